@@ -0,0 +1,173 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache", "artifacts")
+
+# Size budget of the cached artifacts, the least recently used ones are evicted above it
+MAX_CACHE_SIZE = 1024 * 1024 * 1024 * 10
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# ░█▀▀░█▀█░█▀▀░█░█░█▀▀
+# ░█░░░█▀█░█░░░█▀█░█▀▀
+# ░▀▀▀░▀░▀░▀▀▀░▀░▀░▀▀▀
+
+
+def make_settings(media_type: str, extension: str, constraints: dict = None) -> str:
+    """ Canonical form of the settings producing an artifact
+    """
+    return json.dumps({"media_type": media_type, "extension": extension, "constraints": constraints or {}}, sort_keys=True)
+
+
+def make_key(video_id: str, itags: list[int], settings: str) -> str:
+    """ Content address of an artifact
+    """
+    return hashlib.sha256(json.dumps([video_id, sorted(itags), settings]).encode()).hexdigest()
+
+
+def link_or_copy(source: str, destination: str):
+    """ Hardlink source to destination, or copy it across file systems
+    """
+    if os.path.isfile(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ArtifactCache:
+    """ Finished media files stored once, keyed by video id, itags, output format and post-processing settings.
+    An SQLite index keeps their size and last use, so lookups and evictions never scan the disk.
+    """
+    def __init__(self, folder: str = CACHE_FOLDER, max_size: int = MAX_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(folder, "index.sqlite"), check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS artifacts (
+            key TEXT PRIMARY KEY, video_id TEXT NOT NULL, itags TEXT NOT NULL, settings TEXT NOT NULL,
+            name TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS artifacts_lookup ON artifacts (video_id, settings)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS artifacts_lru ON artifacts (last_access)")
+        self.connection.commit()
+
+    def find(self, video_id: str, settings: str) -> dict | None:
+        """ Most recent artifact of a video for the given settings, before its formats are even resolved
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT key FROM artifacts WHERE video_id = ? AND settings = ? ORDER BY created_at DESC LIMIT 1",
+                (video_id, settings)).fetchone()
+        return self.get(row[0]) if row else None
+
+    def get(self, key: str) -> dict | None:
+        """ Artifact stored under key, marked as used. Entries whose file disappeared are dropped.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT key, video_id, itags, settings, name, path, size, created_at FROM artifacts WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+
+            if not os.path.isfile(row[5]):
+                self.connection.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+
+            self.connection.execute("UPDATE artifacts SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+
+        return {"key": row[0], "video_id": row[1], "itags": json.loads(row[2]), "settings": row[3],
+                "name": row[4], "path": row[5], "size": row[6], "created_at": row[7]}
+
+    def put(self, video_id: str, itags: list[int], settings: str, filename: str) -> dict:
+        """ Store a finished file, hardlinked when possible so it takes no extra space,
+        then evict the least recently used artifacts above the size budget.
+        Returns the stored artifact, None if it could not be stored.
+        """
+        key = make_key(video_id, itags, settings)
+        path = os.path.join(self.folder, key + os.path.splitext(filename)[1])
+        try:
+            link_or_copy(filename, path)
+        except OSError:
+            logging.exception(f"Could not cache {filename}")
+            return None
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (key, video_id, json.dumps(sorted(itags)), settings, os.path.basename(filename),
+                                     path, os.path.getsize(path), now, now))
+            self.connection.commit()
+
+        self.evict()
+        return self.get(key)
+
+    def materialize(self, artifact: dict, folder: str) -> str:
+        """ Put a cached artifact into folder under its original name.
+        Returns the new path.
+        """
+        destination = os.path.join(folder, artifact["name"])
+        if os.path.abspath(destination) != os.path.abspath(artifact["path"]):
+            link_or_copy(artifact["path"], destination)
+        return destination
+
+    def total_size(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+    def query(self, video_id: str = None) -> list[dict]:
+        """ Indexed artifacts, of one video or of all of them, the most recently used first
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, video_id, itags, settings, name, path, size, created_at, last_access FROM artifacts "
+                + ("WHERE video_id = ? " if video_id else "") + "ORDER BY last_access DESC",
+                (video_id,) if video_id else ()).fetchall()
+        return [{"key": row[0], "video_id": row[1], "itags": json.loads(row[2]), "settings": row[3], "name": row[4],
+                 "path": row[5], "size": row[6], "created_at": row[7], "last_access": row[8]} for row in rows]
+
+    def evict(self):
+        """ Remove the least recently used artifacts until the cache fits in max_size
+        """
+        with self.lock:
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+            rows = self.connection.execute("SELECT key, path, size FROM artifacts ORDER BY last_access ASC").fetchall() \
+                if total > self.max_size else []
+
+            for key, path, size in rows:
+                if total <= self.max_size:
+                    break
+                try:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                except OSError:
+                    logging.exception(f"Could not evict {path}")
+                    continue
+                self.connection.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                total -= size
+            self.connection.commit()
+
+
+def get_cache() -> ArtifactCache:
+    """ The process-wide artifact cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ArtifactCache()
+        return _cache
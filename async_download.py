@@ -0,0 +1,488 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import asyncio
+import hashlib
+import logging
+import ssl
+import os
+import time
+from urllib.parse import urlsplit, urljoin
+import bandwidth
+import download
+import metrics
+
+# Received bytes gathered before a write, each write goes through a thread to keep the event loop free
+WRITE_BATCH_SIZE = 1024 * 1024
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# What a transfer raises when the server is unreachable, closes early or sends something unexpected
+TRANSFER_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError)
+
+# Period of the checks of a file: adapting its workers, hedging its stalled ranges and hashing the landed ones
+MONITOR_INTERVAL = 0.5
+
+# ░█▀█░█▀█░█▀█░█░░
+# ░█▀▀░█░█░█░█░█░░
+# ░▀░░░▀▀▀░▀▀▀░▀▀▀
+
+
+class ConnectionPool:
+    """ Keep-alive HTTP/1.1 connections shared by every transfer of an event loop,
+    with a global connection limit and a per host limit.
+    """
+    def __init__(self, max_connections = 32, per_host_connections = 8, timeout = 10, buffer_size = 1024 * 64):
+        self.global_slots = asyncio.Semaphore(max_connections)
+        self.per_host_connections = per_host_connections
+        self.host_slots = {}
+        self.idle = {}
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.ssl_context = ssl.create_default_context()
+
+        # Connection reuse counters
+        self.opened = 0
+        self.requests = 0
+
+    async def request(self, method: str, url: str, headers: dict = None, on_data=None, max_redirects = 5, check=None) -> tuple[int, dict]:
+        """ Send a request, following redirects, and give each piece of a successful body to the on_data coroutine.
+        check is called with the status and the headers of the final response before its body is read,
+        whatever it raises drops the connection and is raised.
+        Returns the status and the lower-cased response headers.
+        """
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+            path = parts.path + ("?" + parts.query if parts.query else "")
+
+            if parts.hostname not in self.host_slots:
+                self.host_slots[parts.hostname] = asyncio.Semaphore(self.per_host_connections)
+            async with self.global_slots, self.host_slots[parts.hostname]:
+                status, response_headers = await self._send(key, method, path, headers or {}, on_data, check)
+
+            if status in REDIRECT_STATUSES and "location" in response_headers:
+                url = urljoin(url, response_headers["location"])
+                continue
+            return status, response_headers
+
+        raise ConnectionError(f"Too many redirects for {url}")
+
+    async def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+    async def _send(self, key: tuple, method: str, path: str, headers: dict, on_data, check) -> tuple[int, dict]:
+        # A reused connection may have been closed by the server meanwhile, so retry once on a fresh one
+        idle = self.idle.setdefault(key, [])
+        reused = len(idle) > 0
+        reader, writer = idle.pop() if reused else await self._open(key)
+
+        try:
+            return await self._exchange(key, reader, writer, method, path, headers, on_data, check)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            if not reused:
+                raise e
+        except BaseException as e:
+            writer.close()
+            raise e
+
+        reader, writer = await self._open(key)
+        try:
+            return await self._exchange(key, reader, writer, method, path, headers, on_data, check)
+        except BaseException as e:
+            writer.close()
+            raise e
+
+    async def _open(self, key: tuple) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        scheme, host, port = key
+        self.opened += 1
+        return await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == "https" else None), self.timeout)
+
+    async def _exchange(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                        method: str, path: str, headers: dict, on_data, check) -> tuple[int, dict]:
+        self.requests += 1
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {key[1]}", "Connection: keep-alive"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not status_line:
+            raise ConnectionError("Connection closed by the server")
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if check and not (status in REDIRECT_STATUSES and "location" in response_headers):
+            check(status, response_headers)
+
+        # Only successful bodies are handed out
+        sink = on_data if 200 <= status < 300 else None
+        keep_alive = response_headers.get("connection", "").lower() != "close"
+
+        if method == "HEAD" or status in (204, 304):
+            pass
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), self.timeout)).split(b";")[0], 16)
+                if size == 0:
+                    await asyncio.wait_for(reader.readline(), self.timeout)
+                    break
+                await self._read_body(reader, size, sink)
+                await asyncio.wait_for(reader.readexactly(2), self.timeout)
+        elif "content-length" in response_headers:
+            await self._read_body(reader, int(response_headers["content-length"]), sink)
+        else:
+            await self._read_body(reader, None, sink)
+            keep_alive = False
+
+        if keep_alive:
+            self.idle[key].append((reader, writer))
+        else:
+            writer.close()
+        return status, response_headers
+
+    async def _read_body(self, reader: asyncio.StreamReader, size: int | None, on_data):
+        """ Read size bytes, or until the connection closes if size is None
+        """
+        remaining = size
+        while remaining is None or remaining > 0:
+            data = await asyncio.wait_for(reader.read(self.buffer_size if remaining is None else min(self.buffer_size, remaining)), self.timeout)
+            if not data:
+                if remaining is None:
+                    return
+                raise ConnectionError(f"Connection closed with {remaining} bytes left")
+            if remaining is not None:
+                remaining -= len(data)
+            if on_data:
+                await on_data(data)
+
+# ░█▀▀░█░█░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█░█▀▀
+# ░█▀▀░█░█░█░█░█░░░░█░░░█░░█░█░█░█░▀▀█
+# ░▀░░░▀▀▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀▀▀░▀░▀░▀▀▀
+
+
+class RangeCancelled(Exception):
+    """ Raised from the body of a range once another copy of it completed, to drop the connection
+    """
+
+
+def write_batch(writer: download.RangeWriter, flow: bandwidth.Flow, offset: int, data: bytes, digest=None):
+    """ Wait for the turn of data in the bandwidth limit and write it at offset, run from a thread
+    """
+    flow.consume(len(data))
+    writer.write_at(offset, data)
+    if digest is not None:
+        digest.update(data)
+
+
+async def download_worker(pool: ConnectionPool, url: str, scheduler: download.RangeScheduler, writer: download.RangeWriter,
+                          flow: bandwidth.Flow, batch_size = WRITE_BATCH_SIZE, on_written=None, on_done=None):
+    """ Pull ranges from the scheduler until it tells the worker to stop, like download.download_worker:
+    failed ranges are retried after a backoff and the hedges of the stalled ones are taken first.
+    The body of a range is only written once its response is checked, in batches written from a thread.
+    on_written is called with the number of new bytes of every batch, as a range and its hedge write the same bytes,
+    on_done with each (start, end) range once it is fully written, and with the written part of the failed ones.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        task = scheduler.poll_task()
+        if task is None:
+            return
+        # Retries in backoff, a hedge may come meanwhile
+        if isinstance(task, float):
+            await asyncio.sleep(min(task, MONITOR_INTERVAL))
+            continue
+
+        batch = bytearray()
+
+        def check(status: int, headers: dict):
+            if status != 206:
+                raise ValueError(f"Range request returned status {status}")
+            download.check_range_headers(status, headers, task.start, task.end)
+
+        async def flush():
+            if batch:
+                data = bytes(batch)
+                batch.clear()
+                await loop.run_in_executor(None, write_batch, writer, flow, task.position, data)
+                new_bytes = scheduler.advance(task, len(data))
+                if new_bytes and on_written:
+                    on_written(new_bytes)
+
+        async def on_data(data: bytes):
+            if task.cancelled:
+                raise RangeCancelled()
+            if task.position + len(batch) + len(data) > task.end + 1:
+                raise ValueError(f"Range {task.start}-{task.end} is longer than asked")
+            batch.extend(data)
+            if len(batch) >= batch_size:
+                await flush()
+
+        try:
+            with metrics.span("range", hedge=str(task.primary is not None).lower()):
+                await pool.request("GET", url, {"Range": f"bytes={task.start}-{task.end}"}, on_data, check=check)
+                await flush()
+        except RangeCancelled:
+            pass
+        # Whatever the error, the range goes back to the scheduler instead of leaving a hole
+        except Exception as e:
+            if not task.cancelled:
+                metrics.count("range_failures")
+                logging.warning(f"Could not download range {task.start}-{task.end} of {writer.filename}, attempt {task.attempt + 1}: {e}")
+
+        chunk_range = scheduler.complete(task) if task.position == task.end + 1 else scheduler.fail(task)
+        if chunk_range and on_done:
+            await on_done(chunk_range)
+
+
+async def stream_one(pool: ConnectionPool, url: str, filename: str, flow: bandwidth.Flow, report, batch_size = WRITE_BATCH_SIZE,
+                     digest=None) -> int:
+    """ Download url into filename with a single GET, for a file of unknown length or too small to be split.
+    Returns the number of bytes written.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, download.create_file, filename, 0)
+    writer = download.RangeWriter(filename)
+    position = 0
+    batch = bytearray()
+
+    async def flush():
+        nonlocal position
+        if batch:
+            data = bytes(batch)
+            batch.clear()
+            await loop.run_in_executor(None, write_batch, writer, flow, position, data, digest)
+            position += len(data)
+            report(len(data))
+
+    async def on_data(data: bytes):
+        batch.extend(data)
+        if len(batch) >= batch_size:
+            await flush()
+
+    def check(status: int, headers: dict):
+        if status != 200:
+            raise ValueError(f"Download returned status {status}")
+
+    try:
+        await pool.request("GET", url, on_data=on_data, check=check)
+        await flush()
+    finally:
+        writer.close()
+    return position
+
+
+async def download_one(pool: ConnectionPool, url: str, filename: str, num_threads = 8, chunk_size = 1024 * 1024 * 4, adaptive = False,
+                       max_threads = 16, stats: dict = None, on_progress=None, on_size=None, max_memory = download.MAX_BUFFER_MEMORY,
+                       weight = 1.0, hedge = True, expected_size: int = None, hash_algorithm: str = None, expected_hash: str = None) -> bool:
+    """ Download one url into filename through the shared pool, resuming from its journal if any.
+    Same options and checks as download.download_file, the workers being tasks of the event loop instead of threads.
+    Each worker gathers at most max_memory / max_threads bytes (WRITE_BATCH_SIZE at most) before writing them.
+    Returns True once every range is written and checked, False otherwise.
+    """
+    if chunk_size % 1024 != 0 or num_threads <= 0:
+        return False
+    loop = asyncio.get_running_loop()
+
+    try:
+        status, headers = await pool.request("HEAD", url)
+    except TRANSFER_ERRORS:
+        logging.exception(f"Could not reach {url}")
+        return False
+    if status >= 400:
+        logging.error(f"Cannot download {filename}, the server answered {status}")
+        return False
+
+    total_size = int(headers.get("content-length", 0))
+    validator = headers.get("etag") or headers.get("last-modified")
+    if expected_size and total_size and total_size != expected_size:
+        logging.error(f"Cannot download {filename}, the server announces {total_size} bytes instead of {expected_size}")
+        return False
+    if on_size:
+        on_size(total_size)
+
+    def report(size: int):
+        metrics.count("downloaded_bytes", size)
+        if on_progress:
+            on_progress(size)
+
+    flow = bandwidth.get_limiter().flow(weight)
+    batch_size = max(1024 * 64, min(WRITE_BATCH_SIZE, max_memory // max(max_threads if adaptive else num_threads, 1)))
+    start_time = time.monotonic()
+
+    # Unknown length, or not worth splitting
+    if total_size == 0 or (adaptive and total_size < download.SMALL_FILE_SIZE):
+        digest = hashlib.new(hash_algorithm) if hash_algorithm else None
+        try:
+            written = await stream_one(pool, url, filename, flow, report, batch_size, digest)
+        except TRANSFER_ERRORS:
+            logging.exception(f"Could not download {filename}")
+            written = -1
+        if stats is not None:
+            stats.update({"mode": "single", "threads": 1, "chunk_size": total_size, "chunk_sizes": [total_size], "size": written,
+                          "elapsed": time.monotonic() - start_time,
+                          "throughput": written / max(time.monotonic() - start_time, 1e-6)})
+        if written < 0:
+            return False
+        if written != (expected_size or total_size or written):
+            logging.error(f"Download of {filename} is truncated, {written} bytes instead of {expected_size or total_size}")
+            return False
+        return digest is None or download.check_hash(filename, digest.hexdigest(), hash_algorithm, expected_hash, stats)
+
+    done = await loop.run_in_executor(None, download.load_journal, filename, total_size, validator)
+    if done is None:
+        done = []
+        await loop.run_in_executor(None, download.create_file, filename, total_size)
+        await loop.run_in_executor(None, download.save_journal, filename, total_size, validator, done)
+    else:
+        logging.info(f"Resuming {filename}, {len(done)} ranges already downloaded")
+
+    missing_ranges = download.get_missing_ranges(total_size, done)
+    resumed = total_size - sum(end - start + 1 for start, end in missing_ranges)
+    metrics.count("resumed_bytes", resumed)
+    if on_progress and resumed:
+        on_progress(resumed)
+
+    if adaptive:
+        scheduler = download.RangeScheduler(missing_ranges, download.MIN_CHUNK_SIZE * 4, min(4, num_threads))
+        controller = download.ThroughputController(scheduler, max_threads)
+    else:
+        scheduler = download.RangeScheduler(missing_ranges, chunk_size, num_threads)
+        controller = None
+
+    journal_lock = asyncio.Lock()
+
+    async def on_done(chunk_range: tuple[int, int]):
+        done.append(chunk_range)
+        # One save at a time, each from a copy, so an older journal never replaces a newer one
+        async with journal_lock:
+            await loop.run_in_executor(None, download.save_journal, filename, total_size, validator, list(done))
+
+    def on_written(size: int):
+        scheduler.add_bytes(size)
+        report(size)
+
+    writer = download.RangeWriter(filename)
+    hasher = download.RangeHasher(writer, hash_algorithm) if hash_algorithm else None
+
+    async def run_workers(range_scheduler: download.RangeScheduler, range_controller: download.ThroughputController = None):
+        workers = set()
+        try:
+            while True:
+                while range_scheduler.add_worker():
+                    workers.add(asyncio.ensure_future(
+                        download_worker(pool, url, range_scheduler, writer, flow, batch_size, on_written, on_done)))
+
+                # Until all workers end, adapting them and hashing the landed ranges on the way
+                workers = {worker for worker in workers if not worker.done()}
+                if not workers:
+                    return
+                await asyncio.wait(workers, timeout=MONITOR_INTERVAL)
+                if range_controller:
+                    range_controller.update()
+                if hedge:
+                    range_scheduler.hedge_stalled()
+                if hasher is not None:
+                    await loop.run_in_executor(None, hasher.update, list(done))
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    try:
+        await run_workers(scheduler, controller)
+
+        # Only the ranges the journal does not account for are fetched again
+        missing_ranges = download.get_missing_ranges(total_size, done)
+        if missing_ranges and not scheduler.failed:
+            logging.warning(f"{len(missing_ranges)} ranges of {filename} were not written, fetching them again")
+            metrics.count("range_refetches", len(missing_ranges))
+            refetch_scheduler = download.RangeScheduler(missing_ranges, chunk_size, num_threads)
+            await run_workers(refetch_scheduler)
+            scheduler.failed += refetch_scheduler.failed
+            missing_ranges = download.get_missing_ranges(total_size, done)
+
+        size_on_disk = writer.size()
+        if hasher is not None and not missing_ranges:
+            await loop.run_in_executor(None, hasher.update, list(done))
+    finally:
+        writer.close()
+
+    if stats is not None:
+        elapsed = time.monotonic() - start_time
+        stats.update({"mode": "adaptive" if adaptive else "fixed",
+                      "threads": scheduler.peak_workers,
+                      "chunk_size": scheduler.chunk_size, "chunk_sizes": controller.chunk_sizes if controller else [chunk_size],
+                      "size": scheduler.downloaded,
+                      "retries": scheduler.retried, "hedges": scheduler.hedged,
+                      "elapsed": elapsed, "throughput": scheduler.downloaded / max(elapsed, 1e-6)})
+
+    return download.check_download(filename, total_size, scheduler.failed, missing_ranges, size_on_disk, hasher, expected_hash, stats)
+
+
+async def download_files_async(jobs: list[tuple], num_threads = 8, chunk_size = 1024 * 1024 * 4, timeout = 10, display_bar = True,
+                               buffer_size = 1024 * 64, max_connections = 32, per_host_connections = 8, **options) -> list[bool]:
+    """ Download every (url, filename) job at once from one event loop.
+    Each file runs up to num_threads range requests, all of them sharing a pool of keep-alive connections
+    limited to max_connections overall and per_host_connections per host.
+    options are the ones of download_one for every file, a job can add its own as a third item,
+    like {"expected_size": ..., "expected_hash": ..., "stats": {}}.
+    """
+    pool = ConnectionPool(max_connections, per_host_connections, timeout, buffer_size)
+    if display_bar:
+        from tqdm import tqdm
+        bar = tqdm(total=0, desc="Downloading files", colour="yellow", unit="B", unit_scale=True)
+    else:
+        bar = None
+
+    def on_size(size: int):
+        # Grow the total as sizes get known
+        bar.total += size
+        bar.refresh()
+
+    def file_options(job: tuple) -> dict:
+        file_options = dict(options)
+        if bar is not None:
+            file_options.update({"on_progress": bar.update, "on_size": on_size})
+        file_options.update(job[2] if len(job) > 2 else {})
+        return file_options
+
+    try:
+        return list(await asyncio.gather(*[download_one(pool, job[0], job[1], num_threads, chunk_size, **file_options(job))
+                                           for job in jobs]))
+    finally:
+        await pool.close()
+        if bar is not None:
+            bar.close()
+
+def download_files(jobs: list[tuple], num_threads = 8, chunk_size = 1024 * 1024 * 4, timeout = 10, display_bar = True,
+                   buffer_size = 1024 * 64, max_connections = 32, per_host_connections = 8, **options) -> list[bool]:
+    """ Blocking version of download_files_async
+    """
+    return asyncio.run(download_files_async(jobs, num_threads, chunk_size, timeout, display_bar,
+                                            buffer_size, max_connections, per_host_connections, **options))
+
+@metrics.timed("download_file")
+def download_file(url: str, filename: str, num_threads = 8, chunk_size = 1024 * 1024 * 4, timeout = 10, display_bar = True, buffer_size = 1024 * 64,
+                  adaptive = False, max_threads = 16, stats: dict = None, on_progress=None, on_size=None, max_memory = download.MAX_BUFFER_MEMORY,
+                  weight = 1.0, hedge = True, expected_size: int = None, hash_algorithm: str = None, expected_hash: str = None) -> bool:
+    """ Same as download.download_file, running on an event loop instead of OS threads
+    """
+    # Every worker and hedge of the file gets its own connection
+    connections = (max_threads if adaptive else num_threads) + download.MAX_HEDGES
+    return download_files([(url, filename, {"stats": stats, "on_progress": on_progress, "on_size": on_size,
+                                            "expected_size": expected_size, "expected_hash": expected_hash})],
+                          num_threads, chunk_size, timeout, display_bar, buffer_size, connections, connections,
+                          adaptive=adaptive, max_threads=max_threads, max_memory=max_memory, weight=weight, hedge=hedge,
+                          hash_algorithm=hash_algorithm)[0]
@@ -0,0 +1,134 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import re
+import threading
+import time
+import metrics
+
+# Bucket capacity, in seconds of the rate, sent at once after an idle period
+BURST_DURATION = 0.1
+MIN_BURST = 1024 * 64
+
+# Longest wait before a thread checks the bucket again, so a rate change is picked up quickly
+MAX_WAIT = 0.05
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+# ░█░░░▀█▀░█▄█░▀█▀░▀█▀░█▀▀░█▀▄
+# ░█░░░░█░░█░█░░█░░░█░░█▀▀░█▀▄
+# ░▀▀▀░▀▀▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀░▀
+
+
+def parse_rate(text: str) -> int:
+    """ Bytes per second from a rate like 500K, 2.5M or 1G (powers of 1024), 0 for no limit
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*", str(text).lower())
+    if not match:
+        raise ValueError(f"Invalid rate {text}, expected a number of bytes per second like 500K or 2M")
+    return int(float(match.group(1)) * 1024 ** " kmg".index(match.group(2) or " "))
+
+
+class Flow:
+    """ Share of one file in the limiter, whatever its number of connections.
+    Waiting flows are served in proportion to their weight.
+    """
+    def __init__(self, limiter: "BandwidthLimiter", weight = 1.0):
+        if weight <= 0:
+            raise ValueError("The weight of a flow must be positive")
+        self.limiter = limiter
+        self.weight = weight
+        # Bytes served divided by the weight, the waiting flow with the lowest goes first
+        self.virtual_time = 0.0
+        self.waiting = 0
+
+    def consume(self, size: int):
+        self.limiter.consume(self, size)
+
+
+class BandwidthLimiter:
+    """ Token bucket shared by every transfer of the process, refilled at rate bytes per second (0 for no limit).
+    The rate can be changed at any time, waiting transfers follow the new one right away.
+    """
+    def __init__(self, rate = 0):
+        self.rate = 0
+        self.burst = MIN_BURST
+        self.tokens = 0.0
+        self.updated_at = time.monotonic()
+        self.transferred = 0
+        self.virtual_clock = 0.0
+        self.waiting = []
+        self.condition = threading.Condition()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: int):
+        with self.condition:
+            self._refill()
+            self.rate = max(0, int(rate))
+            self.burst = max(MIN_BURST, int(self.rate * BURST_DURATION))
+            self.tokens = min(self.tokens, self.burst)
+            self.condition.notify_all()
+
+    def flow(self, weight = 1.0) -> Flow:
+        return Flow(self, weight)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, flow: Flow, size: int):
+        """ Wait until the size bytes received by flow fit in the rate.
+        A transfer may overdraw the bucket, the next ones wait for the debt to be refilled,
+        so the long-run rate is exact whatever the read sizes.
+        """
+        if not self.rate:
+            with self.condition:
+                self.transferred += size
+            return
+
+        start = time.monotonic()
+        with self.condition:
+            flow.waiting += 1
+            if flow.waiting == 1:
+                # An idle flow does not get credit for the time it did not use
+                flow.virtual_time = max(flow.virtual_time, self.virtual_clock)
+                self.waiting.append(flow)
+            try:
+                while True:
+                    self._refill()
+                    if not self.rate:
+                        break
+                    first = min(self.waiting, key=lambda waiting: waiting.virtual_time)
+                    if first is flow and self.tokens > 0:
+                        break
+                    # Until the debt is refilled, or the first flow is served
+                    self.condition.wait(min(MAX_WAIT, max(1.0, -self.tokens) / self.rate) if self.tokens <= 0 else MAX_WAIT)
+
+                self.tokens -= size
+                self.transferred += size
+                self.virtual_clock = flow.virtual_time
+                flow.virtual_time += size / flow.weight
+            finally:
+                flow.waiting -= 1
+                if not flow.waiting:
+                    self.waiting.remove(flow)
+                self.condition.notify_all()
+        metrics.observe("bandwidth_wait_seconds", time.monotonic() - start)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"rate": self.rate, "transferred": self.transferred, "waiting_flows": len(self.waiting)}
+
+
+def get_limiter() -> BandwidthLimiter:
+    """ The process-wide limiter, without limit until set_rate is called
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = BandwidthLimiter()
+        return _limiter
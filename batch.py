@@ -0,0 +1,165 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import Iterator
+import requests
+import artifact_cache
+import bandwidth
+import metrics
+import pipeline
+import ytb_classes
+
+# Minimum time between two Prometheus snapshots of a run, in seconds
+METRICS_INTERVAL = 10
+
+# ░█▀▀░█░█░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█░█▀▀
+# ░█▀▀░█░█░█░█░█░░░░█░░░█░░█░█░█░█░▀▀█
+# ░▀░░░▀▀▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀▀▀░▀░▀░▀▀▀
+
+
+def read_urls(urls: list[str], input_file: str = None) -> Iterator[str]:
+    """ Yield the given urls, then the ones of input_file ("-" for stdin), one per line.
+    Empty lines and lines starting with # are skipped.
+    """
+    yield from urls
+    if not input_file:
+        return
+
+    file = sys.stdin if input_file == "-" else open(input_file, encoding="utf-8")
+    try:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def expand_urls(urls: Iterator[str], failures: list[dict]) -> Iterator[tuple[str, ytb_classes.Video]]:
+    """ Yield the (source url, video) of every url, playlists being listed page by page.
+    Links that cannot be used are added to failures.
+    """
+    for url in urls:
+        try:
+            playlist = ytb_classes.Playlist(url)
+        except ValueError:
+            try:
+                yield url, ytb_classes.Video(url)
+            except ValueError as e:
+                failures.append({"url": url, "error": str(e), "failed_stage": "detect"})
+            continue
+
+        try:
+            for video in playlist.iter_videos():
+                yield url, video
+        except (ValueError, requests.RequestException) as e:
+            failures.append({"url": url, "error": str(e) or type(e).__name__, "failed_stage": "detect"})
+
+
+def run_batch(urls: Iterator[str], media_type: str, output_folder: str, jobs = 4, audio_extension = "mp3",
+              constraints: dict = None, streaming = False, use_cache = True, verbose = False, metrics_folder: str = None) -> dict:
+    """ Download every url through the pipeline, with jobs videos in flight per stage.
+    With a metrics_folder, the trace of every job and a Prometheus snapshot (metrics.prom) are written into it.
+    Returns the summary of the run, with the outcome and per stage timings of each video.
+    """
+    last_snapshot = time.monotonic()
+    failures = []
+    cache = artifact_cache.get_cache() if use_cache else None
+
+    def make_jobs():
+        for url, video in expand_urls(urls, failures):
+            job = pipeline.make_video_job(video, media_type, output_folder, verbose, audio_extension, constraints,
+                                          streaming, cache)
+            job["source"] = url
+            yield job
+
+    def on_job_done(job: dict):
+        nonlocal last_snapshot
+        if job["error"]:
+            logging.error(f"{job['video']} - {job['failed_stage']}: {job['error']}")
+        else:
+            logging.info(f"{job['output']} - Done{' (cached)' if job.get('cached') else ''}.")
+
+        if metrics_folder and job["trace"] is not None:
+            metrics.write_trace(job["trace"], metrics_folder)
+            # Long runs can be watched from the snapshot
+            if time.monotonic() - last_snapshot > METRICS_INTERVAL:
+                last_snapshot = time.monotonic()
+                metrics.write_prometheus(os.path.join(metrics_folder, "metrics.prom"))
+
+    os.makedirs(output_folder, exist_ok=True)
+    start = time.monotonic()
+    stages = pipeline.get_video_stages(jobs, jobs, max(1, min(jobs, pipeline.POST_PROCESS_WORKERS)))
+    done_jobs = pipeline.run_pipeline(make_jobs(), stages, on_job_done=on_job_done)
+
+    if metrics_folder:
+        metrics.write_prometheus(os.path.join(metrics_folder, "metrics.prom"))
+
+    items = [{"url": job["source"], "video_id": job["video"].id, "title": job.get("title"),
+              "output": job.get("output"), "cached": bool(job.get("cached")), "error": job["error"],
+              "failed_stage": job.get("failed_stage"), "timings": job["timings"], "waits": job["waits"]}
+             for job in done_jobs]
+    failed = [item for item in items if item["error"]]
+    return {"elapsed": time.monotonic() - start, "total": len(items) + len(failures),
+            "succeeded": len(items) - len(failed), "failed": len(failed) + len(failures),
+            "cached": sum(item["cached"] for item in items), "items": items, "failures": failures + failed}
+
+
+def parse_arguments(arguments: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Download Youtube videos and playlists without any prompt.")
+    parser.add_argument("urls", nargs="*", help="video or playlist urls")
+    parser.add_argument("-i", "--input", help="file with one url per line, - for stdin")
+    parser.add_argument("-t", "--type", choices=["audio", "video"], default="audio", help="output media type")
+    parser.add_argument("-o", "--output", default=".", help="output folder")
+    parser.add_argument("-f", "--audio-format", choices=["mp3", "m4a"], default="mp3", help="audio output format")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="videos processed at the same time per stage")
+    parser.add_argument("--max-height", type=int, help="highest video resolution, like 1080")
+    parser.add_argument("--max-filesize", type=int, help="largest stream size in bytes")
+    parser.add_argument("--codec", help="codec to prefer, like avc1 or opus")
+    parser.add_argument("--streaming", action="store_true", help="pipe audio into ffmpeg while it downloads")
+    parser.add_argument("--no-cache", action="store_true", help="do not reuse nor store finished files")
+    parser.add_argument("--summary", help="write the JSON summary to this file instead of stdout")
+    parser.add_argument("--metrics", help="folder to write the job traces and a Prometheus snapshot into")
+    parser.add_argument("--limit-rate", type=bandwidth.parse_rate, default=0, help="bandwidth cap shared by every download, like 500K or 2M")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the ffmpeg output")
+    args = parser.parse_args(arguments)
+
+    if not args.urls and not args.input:
+        parser.error("no url nor input file given")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+# ░█▄█░█▀█░▀█▀░█▀█
+# ░█░█░█▀█░░█░░█░█
+# ░▀░▀░▀░▀░▀▀▀░▀░▀
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    # Progress goes to stderr, stdout is kept for the summary
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    if args.metrics:
+        metrics.enable()
+    bandwidth.get_limiter().set_rate(args.limit_rate)
+
+    constraints = {"max_height": args.max_height, "max_filesize": args.max_filesize, "preferred_codec": args.codec}
+    summary = run_batch(read_urls(args.urls, args.input), args.type, args.output, args.jobs, args.audio_format,
+                        {key: value for key, value in constraints.items() if value}, args.streaming,
+                        not args.no_cache, args.verbose, args.metrics)
+
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    sys.exit(1 if summary["failed"] else 0)
@@ -0,0 +1,625 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import argparse
+import bandwidth
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import download
+import html_extractor
+import http_client
+import media_management
+import metrics
+import pipeline
+import ytb_classes
+
+# Startup budget, in seconds
+IMPORT_BUDGET = 0.3
+PROMPT_BUDGET = 0.5
+
+# Saved Youtube pages (*.html) for the extraction benchmark, synthetic pages are used when there are none
+PAGES_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache", "pages")
+
+# Stand-in server conditions of the end to end benchmark
+STANDIN_LATENCY = 0.02
+STANDIN_BANDWIDTH = 1024 * 1024 * 8
+STANDIN_FAILURE_RATE = 0.02
+
+# Size of the stream downloaded by the writer benchmark
+WRITER_SIZE = 1024 * 1024 * 1024 * 2
+
+# Run in a child process, so the peak RSS is its own and not the one of the former benchmarks
+WRITER_CHILD = """
+import json, resource, sys, time
+import download
+start = time.perf_counter()
+ok = download.download_file(sys.argv[1], sys.argv[2], display_bar=False, adaptive=True, expected_size=int(sys.argv[3]),
+                            hash_algorithm=sys.argv[4] if len(sys.argv) > 4 else None)
+usage = resource.getrusage(resource.RUSAGE_SELF)
+print(json.dumps({"ok": ok, "elapsed": time.perf_counter() - start, "cpu": usage.ru_utime + usage.ru_stime,
+                  "peak": usage.ru_maxrss / 1024 / 1024 if sys.platform == "darwin" else usage.ru_maxrss / 1024}))
+"""
+
+# Tail benchmark: share of the range responses sent at a crawl, and bandwidth of the others
+TAIL_SLOW_RATE = 0.05
+TAIL_BANDWIDTH = 1024 * 1024 * 8
+
+# Cap of the bandwidth benchmark, halved halfway through
+BANDWIDTH_RATE = 1024 * 1024 * 40
+
+# Modules that must not be loaded before they are used
+HEAVY_MODULES = ["git", "mutagen", "tqdm"]
+
+# ░█▀█░█▀█░█▀▀░▀█▀░░░█▀█░█▀▄░█▀█░█▀▀░█▀▀░█▀▀░█▀▀░▀█▀░█▀█░█▀▀
+# ░█▀▀░█░█░▀▀█░░█░░░░█▀▀░█▀▄░█░█░█░░░█▀▀░▀▀█░▀▀█░░█░░█░█░█░█
+# ░▀░░░▀▀▀░▀▀▀░░▀░░░░▀░░░▀░▀░▀▀▀░▀▀▀░▀▀▀░▀▀▀░▀▀▀░▀▀▀░▀░▀░▀▀▀
+
+
+def make_synthetic_media(folder: str, duration = 60) -> tuple[str, str, str]:
+    """ Create a webm video stream, a webm audio stream and a jpg thumbnail with ffmpeg lavfi sources,
+    close to what Youtube serves.
+    Returns their paths.
+    """
+    video_path = os.path.join(folder, "source.video.webm")
+    audio_path = os.path.join(folder, "source.audio.webm")
+    thumbnail = os.path.join(folder, "source.jpg")
+    starter = media_management.get_ffmpeg_command_starter()
+
+    subprocess.run(starter + ["-f", "lavfi", "-i", f"testsrc2=duration={duration}:size=1280x720:rate=30",
+                              "-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-b:v", "2M", "-y", video_path], check=True)
+    subprocess.run(starter + ["-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+                              "-c:a", "libopus", "-b:a", "128k", "-y", audio_path], check=True)
+    subprocess.run(starter + ["-f", "lavfi", "-i", "testsrc2=size=640x480", "-frames:v", "1", "-y", thumbnail], check=True)
+    return video_path, audio_path, thumbnail
+
+
+def copy_sources(sources: tuple[str, str, str], folder: str) -> tuple[str, str, str]:
+    """ The post-processing functions delete their inputs, so each run works on fresh copies
+    """
+    os.makedirs(folder, exist_ok=True)
+    copies = tuple(os.path.join(folder, os.path.basename(path)) for path in sources)
+    for source, copy in zip(sources, copies):
+        shutil.copyfile(source, copy)
+    return copies
+
+
+def add_metadata(filename: str, thumbnail: str, author: str, title: str, verbose=False) -> bool:
+    """ Former media_management.add_metadata: a full ffmpeg remux of filename with the cover and the tags,
+    kept here as media_management now tags mp3, mp4 and m4a files in place
+    """
+    output_filename = filename + "_temp" + os.path.splitext(filename)[1]
+    command = media_management.get_ffmpeg_command_starter(verbose) + [
+        "-i", thumbnail, "-i", filename, "-map", "0", "-map", "1", "-c", "copy",
+        "-metadata", f"artist={author}", "-metadata", f"title={title}", output_filename]
+
+    success = media_management.run_ffmpeg(command, verbose) == 0 and os.path.isfile(output_filename)
+    os.remove(thumbnail)
+    if not success:
+        if os.path.isfile(output_filename):
+            os.remove(output_filename)
+        return False
+
+    os.remove(filename)
+    os.rename(output_filename, filename)
+    return True
+
+
+def run_chained(folder: str, sources: tuple[str, str, str], media_type: str) -> str:
+    """ Former post-processing: one ffmpeg pass per conversion, per metadata and per merge
+    """
+    video_path, audio_path, thumbnail = copy_sources(sources, folder)
+    audio_path = media_management.convert_to(audio_path, "mp3")
+    if media_type == "audio":
+        add_metadata(audio_path, thumbnail, "Author", "Title")
+        os.remove(video_path)
+        return audio_path
+
+    shutil.copyfile(thumbnail, thumbnail + ".audio.jpg")
+    add_metadata(audio_path, thumbnail + ".audio.jpg", "Author", "Title")
+    video_path = media_management.convert_to(video_path, "mp4")
+    add_metadata(video_path, thumbnail, "Author", "Title")
+    return media_management.merge_video_audio(video_path, audio_path)
+
+
+def run_fused(folder: str, sources: tuple[str, str, str], media_type: str) -> str:
+    """ Single pass post-processing
+    """
+    video_path, audio_path, thumbnail = copy_sources(sources, folder)
+    if media_type == "audio":
+        os.remove(video_path)
+        return media_management.post_process(os.path.join(folder, "output.mp3"), audio_path, None, thumbnail, "Author", "Title")
+    return media_management.post_process(os.path.join(folder, "output.mp4"), audio_path, video_path, thumbnail, "Author", "Title")
+
+
+def benchmark_post_processing(duration = 60, runs = 3):
+    """ Compare the chained ffmpeg passes against the single fused command, for audio and video outputs
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        sources = make_synthetic_media(folder, duration)
+        print(f"Synthetic sources: {duration}s, "
+              f"{sum(os.path.getsize(path) for path in sources) / 1024 / 1024:.1f} MB")
+
+        for media_type in ["audio", "video"]:
+            for name, function in [("chained", run_chained), ("fused", run_fused)]:
+                timings = []
+                for run in range(runs):
+                    run_folder = os.path.join(folder, f"{name}_{media_type}_{run}")
+                    start = time.perf_counter()
+                    output = function(run_folder, sources, media_type)
+                    timings.append(time.perf_counter() - start)
+                    if not output or not os.path.isfile(output):
+                        print(f"{name} {media_type}: no output produced")
+                    shutil.rmtree(run_folder, ignore_errors=True)
+                print(f"{media_type:<6} {name:<8} best {min(timings):.2f}s  mean {sum(timings) / len(timings):.2f}s")
+
+# ░█▀▀░▀█▀░█▀█░█▀▄░▀█▀░█░█░█▀█
+# ░▀▀█░░█░░█▀█░█▀▄░░█░░█░█░█▀▀
+# ░▀▀▀░░▀░░▀░▀░▀░▀░░▀░░▀▀▀░▀░░
+
+
+def measure_import(module: str) -> tuple[float, list[str]]:
+    """ Import module in a fresh interpreter.
+    Returns the import time and the heavy modules it loaded.
+    """
+    code = (f"import sys, time; start = time.perf_counter(); import {module}; elapsed = time.perf_counter() - start; "
+            f"print(elapsed, *[name for name in {HEAVY_MODULES!r} if name in sys.modules])")
+    output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.realpath(__file__)),
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[0]), output[1:]
+
+
+def measure_first_prompt(timeout = 10) -> float | None:
+    """ Time between launching main.py and its first menu prompt, None if it never shows up
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "main.py", "--no-update-check"], cwd=os.path.dirname(os.path.realpath(__file__)),
+                               stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               env=dict(os.environ, PYTHONUNBUFFERED="1"))
+    output = b""
+    try:
+        while b">>> " not in output and time.perf_counter() - start < timeout:
+            data = process.stdout.read1(4096)
+            if not data:
+                return None
+            output += data
+        return time.perf_counter() - start if b">>> " in output else None
+    finally:
+        process.kill()
+        process.wait()
+
+
+def benchmark_startup(runs = 5):
+    """ Import time of every entry module, the heavy modules they load eagerly,
+    and the time to the first prompt of main.py, against the startup budget
+    """
+    for module in ["http_client", "ytb_classes", "download", "media_management", "pipeline", "batch", "daemon"]:
+        timings, heavy = [], []
+        for _ in range(runs):
+            elapsed, heavy = measure_import(module)
+            timings.append(elapsed)
+        status = "ok" if min(timings) <= IMPORT_BUDGET else "OVER BUDGET"
+        print(f"import {module:<18} best {min(timings) * 1000:6.1f}ms  mean {sum(timings) / len(timings) * 1000:6.1f}ms  "
+              f"{status}" + (f"  eager: {', '.join(heavy)}" if heavy else ""))
+
+    timings = [measure_first_prompt() for _ in range(runs)]
+    if None in timings:
+        # The menu reads the Windows console
+        print("main.py did not reach its first prompt")
+    else:
+        status = "ok" if min(timings) <= PROMPT_BUDGET else "OVER BUDGET"
+        print(f"first prompt            best {min(timings) * 1000:6.1f}ms  mean {sum(timings) / len(timings) * 1000:6.1f}ms  {status}")
+
+# ░█▀▀░█░█░▀█▀░█▀▄░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█
+# ░█▀▀░▄▀▄░░█░░█▀▄░█▀█░█░░░░█░░░█░░█░█░█░█
+# ░▀▀▀░▀░▀░░▀░░▀░▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀▀▀░▀░▀
+
+
+def make_synthetic_page(videos = 5000) -> bytes:
+    """ Youtube-like page: scripts before and after the ytcfg holding the API key, and a multi-MB ytInitialData
+    """
+    filler = "".join(f"<script>var f{i} = function(a) {{ return a + {i}; }};</script>\n" for i in range(5000))
+    initial_data = {"contents": {"items": [{"playlistVideoRenderer": {
+        "videoId": f"video{i:06d}", "title": {"runs": [{"text": f"Video number {i} " * 8}]},
+        "thumbnail": {"thumbnails": [{"url": f"https://i.ytimg.com/vi/video{i:06d}/hqdefault.jpg", "width": 480}] * 4}}}
+        for i in range(videos)]}}
+    page = (f"<html><head>{filler}<script>ytcfg.set({{\"INNERTUBE_API_KEY\":\"AIzaSyDummyKeyForTheBenchmark0000000\"}});</script>"
+            f"{filler}</head><body><script>var ytInitialData = {json.dumps(initial_data)};</script>{filler}</body></html>")
+    return page.encode()
+
+
+def old_api_key(page: bytes) -> str | None:
+    """ Former extraction: a BeautifulSoup DOM of the whole page, its scripts searched one by one
+    """
+    from bs4 import BeautifulSoup
+    for script_tag in BeautifulSoup(page.decode(), "html.parser").find_all("script"):
+        if script_tag.string is not None:
+            match = re.search(r'"INNERTUBE_API_KEY":"([^"]+)"', script_tag.string)
+            if match is not None:
+                return match.group(1)
+    return None
+
+
+def new_api_key(page: bytes) -> str | None:
+    """ The page fed as 64KiB chunks, as they arrive from the network
+    """
+    key = html_extractor.search_chunks(page[i:i + 1024 * 64] for i in range(0, len(page), 1024 * 64))
+    return key.decode() if key else None
+
+
+def old_initial_data(page: bytes) -> dict | None:
+    """ Former extraction: a non-greedy regex over the whole page, then json.loads on the match
+    """
+    result = re.search(r'ytInitialData =\s*({.+?});', page.decode())
+    return json.loads(result.group(1)) if result else None
+
+
+def new_initial_data(page: bytes) -> dict | None:
+    return html_extractor.extract_json(page.decode())
+
+
+def measure(function, page: bytes, runs: int) -> tuple[float, int, object]:
+    """ Best CPU time over runs, peak traced memory of one run, and the result
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.process_time()
+        result = function(page)
+        timings.append(time.process_time() - start)
+
+    tracemalloc.start()
+    function(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak, result
+
+
+def benchmark_extraction(runs = 5):
+    """ Compare the BeautifulSoup and regex extractions against html_extractor, in CPU time and peak memory,
+    on the pages saved in PAGES_FOLDER or on a synthetic page
+    """
+    pages = {os.path.basename(path): open(path, "rb").read() for path in sorted(glob.glob(os.path.join(PAGES_FOLDER, "*.html")))}
+    if not pages:
+        pages = {"synthetic": make_synthetic_page()}
+
+    for name, page in pages.items():
+        print(f"{name}: {len(page) / 1024 / 1024:.1f} MB")
+        for task, old, new in [("api key", old_api_key, new_api_key), ("initial data", old_initial_data, new_initial_data)]:
+            results = []
+            for approach, function in [("old", old), ("new", new)]:
+                try:
+                    elapsed, peak, result = measure(function, page, runs)
+                except ImportError as e:
+                    print(f"  {task:<13} {approach}: skipped, {e}")
+                    continue
+                except ValueError as e:
+                    print(f"  {task:<13} {approach}: failed, {e}")
+                    continue
+                results.append(result)
+                print(f"  {task:<13} {approach}  cpu {elapsed * 1000:8.1f}ms  peak {peak / 1024 / 1024:7.1f} MB"
+                      + ("" if result else "  not found"))
+            if len(results) == 2 and results[0] != results[1]:
+                print(f"  {task:<13} results differ")
+
+# ░█▄█░█▀▀░▀█▀░█▀▄░▀█▀░█▀▀░█▀▀
+# ░█░█░█▀▀░░█░░█▀▄░░█░░█░░░▀▀█
+# ░▀░▀░▀▀▀░░▀░░▀░▀░▀▀▀░▀▀▀░▀▀▀
+
+
+def benchmark_metrics(calls = 200000):
+    """ Cost of a span and of a counter, with the metrics disabled and enabled
+    """
+    enabled = metrics.ENABLED
+    try:
+        for state in [False, True]:
+            metrics.enable(state)
+            start = time.perf_counter()
+            for _ in range(calls):
+                with metrics.span("benchmark"):
+                    pass
+            span_cost = (time.perf_counter() - start) / calls
+            start = time.perf_counter()
+            for _ in range(calls):
+                metrics.count("benchmark", 1)
+            count_cost = (time.perf_counter() - start) / calls
+            print(f"{'enabled' if state else 'disabled':<9} span {span_cost * 1e9:7.0f}ns  count {count_cost * 1e9:7.0f}ns")
+    finally:
+        metrics.enable(enabled)
+        metrics.reset()
+
+# ░█▀▀░█▀█░█▀▄░░░▀█▀░█▀█░░░█▀▀░█▀█░█▀▄
+# ░█▀▀░█░█░█░█░░░░█░░█░█░░░█▀▀░█░█░█░█
+# ░▀▀▀░▀░▀░▀▀░░░░░▀░░▀▀▀░░░▀▀▀░▀░▀░▀▀░
+
+
+def start_standin(*arguments: str) -> tuple[subprocess.Popen, str]:
+    """ Run standin_server.py in its own process, so its CPU time is not counted.
+    Returns the process and its base url.
+    """
+    process = subprocess.Popen([sys.executable, "standin_server.py", *arguments], cwd=os.path.dirname(os.path.realpath(__file__)),
+                               stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def use_standin(url: str):
+    """ Point the Youtube classes to the stand-in server, with a throwaway API key cache
+    """
+    ytb_classes.YOUTUBE_URL = ytb_classes.THUMBNAIL_URL = url
+    ytb_classes.API_KEY_CACHE = os.path.join(tempfile.gettempdir(), "standin_api_key.json")
+    ytb_classes.invalidate_api_key()
+    http_client.configure(pool_sizes={"127.0.0.1": 32})
+
+
+def percentile(values: list[float], rank: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * rank))]
+
+
+def get_resources() -> tuple[float, float | None]:
+    """ CPU seconds of this process and its children (ffmpeg), and peak RSS in MB if it can be read
+    """
+    try:
+        import resource
+    except ImportError:
+        return time.process_time(), None
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, KB elsewhere
+    peak = peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    return time.process_time() + children.ru_utime + children.ru_stime, peak
+
+
+def benchmark_end_to_end(videos = 20, downloads = 3, pipeline_videos = 8) -> dict:
+    """ Run the real code paths against the local stand-in server: video resolution, playlist listing,
+    range downloads under latency, bandwidth cap and failures, and the whole pipeline when ffmpeg is available.
+    Returns the metrics, to be compared with a baseline.
+    """
+    results = {}
+    start_cpu, _ = get_resources()
+    process, url = start_standin("--latency", str(STANDIN_LATENCY), "--bandwidth", str(STANDIN_BANDWIDTH),
+                                 "--failure-rate", str(STANDIN_FAILURE_RATE))
+    try:
+        use_standin(url)
+
+        timings = []
+        for index in range(videos):
+            start = time.perf_counter()
+            if not ytb_classes.Video(f"{url}/watch?v=video{index:05d}").get_extraction_url():
+                print(f"Could not resolve video{index:05d}")
+            timings.append(time.perf_counter() - start)
+        results.update({"resolve_p50_ms": percentile(timings, 0.5) * 1000, "resolve_p90_ms": percentile(timings, 0.9) * 1000,
+                        "resolve_p99_ms": percentile(timings, 0.99) * 1000})
+        print(f"resolve     p50 {results['resolve_p50_ms']:.1f}ms  p90 {results['resolve_p90_ms']:.1f}ms  "
+              f"p99 {results['resolve_p99_ms']:.1f}ms  (first one fetches the API key)")
+
+        start = time.perf_counter()
+        count = sum(1 for _ in ytb_classes.Playlist(f"{url}/playlist?list=PLstandin").iter_videos())
+        results["playlist_s"] = time.perf_counter() - start
+        print(f"playlist    {count} videos in {results['playlist_s']:.2f}s")
+
+        video = ytb_classes.Video(f"{url}/watch?v=download")
+        selected_format = video.get_extraction_url()["video"][0]
+        with tempfile.TemporaryDirectory() as folder:
+            sizes, timings, attempts = 0, [], 0
+            for run in range(downloads):
+                filename = os.path.join(folder, f"download{run}.mp4")
+                start = time.perf_counter()
+                # Failed ranges are resumed by running it again, as a user would
+                for _ in range(5):
+                    attempts += 1
+                    if download.download_file(selected_format["url"], filename, display_bar=False, adaptive=True):
+                        break
+                timings.append(time.perf_counter() - start)
+                sizes += os.path.getsize(filename)
+        results["download_mb_s"] = sizes / sum(timings) / 1024 / 1024
+        results["download_attempts"] = attempts / downloads
+        print(f"download    {results['download_mb_s']:.1f} MB/s  {results['download_attempts']:.1f} attempts per file  "
+              f"({STANDIN_BANDWIDTH / 1024 / 1024:.0f} MB/s per connection, {STANDIN_FAILURE_RATE:.0%} failures)")
+    finally:
+        process.kill()
+        process.wait()
+
+    if shutil.which("ffmpeg") or os.path.isfile("ffmpeg.exe"):
+        with tempfile.TemporaryDirectory() as folder:
+            _, audio_path, _ = make_synthetic_media(folder, 30)
+            process, url = start_standin("--latency", str(STANDIN_LATENCY), "--audio", audio_path,
+                                         "--playlist-size", str(pipeline_videos))
+            try:
+                use_standin(url)
+                videos_list = ytb_classes.Playlist(f"{url}/playlist?list=PLpipeline").iter_videos()
+                start = time.perf_counter()
+                jobs = pipeline.download_videos(videos_list, "audio", folder, audio_extension="m4a")
+                elapsed = time.perf_counter() - start
+            finally:
+                process.kill()
+                process.wait()
+        failed = sum(1 for job in jobs if job["error"])
+        results["pipeline_videos_s"] = len(jobs) / elapsed
+        print(f"pipeline    {len(jobs)} videos in {elapsed:.2f}s, {results['pipeline_videos_s']:.2f} videos/s, {failed} failed")
+    else:
+        print("pipeline    skipped, ffmpeg not found")
+
+    cpu, peak = get_resources()
+    results["cpu_s"] = cpu - start_cpu
+    if peak is not None:
+        results["peak_rss_mb"] = peak
+    print(f"resources   cpu {results['cpu_s']:.2f}s" + (f"  peak RSS {peak:.0f} MB" if peak is not None else ""))
+    return results
+
+
+def benchmark_writer(size = WRITER_SIZE) -> dict | None:
+    """ Download a multi-GB stream from the stand-in server with the range workers, in a child process,
+    and report its throughput, CPU time per GB and peak RSS, which must not grow with the file size.
+    It is downloaded again with a sha256 computed as the ranges land, to measure the cost of the verification.
+    """
+    try:
+        import resource
+    except ImportError:
+        print("Skipped, the resource module is not available on this platform")
+        return None
+
+    results = {}
+    gigabytes = size / 1024 / 1024 / 1024
+    process, url = start_standin("--large-size", str(size))
+    try:
+        for name, hash_arguments in [("writer", []), ("writer_sha256", ["sha256"])]:
+            with tempfile.TemporaryDirectory() as folder:
+                child = subprocess.run([sys.executable, "-c", WRITER_CHILD, f"{url}/videoplayback?itag=22", os.path.join(folder, "large.mp4"),
+                                        str(size), *hash_arguments], cwd=os.path.dirname(os.path.realpath(__file__)), capture_output=True, text=True)
+            if child.returncode != 0:
+                print(f"Download failed: {child.stderr.strip()}")
+                return None
+            measures = json.loads(child.stdout.strip().splitlines()[-1])
+            if not measures["ok"]:
+                print("Download incomplete")
+            results.update({f"{name}_mb_s": size / measures["elapsed"] / 1024 / 1024, f"{name}_cpu_s_per_gb": measures["cpu"] / gigabytes,
+                            f"{name}_peak_rss_mb": measures["peak"]})
+            print(f"{name:<14}{gigabytes:.1f} GB at {results[f'{name}_mb_s']:.0f} MB/s  cpu {results[f'{name}_cpu_s_per_gb']:.2f}s per GB  "
+                  f"peak RSS {results[f'{name}_peak_rss_mb']:.0f} MB")
+    finally:
+        process.kill()
+        process.wait()
+    return results
+
+
+def benchmark_tail(size = 1024 * 1024 * 64, runs = 6) -> dict:
+    """ Download a file from the stand-in server when a few range responses crawl, like throttled connections,
+    without then with the hedging of the stalled ranges, and compare the download times.
+    """
+    results = {}
+    process, url = start_standin("--large-size", str(size), "--bandwidth", str(TAIL_BANDWIDTH), "--latency", str(STANDIN_LATENCY),
+                                 "--slow-rate", str(TAIL_SLOW_RATE), "--failure-rate", str(STANDIN_FAILURE_RATE))
+    try:
+        use_standin(url)
+        with tempfile.TemporaryDirectory() as folder:
+            for hedge in [False, True]:
+                timings, hedges, retries = [], 0, 0
+                for run in range(runs):
+                    stats = {}
+                    start = time.perf_counter()
+                    if not download.download_file(f"{url}/videoplayback?itag=22", os.path.join(folder, f"{hedge}{run}.mp4"), display_bar=False,
+                                                  stats=stats, hedge=hedge):
+                        print(f"Download {run} failed")
+                    timings.append(time.perf_counter() - start)
+                    hedges += stats.get("hedges", 0)
+                    retries += stats.get("retries", 0)
+                name = "hedged" if hedge else "unhedged"
+                results.update({f"{name}_p50_s": percentile(timings, 0.5), f"{name}_max_s": max(timings)})
+                print(f"{name:<11} p50 {results[f'{name}_p50_s']:.2f}s  max {results[f'{name}_max_s']:.2f}s  "
+                      f"{hedges / runs:.1f} hedges and {retries / runs:.1f} retries per file")
+    finally:
+        process.kill()
+        process.wait()
+    return results
+
+
+def measure_rate(limiter: bandwidth.BandwidthLimiter, duration: float) -> float:
+    start, transferred = time.monotonic(), limiter.stats()["transferred"]
+    time.sleep(duration)
+    return (limiter.stats()["transferred"] - transferred) / (time.monotonic() - start)
+
+
+def benchmark_bandwidth(rate = BANDWIDTH_RATE, window = 2.0) -> dict:
+    """ Download a large video from the stand-in server under a global cap, and check the achieved rate
+    before and after halving the cap at runtime. A small audio file is downloaded alongside the video,
+    and has to finish about as fast as with half of the cap to itself.
+    """
+    limiter = bandwidth.get_limiter()
+    process, url = start_standin("--large-size", str(rate * 8))
+    try:
+        use_standin(url)
+        with tempfile.TemporaryDirectory() as folder:
+            limiter.set_rate(rate)
+            video = threading.Thread(target=download.download_file, args=(f"{url}/videoplayback?itag=22", os.path.join(folder, "video.mp4")),
+                                     kwargs={"display_bar": False, "adaptive": True})
+            video.start()
+            # Let the adaptive controller open its connections
+            time.sleep(1)
+            full_rate = measure_rate(limiter, window)
+
+            start = time.perf_counter()
+            download.download_file(f"{url}/videoplayback?itag=251", os.path.join(folder, "audio.webm"), display_bar=False, adaptive=True)
+            audio_s = time.perf_counter() - start
+            audio_size = os.path.getsize(os.path.join(folder, "audio.webm"))
+
+            limiter.set_rate(rate // 2)
+            time.sleep(0.5)
+            half_rate = measure_rate(limiter, window)
+
+            # Let the rest go unlimited
+            limiter.set_rate(0)
+            video.join()
+    finally:
+        limiter.set_rate(0)
+        process.kill()
+        process.wait()
+
+    results = {"cap_error_pct": abs(full_rate - rate) / rate * 100, "halved_cap_error_pct": abs(half_rate - rate / 2) / (rate / 2) * 100,
+               "audio_s": audio_s, "audio_fair_s": audio_size / (rate / 2)}
+    print(f"cap         {rate / 1024 / 1024:.0f} MB/s -> {full_rate / 1024 / 1024:.2f} MB/s  ({results['cap_error_pct']:.1f}% off)")
+    print(f"halved cap  {rate / 2 / 1024 / 1024:.0f} MB/s -> {half_rate / 1024 / 1024:.2f} MB/s  ({results['halved_cap_error_pct']:.1f}% off)")
+    print(f"audio       {audio_size / 1024 / 1024:.1f} MB in {audio_s:.2f}s next to the video, "
+          f"{results['audio_fair_s']:.2f}s with half of the cap")
+    return results
+
+
+def compare_baseline(baseline: dict, results: dict):
+    """ Print the change of every metric against the baseline of the same benchmark
+    """
+    for name, value in results.items():
+        if name in baseline and baseline[name]:
+            print(f"  {name:<20} {baseline[name]:10.2f} -> {value:10.2f}  {(value - baseline[name]) / baseline[name]:+.1%}")
+
+# ░█▄█░█▀█░▀█▀░█▀█
+# ░█░█░█▀█░░█░░█░█
+# ░▀░▀░▀░▀░▀▀▀░▀░▀
+
+BENCHMARKS = {
+    "post_processing": benchmark_post_processing,
+    "startup": benchmark_startup,
+    "extraction": benchmark_extraction,
+    "end_to_end": benchmark_end_to_end,
+    "writer": benchmark_writer,
+    "bandwidth": benchmark_bandwidth,
+    "tail": benchmark_tail,
+    "metrics": benchmark_metrics,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmarks.")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run among {', '.join(BENCHMARKS.keys())}, all by default")
+    parser.add_argument("--baseline", help="JSON file of former results to compare with")
+    parser.add_argument("--save", help="JSON file to write the results to, to be used as a baseline later")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    all_results = {}
+    for name in args.names or list(BENCHMARKS.keys()):
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark {name}, choose from {', '.join(BENCHMARKS.keys())}")
+            continue
+        print(f"== {name} ==")
+        results = BENCHMARKS[name]()
+        # Benchmarks returning their metrics can be compared across runs
+        if results:
+            all_results[name] = results
+            if name in baseline:
+                print(f"-- against {args.baseline} --")
+                compare_baseline(baseline[name], results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(all_results, f, indent=2)
@@ -0,0 +1,385 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+import artifact_cache
+import bandwidth
+import http_client
+import metrics
+import pipeline
+import ytb_classes
+
+DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache", "daemon.sqlite")
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Minimum time between two progress writes of a job, in seconds
+PROGRESS_INTERVAL = 1
+
+JOB_COLUMNS = ["id", "parent_id", "url", "media_type", "output_folder", "options", "status", "stage",
+               "downloaded", "total", "output", "error", "timings", "created_at", "started_at", "finished_at"]
+
+# ░▀▀█░█░█░█▀▀░█░█░█▀▀
+# ░░▄▀░█░█░█▀▀░█░█░█▀▀
+# ░░▀░░▀▀▀░▀▀▀░▀▀▀░▀▀▀
+
+
+class JobQueue:
+    """ Download jobs stored in SQLite, so queued and interrupted jobs survive a restart.
+    A job goes from queued to running, then done or failed. Playlists are expanded into one child job per video.
+    """
+    def __init__(self, database: str = DATABASE):
+        self.lock = threading.Lock()
+        self.added = threading.Event()
+
+        os.makedirs(os.path.dirname(database) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, parent_id INTEGER, url TEXT NOT NULL, media_type TEXT NOT NULL,
+            output_folder TEXT NOT NULL, options TEXT NOT NULL, status TEXT NOT NULL, stage TEXT,
+            downloaded INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, output TEXT, error TEXT,
+            timings TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id)")
+
+        # Jobs interrupted by a stop are run again, their downloads resume from the journals
+        self.connection.execute("UPDATE jobs SET status = 'queued', stage = NULL WHERE status = 'running'")
+        self.connection.commit()
+
+    def _execute(self, query: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            self.connection.commit()
+            return cursor
+
+    def add(self, url: str, media_type: str, output_folder: str, options: dict = None, parent_id: int = None) -> int:
+        """ Queue a job. Returns its id.
+        """
+        job_id = self._execute(
+            "INSERT INTO jobs (parent_id, url, media_type, output_folder, options, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+            (parent_id, url, media_type, output_folder, json.dumps(options or {}), time.time())).lastrowid
+        self.added.set()
+        return job_id
+
+    def claim(self) -> dict | None:
+        """ Mark the oldest queued job as running and return it, None if there is none
+        """
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if not row:
+                self.added.clear()
+                return None
+            self.connection.execute("UPDATE jobs SET status = 'running', started_at = ?, downloaded = 0, total = 0 WHERE id = ?",
+                                    (time.time(), row[0]))
+            self.connection.commit()
+        return self._to_dict(row)
+
+    def update(self, job_id: int, **values):
+        """ Set the given columns of a job
+        """
+        self._execute(f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in values)} WHERE id = ?",
+                      (*values.values(), job_id))
+
+    def finish(self, job_id: int, output: str = None, error: str = None, timings: dict = None):
+        self.update(job_id, status="failed" if error else "done", stage=None, output=output, error=error,
+                    timings=json.dumps(timings or {}), finished_at=time.time())
+
+    def get(self, job_id: int) -> dict | None:
+        """ A job with the status counts of its children, if any
+        """
+        with self.lock:
+            row = self.connection.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            children = self.connection.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE parent_id = ? GROUP BY status", (job_id,)).fetchall()
+        if not row:
+            return None
+        job = self._to_dict(row)
+        if children:
+            job["children"] = dict(children)
+        return job
+
+    def count(self) -> dict[str, int]:
+        """ Number of jobs per status
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def list(self, status: str = None, limit = 100) -> list[dict]:
+        """ The most recent jobs, optionally with the given status
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs " + ("WHERE status = ? " if status else "")
+                + "ORDER BY id DESC LIMIT ?", (status, limit) if status else (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _to_dict(row: tuple) -> dict:
+        job = dict(zip(JOB_COLUMNS, row))
+        job["options"] = json.loads(job["options"])
+        job["timings"] = json.loads(job["timings"]) if job["timings"] else {}
+        return job
+
+# ░█▀▄░█▀█░█▀▀░█▄█░█▀█░█▀█
+# ░█░█░█▀█░█▀▀░█░█░█░█░█░█
+# ░▀▀░░▀░▀░▀▀▀░▀░▀░▀▀▀░▀░▀
+
+
+class Daemon:
+    """ Runs the queued jobs through one long-lived pipeline, so the workers, the HTTP session,
+    the API key and the artifact cache stay warm from one job to the next.
+    """
+    def __init__(self, queue: JobQueue, verbose = False, resolve_workers = pipeline.RESOLVE_WORKERS,
+                 transfer_workers = pipeline.TRANSFER_WORKERS, post_process_workers = pipeline.POST_PROCESS_WORKERS):
+        self.queue = queue
+        self.verbose = verbose
+        self.stages = [(name, self._track_stage(name, function), workers) for name, function, workers
+                       in pipeline.get_video_stages(resolve_workers, transfer_workers, post_process_workers)]
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _track_stage(self, name: str, function):
+        """ Record the stage a job enters in the queue
+        """
+        def tracked(job: dict):
+            self.queue.update(job["id"], stage=name)
+            function(job)
+        return tracked
+
+    def _make_job(self, row: dict) -> dict:
+        options = row["options"]
+        os.makedirs(row["output_folder"], exist_ok=True)
+        job = pipeline.make_video_job(ytb_classes.Video(row["url"]), row["media_type"], row["output_folder"], self.verbose,
+                                      options.get("audio_extension", "mp3"), options.get("constraints"),
+                                      options.get("streaming", False),
+                                      artifact_cache.get_cache() if options.get("cache", True) else None,
+                                      options.get("weight", 1.0))
+        job["id"] = row["id"]
+
+        # Progress is kept in memory and written at most every PROGRESS_INTERVAL
+        progress = {"downloaded": 0, "total": 0, "written_at": 0}
+        progress_lock = threading.Lock()
+
+        def on_size(size: int):
+            with progress_lock:
+                progress["total"] += size
+            self.queue.update(row["id"], total=progress["total"])
+
+        def on_progress(size: int):
+            with progress_lock:
+                progress["downloaded"] += size
+                if time.monotonic() - progress["written_at"] < PROGRESS_INTERVAL:
+                    return
+                progress["written_at"] = time.monotonic()
+                downloaded = progress["downloaded"]
+            self.queue.update(row["id"], downloaded=downloaded)
+
+        job["on_size"], job["on_progress"], job["progress"] = on_size, on_progress, progress
+        return job
+
+    def _expand_playlist(self, row: dict):
+        """ Queue one child job per video of a playlist job
+        """
+        try:
+            playlist = ytb_classes.Playlist(row["url"])
+            count = 0
+            for video in playlist.iter_videos():
+                self.queue.add(video.url, row["media_type"], row["output_folder"], row["options"], row["id"])
+                count += 1
+        except Exception as e:
+            logging.exception(f"Could not list {row['url']}")
+            self.queue.finish(row["id"], error=str(e) or type(e).__name__)
+            return
+        self.queue.finish(row["id"], output=f"{count} videos queued")
+
+    def _claim_jobs(self) -> Iterator[dict]:
+        """ Feed the pipeline with the queued jobs until the daemon stops.
+        The pipeline queues being bounded, jobs are only claimed when there is room for them.
+        """
+        while not self.stopping.is_set():
+            row = self.queue.claim()
+            if row is None:
+                self.queue.added.wait(1)
+                continue
+
+            try:
+                ytb_classes.Playlist(row["url"])
+                is_playlist = True
+            except ValueError:
+                is_playlist = False
+
+            if is_playlist:
+                self._expand_playlist(row)
+                continue
+            # A job that cannot be set up fails alone, the pipeline keeps being fed
+            try:
+                job = self._make_job(row)
+            except Exception as e:
+                logging.exception(f"Could not start job {row['id']} {row['url']}")
+                self.queue.finish(row["id"], None, str(e) or type(e).__name__, {})
+                continue
+            yield job
+
+    def _on_job_done(self, job: dict):
+        self.queue.update(job["id"], downloaded=job["progress"]["downloaded"])
+        self.queue.finish(job["id"], job.get("output"), job["error"], job["timings"])
+        if job["error"]:
+            logging.error(f"Job {job['id']} {job['video']} failed at {job['failed_stage']}: {job['error']}")
+        else:
+            logging.info(f"Job {job['id']} {job['output']} - Done{' (cached)' if job.get('cached') else ''}.")
+        if job["trace"] is not None:
+            metrics.write_trace(job["trace"])
+
+    def start(self):
+        # The pipeline runs for the daemon's whole life, the finished jobs are only recorded in the queue
+        self.thread = threading.Thread(target=pipeline.run_pipeline, args=(self._claim_jobs(), self.stages),
+                                       kwargs={"on_job_done": self._on_job_done, "collect": False}, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop claiming jobs and wait for the running ones to finish
+        """
+        self.stopping.set()
+        self.queue.added.set()
+        if self.thread:
+            self.thread.join()
+
+    def stats(self) -> dict:
+        return {"connections": http_client.connection_stats(),
+                "cache_size": artifact_cache.get_cache().total_size(),
+                "bandwidth": bandwidth.get_limiter().stats(),
+                "jobs": self.queue.count()}
+
+# ░█▀█░█▀█░▀█▀
+# ░█▀█░█▀▀░░█░
+# ░▀░▀░▀░░░▀▀▀
+
+
+def make_handler(daemon: Daemon) -> type[BaseHTTPRequestHandler]:
+    """ HTTP API of the daemon:
+    POST /jobs {"url", "media_type", "output_folder", "audio_extension", "constraints", "streaming", "cache", "weight"} queues a job,
+    GET /jobs[?status=] lists the jobs, GET /jobs/<id> returns one, GET /stats the pools and queue state.
+    GET /bandwidth returns the limiter state, POST /bandwidth {"rate": "2M"} changes the cap of the running downloads (0 for none).
+    With the metrics enabled, GET /jobs/<id>/trace returns the trace of a finished job, GET /metrics a Prometheus snapshot.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, status: int, data, content_type = "application/json"):
+            body = data.encode() if isinstance(data, str) else json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            parts = [part for part in path.split("/") if part]
+
+            if parts == ["jobs"]:
+                status = dict(pair.partition("=")[::2] for pair in query.split("&") if pair).get("status")
+                self.send(200, daemon.queue.list(status))
+            elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                job = daemon.queue.get(int(parts[1]))
+                if job:
+                    self.send(200, job)
+                else:
+                    self.send(404, {"error": "Unknown job"})
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "trace":
+                try:
+                    with open(os.path.join(metrics.TRACES_FOLDER, f"{parts[1]}.json"), "r") as f:
+                        self.send(200, json.load(f))
+                except (OSError, ValueError):
+                    self.send(404, {"error": "No trace for this job, are the metrics enabled?"})
+            elif parts == ["bandwidth"]:
+                self.send(200, bandwidth.get_limiter().stats())
+            elif parts == ["stats"]:
+                self.send(200, daemon.stats())
+            elif parts == ["metrics"]:
+                self.send(200, metrics.prometheus_text(), "text/plain; version=0.0.4")
+            else:
+                self.send(404, {"error": "Unknown path"})
+
+        def do_POST(self):
+            path = self.path.rstrip("/")
+            if path == "/bandwidth":
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    bandwidth.get_limiter().set_rate(bandwidth.parse_rate(request["rate"]))
+                except (KeyError, ValueError) as e:
+                    self.send(400, {"error": f"Invalid rate: {e}"})
+                    return
+                self.send(200, bandwidth.get_limiter().stats())
+                return
+            if path != "/jobs":
+                self.send(404, {"error": "Unknown path"})
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                url = request["url"]
+                media_type = request.get("media_type", "audio")
+                if media_type not in ["audio", "video"]:
+                    raise ValueError("media_type must be audio or video")
+                if float(request.get("weight", 1.0)) <= 0:
+                    raise ValueError("weight must be positive")
+                output_folder = os.path.abspath(request.get("output_folder", "."))
+                try:
+                    os.makedirs(output_folder, exist_ok=True)
+                except OSError as e:
+                    raise ValueError(f"output_folder cannot be created: {e}")
+                if not os.access(output_folder, os.W_OK):
+                    raise ValueError("output_folder is not writable")
+            except (KeyError, TypeError, ValueError) as e:
+                self.send(400, {"error": f"Invalid job: {e}"})
+                return
+
+            options = {key: request[key] for key in ["audio_extension", "constraints", "streaming", "cache", "weight"] if key in request}
+            job_id = daemon.queue.add(url, media_type, output_folder, options)
+            self.send(201, {"id": job_id})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+# ░█▄█░█▀█░▀█▀░█▀█
+# ░█░█░█▀█░░█░░█░█
+# ░▀░▀░▀░▀░▀▀▀░▀░▀
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download daemon taking its jobs over a local HTTP API.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--database", default=DATABASE, help="SQLite job queue")
+    parser.add_argument("-j", "--jobs", type=int, default=pipeline.TRANSFER_WORKERS, help="videos transferred at the same time")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the ffmpeg output")
+    parser.add_argument("--metrics", action="store_true", help="record the job traces and serve /metrics")
+    parser.add_argument("--limit-rate", type=bandwidth.parse_rate, default=0, help="bandwidth cap shared by every download, like 500K or 2M")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    metrics.enable(args.metrics)
+    bandwidth.get_limiter().set_rate(args.limit_rate)
+
+    daemon = Daemon(JobQueue(args.database), args.verbose, transfer_workers=args.jobs)
+    daemon.start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(daemon))
+    logging.info(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
@@ -4,7 +4,40 @@
 
 import requests
 import threading
-from tqdm import tqdm
+import logging
+import hashlib
+import json
+import os
+import queue
+import re
+import statistics
+import time
+from collections import deque
+import bandwidth
+import http_client
+import metrics
+
+# Adaptive mode bounds
+MIN_CHUNK_SIZE = 1024 * 256
+MAX_CHUNK_SIZE = 1024 * 1024 * 32
+# Files under that size are fetched with a single streamed GET in adaptive mode
+SMALL_FILE_SIZE = 1024 * 1024 * 2
+# Targeted transfer time of one range on one connection, in seconds
+RANGE_DURATION = 2
+# Upper bound of the receive buffers of one download, whatever the number of workers
+MAX_BUFFER_MEMORY = 1024 * 1024 * 16
+
+# Once every range is handed out, a range running for STALL_AGE seconds below STALL_RATIO times the median
+# range throughput is hedged: the rest of it is requested again on another connection, the first to finish wins
+STALL_AGE = 1.0
+STALL_RATIO = 0.3
+MIN_HEDGE_SIZE = 1024 * 64
+# A hedge can stall as well, a range gets up to MAX_HEDGES of them
+MAX_HEDGES = 2
+# A failed range is retried after RETRY_BACKOFF seconds, doubled on each attempt, and given up after MAX_RANGE_ATTEMPTS
+MAX_RANGE_ATTEMPTS = 5
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 8
 
 # ░█▀▀░█░█░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█░█▀▀
 # ░█▀▀░█░█░█░█░█░░░░█░░░█░░█░█░█░█░▀▀█
@@ -13,56 +46,869 @@ from tqdm import tqdm
 def simple_download(url: str, filename: str):
     """ Simple download using get request. Works better for static small files.
     """
-    response = requests.get(url)
+    response = http_client.get_session().get(url)
     with open(filename, "wb") as file:
         file.write(response.content)
 
-def download_chunk(url: str, start: str, end: str, buffer: str, timeout: int, filename: str):
-    """ Defines the chunk to download
+def fetch_bytes(url: str, timeout = 10) -> bytes:
+    """ Download a small file, like a thumbnail, into memory
     """
-    headers = {'Range': f'bytes={start}-{end}'}
-    response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    response = http_client.get_session().get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
 
-    with open(filename, 'r+b') as f:
-        f.seek(start)
-        for chunk in response.iter_content(chunk_size=buffer):
-            if chunk:
+def stream_download(url: str, filename: str, timeout = 10, buffer_size = 1024 * 64, on_progress=None, weight = 1.0, digest=None) -> int:
+    """ Download a given url with a single streamed GET request, weight being its share of the bandwidth limit.
+    If given, the hashlib digest is updated with every byte.
+    Returns the number of bytes written.
+    """
+    flow = bandwidth.get_limiter().flow(weight)
+    written = 0
+    with http_client.get_session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        with open(filename, "wb") as f:
+            for chunk in response.iter_content(chunk_size=buffer_size):
                 f.write(chunk)
-                if bar:
-                    bar.update()
+                written += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                flow.consume(len(chunk))
+                if on_progress:
+                    on_progress(len(chunk))
+    return written
 
-def download_file(url: str, filename: str, num_threads = 8, chunk_size = 1024 * 1024 * 4, timeout = 10, display_bar = True):
-    """ Download a given url by splitting the download into threads depending on a given chunk_size.
-    Doesn't seem to work for small files < 1 Mo
+def check_range_response(response: requests.Response, start: int, end: int):
+    """ Raise ValueError unless response holds the bytes between start and end (inclusive).
+    A server ignoring the range sends the whole file, only usable for a range starting at 0.
     """
-    if chunk_size % 1024 != 0 or num_threads <= 0:
-        return None
+    check_range_headers(response.status_code, response.headers, start, end)
+
+def check_range_headers(status: int, headers, start: int, end: int):
+    """ Same as check_range_response from the status and the headers of a response, before its body is read
+    """
+    if status != 206:
+        if start != 0:
+            raise ValueError(f"Asked for bytes {start}-{end}, got the whole file (status {status})")
+        return
+    content_range = re.match(r"bytes (\d+)-(\d+)/", headers.get("content-range", ""))
+    if not content_range or (int(content_range.group(1)), int(content_range.group(2))) != (start, end):
+        raise ValueError(f"Asked for bytes {start}-{end}, got {headers.get('content-range')}")
 
-    response = requests.head(url)
+def stream_ranges(url: str, file, chunk_size = 1024 * 1024 * 4, timeout = 10, buffer_size = 1024 * 64, on_progress=None, weight = 1.0,
+                  expected_size: int = None) -> int:
+    """ Download a given url in order, one range after the other, into a writable file object
+    that cannot seek, like the stdin of a process. weight is its share of the bandwidth limit.
+    Each range must deliver its exact length, the rest of a short one is requested again after a backoff.
+    Raises requests.HTTPError if the HEAD of the stream fails, ValueError if a range cannot be completed in MAX_RANGE_ATTEMPTS,
+    or if the stream is not expected_size bytes long.
+    Returns the number of bytes written.
+    """
+    session = http_client.get_session()
+    flow = bandwidth.get_limiter().flow(weight)
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
     total_size = int(response.headers.get('content-length', 0))
+    if expected_size and total_size and total_size != expected_size:
+        raise ValueError(f"The stream is {total_size} bytes long, {expected_size} expected")
+
+    def write(chunk: bytes):
+        file.write(chunk)
+        flow.consume(len(chunk))
+        metrics.count("downloaded_bytes", len(chunk))
+        if on_progress:
+            on_progress(len(chunk))
+
+    # Unknown length, a single GET
+    if not total_size:
+        written = 0
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=buffer_size):
+                write(chunk)
+                written += len(chunk)
+        if expected_size and written != expected_size:
+            raise ValueError(f"The stream is {written} bytes long, {expected_size} expected")
+        return written
+
+    for start in range(0, total_size, chunk_size):
+        end = min(start + chunk_size, total_size) - 1
+        position, attempt = start, 0
+        while position <= end:
+            try:
+                with session.get(url, headers={'Range': f'bytes={position}-{end}'}, stream=True, timeout=timeout) as response:
+                    response.raise_for_status()
+                    check_range_response(response, position, end)
+                    for chunk in response.iter_content(chunk_size=buffer_size):
+                        # Never past the range, whatever the server sends
+                        chunk = chunk[:end + 1 - position]
+                        write(chunk)
+                        position += len(chunk)
+                        if position > end:
+                            break
+            except requests.RequestException as e:
+                logging.warning(f"Could not stream bytes {position}-{end} of {url}, attempt {attempt + 1}: {e}")
+
+            if position <= end:
+                attempt += 1
+                if attempt >= MAX_RANGE_ATTEMPTS:
+                    raise ValueError(f"Bytes {position}-{end} could not be downloaded after {MAX_RANGE_ATTEMPTS} attempts")
+                metrics.count("range_retries")
+                time.sleep(min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** (attempt - 1)))
+    return total_size
+
+def merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """ Merge overlapping or adjacent inclusive (start, end) ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def get_missing_ranges(total_size: int, done: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """ Inclusive (start, end) ranges of a total_size file that are not covered by done
+    """
+    missing = []
+    position = 0
+    for start, end in merge_ranges(done):
+        if start > position:
+            missing.append((position, start - 1))
+        position = max(position, end + 1)
+    if position < total_size:
+        missing.append((position, total_size - 1))
+    return missing
+
+def iter_into(response: requests.Response, buffer: memoryview):
+    """ Read the body of a streamed response into buffer again and again, yielding the filled part each time.
+    Identity bodies go straight from the socket into buffer, without the intermediate bytes objects
+    of iter_content, encoded ones are still decoded by iter_content.
+    """
+    body = getattr(response.raw, "_fp", None)
+    if response.headers.get("content-encoding", "identity") != "identity" or not hasattr(body, "readinto"):
+        yield from response.iter_content(chunk_size=len(buffer))
+        return
+
+    while True:
+        size = body.readinto(buffer)
+        if not size:
+            return
+        yield buffer[:size]
+
+def download_chunk(session: requests.Session, url: str, start: int, end: int, buffer: memoryview, timeout: int, writer: "RangeWriter",
+                   on_progress=None, flow: bandwidth.Flow = None, task: "RangeTask" = None) -> int:
+    """ Download the bytes between start and end (inclusive) at the same offset of the file of writer, through buffer.
+    Every read waits for its turn in flow, when given, and the transfer stops early once task is cancelled.
+    Returns the number of bytes written.
+    """
+    headers = {'Range': f'bytes={start}-{end}'}
+    response = session.get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        response.raise_for_status()
+        check_range_response(response, start, end)
+    except (requests.RequestException, ValueError):
+        response.close()
+        raise
+
+    size = end - start + 1
+    written = 0
+    for chunk in iter_into(response, buffer):
+        # Never past the range, whatever the server sends
+        chunk = chunk[:size - written]
+        writer.write_at(start + written, chunk)
+        written += len(chunk)
+        if flow:
+            flow.consume(len(chunk))
+        if on_progress:
+            on_progress(len(chunk))
+        if written == size or (task is not None and task.cancelled):
+            break
 
+    # The body was read behind the back of urllib3, hand the connection back to the pool ourselves once it is over
+    body = getattr(response.raw, "_fp", None)
+    if body is not None and body.isclosed():
+        response.raw.release_conn()
+    else:
+        response.close()
+    return written
+
+def get_journal_path(filename: str) -> str:
+    """ Path of the sidecar journal recording the completed ranges of filename
+    """
+    return filename + ".journal"
+
+def load_journal(filename: str, total_size: int, validator: str | None) -> list[tuple[int, int]] | None:
+    """ Read the completed ranges of a partial download.
+    Returns None if there is nothing to resume, or if the remote length or validator (ETag) changed.
+    """
+    journal_path = get_journal_path(filename)
+    if not os.path.isfile(journal_path) or not os.path.isfile(filename):
+        return None
+
+    try:
+        with open(journal_path, "r") as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        logging.exception(f"Could not read journal {journal_path}")
+        return None
+
+    if journal.get("size") != total_size or journal.get("validator") != validator or os.path.getsize(filename) != total_size:
+        return None
+
+    return [tuple(done) for done in journal.get("done", [])]
+
+def save_journal(filename: str, total_size: int, validator: str | None, done: list[tuple[int, int]]):
+    """ Atomically replace the journal of filename with the given completed ranges
+    """
+    journal_path = get_journal_path(filename)
+    with open(journal_path + ".tmp", "w") as f:
+        json.dump({"size": total_size, "validator": validator, "done": merge_ranges(done)}, f)
+    os.replace(journal_path + ".tmp", journal_path)
+
+def create_file(filename: str, size: int):
+    """ Create filename, or empty it, at its final size so the ranges can be written at their offsets
+    """
     with open(filename, 'wb') as f:
-        f.truncate(total_size)
+        f.truncate(size)
+
+class RangeTask:
+    """ Range handed to a worker, with its progress for the stall detection.
+    A hedge requests the rest of a stalled range again, from the first byte no copy has written yet,
+    primary being the task it backs up. Together, the copies of a range have written everything before
+    the furthest position among them.
+    """
+    __slots__ = ("start", "end", "attempt", "position", "started_at", "primary", "hedges", "cancelled", "finished", "done")
+
+    def __init__(self, start: int, end: int, attempt = 0, primary: "RangeTask" = None):
+        self.start = start
+        self.end = end
+        self.attempt = attempt
+        # Next byte to write, everything from start is written before it
+        self.position = start
+        self.started_at = time.monotonic()
+        self.primary = primary
+        self.hedges = []
+        self.cancelled = False
+        # This request ended, and for a primary, its whole range is settled
+        self.finished = False
+        self.done = False
+
+
+class RangeScheduler:
+    """ Work queue handing out the missing ranges of a file to the download workers, chunk_size bytes at a time.
+    The chunk size and the targeted number of workers can be changed while the download runs.
+    The threaded workers also get the retries of the failed ranges and the hedges of the stalled ones through next_task.
+    """
+    def __init__(self, missing_ranges: list[tuple[int, int]], chunk_size: int, num_threads: int):
+        self.gaps = list(missing_ranges)
+        self.chunk_size = chunk_size
+        self.target_workers = num_threads
+        self.workers = 0
+        self.peak_workers = 0
+        self.downloaded = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+        # (due time, start, end, attempt) of the failed ranges waiting for their backoff
+        self.retries = []
+        # Ranges given up after MAX_RANGE_ATTEMPTS, no new range is handed out once there is one
+        self.failed = []
+        self.hedges = []
+        self.active = set()
+        self.retried = 0
+        self.hedged = 0
+        # Throughput of the last completed ranges, the reference of the stall detection
+        self.throughputs = deque(maxlen=32)
+
+    @staticmethod
+    def _copies(primary: RangeTask) -> list[RangeTask]:
+        return [primary, *primary.hedges]
+
+    @staticmethod
+    def _covered(primary: RangeTask) -> int:
+        """ First byte of the range of primary that no copy has written yet
+        """
+        return max(copy.position for copy in RangeScheduler._copies(primary))
+
+    def add_worker(self) -> bool:
+        """ Reserve a slot for a new worker if there are fewer than targeted and ranges are left.
+        Hedges get a worker beyond the target, as the tail is often down to a single worker.
+        """
+        with self.lock:
+            if self.workers >= self.target_workers + len(self.hedges) or not (self.gaps or self.retries or self.hedges) or self.failed:
+                return False
+            self.workers += 1
+            self.peak_workers = max(self.peak_workers, self.workers)
+            return True
+
+    def next_range(self) -> tuple[int, int] | None:
+        """ Returns the next range to download, or None if the calling worker has to stop,
+        either because every range is handed out or because there are too many workers.
+        """
+        with self.lock:
+            if self.workers > self.target_workers or not self.gaps:
+                self.workers -= 1
+                return None
+
+            start, end = self.gaps[0]
+            range_end = min(start + self.chunk_size - 1, end)
+            if range_end == end:
+                self.gaps.pop(0)
+            else:
+                self.gaps[0] = (range_end + 1, end)
+            return start, range_end
+
+    def next_task(self) -> RangeTask | None:
+        """ Like next_range, with the hedges first, then the retries whose backoff is over, then the new ranges.
+        Waits while the only ranges left are retries in backoff.
+        """
+        with self.condition:
+            while True:
+                task = self._poll_task()
+                if not isinstance(task, float):
+                    return task
+                self.condition.wait(task)
+
+    def poll_task(self) -> RangeTask | float | None:
+        """ next_task without waiting, for the workers of an event loop: returns the seconds to wait
+        instead when the only ranges left are retries in backoff.
+        """
+        with self.lock:
+            return self._poll_task()
+
+    def _poll_task(self) -> RangeTask | float | None:
+        now = time.monotonic()
+        due = [retry for retry in self.retries if retry[0] <= now]
+        if self.hedges:
+            task = self.hedges.pop(0)
+            task.started_at = now
+        elif self.workers > self.target_workers or self.failed:
+            self.workers -= 1
+            return None
+        elif due:
+            retry = min(due)
+            self.retries.remove(retry)
+            task = RangeTask(retry[1], retry[2], retry[3])
+        elif self.gaps:
+            start, end = self.gaps[0]
+            range_end = min(start + self.chunk_size - 1, end)
+            if range_end == end:
+                self.gaps.pop(0)
+            else:
+                self.gaps[0] = (range_end + 1, end)
+            task = RangeTask(start, range_end)
+        elif self.retries:
+            return min(retry[0] for retry in self.retries) - now
+        else:
+            self.workers -= 1
+            return None
+
+        self.active.add(task)
+        return task
+
+    def advance(self, task: RangeTask, size: int) -> int:
+        """ Record size more bytes written by task.
+        Returns how many of them are new, as a range and its hedge write the same bytes.
+        """
+        with self.lock:
+            covered = self._covered(task.primary or task)
+            task.position += size
+            return max(0, task.position - covered)
+
+    def complete(self, task: RangeTask) -> tuple[int, int] | None:
+        """ Settle the range of a task that wrote every byte, cancelling the other copies if it was hedged.
+        Returns the (start, end) range now complete, None if another copy already completed it.
+        """
+        with self.lock:
+            task.finished = True
+            self.active.discard(task)
+            primary = task.primary or task
+            if primary.done:
+                return None
+            primary.done = True
+            for copy in self._copies(primary):
+                if not copy.finished:
+                    copy.cancelled = True
+                    # A hedge no worker took yet is dropped
+                    if copy in self.hedges:
+                        self.hedges.remove(copy)
+                        copy.finished = True
+            if task is not primary:
+                metrics.count("hedge_wins")
+            self.throughputs.append((task.end - task.start + 1) / max(time.monotonic() - task.started_at, 1e-6))
+            return primary.start, primary.end
+
+    def fail(self, task: RangeTask) -> tuple[int, int] | None:
+        """ Settle a task that stopped before its end. Unless another copy still runs, the rest of the range
+        is retried after a backoff, or given up after MAX_RANGE_ATTEMPTS.
+        Returns the (start, end) part of the range written so far, to be recorded, if any.
+        """
+        with self.condition:
+            task.finished = True
+            self.active.discard(task)
+            primary = task.primary or task
+            if primary.done or not all(copy.finished for copy in self._copies(primary)):
+                return None
+
+            primary.done = True
+            covered = self._covered(primary)
+            if covered > primary.end:
+                return primary.start, primary.end
+
+            attempt = primary.attempt + 1
+            if attempt >= MAX_RANGE_ATTEMPTS:
+                self.failed.append((covered, primary.end))
+            else:
+                metrics.count("range_retries")
+                self.retried += 1
+                self.retries.append((time.monotonic() + min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** (attempt - 1)),
+                                     covered, primary.end, attempt))
+            self.condition.notify_all()
+            return (primary.start, covered - 1) if covered > primary.start else None
+
+    def hedge_stalled(self) -> int:
+        """ Hedge the ranges whose latest copy runs far below the median throughput, once every range is handed out,
+        as a slow range then holds up the whole file.
+        Returns the number of new hedges.
+        """
+        with self.condition:
+            if self.gaps or self.failed:
+                return 0
+            now = time.monotonic()
+            latest = {}
+            for task in self.active:
+                primary = task.primary or task
+                if not primary.done and len(primary.hedges) < MAX_HEDGES and now - task.started_at >= STALL_AGE:
+                    latest[id(primary)] = max(latest.get(id(primary), task), task, key=lambda copy: copy.started_at)
+            # A range with a copy running for less than STALL_AGE, like a fresh hedge, is left alone
+            running = [task for task in latest.values()
+                       if all(now - copy.started_at >= STALL_AGE for copy in self._copies(task.primary or task) if not copy.finished)]
+            samples = list(self.throughputs) + [(task.position - task.start) / (now - task.started_at) for task in running]
+            if not samples:
+                return 0
+
+            median = statistics.median(samples)
+            hedged = 0
+            for task in running:
+                primary = task.primary or task
+                covered = self._covered(primary)
+                if primary.end - covered + 1 >= MIN_HEDGE_SIZE and (task.position - task.start) / (now - task.started_at) < median * STALL_RATIO:
+                    hedge = RangeTask(covered, primary.end, primary.attempt, primary)
+                    primary.hedges.append(hedge)
+                    self.hedges.append(hedge)
+                    hedged += 1
+            if hedged:
+                self.hedged += hedged
+                metrics.count("range_hedges", hedged)
+                self.condition.notify_all()
+            return hedged
+
+    def remaining(self) -> int:
+        """ Number of bytes not handed out yet
+        """
+        with self.lock:
+            return sum(end - start + 1 for start, end in self.gaps)
 
-    chunk_ranges = [(i*chunk_size, (i+1)*chunk_size-1) for i in range(num_threads)]
-    chunk_ranges[-1] = (chunk_ranges[-1][0], total_size-1)
+    def add_bytes(self, size: int):
+        with self.lock:
+            self.downloaded += size
+
+
+class RangeWriter:
+    """ Single descriptor of the output file, shared by every worker and written (or read back) at explicit offsets.
+    os.pwrite does not move a shared position so the workers never wait for each other,
+    where it is missing (Windows) a lock keeps each seek and its write together.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        self.lock = None if hasattr(os, "pwrite") and hasattr(os, "preadv") else threading.Lock()
+
+    def write_at(self, offset: int, data):
+        data = memoryview(data)
+        while data:
+            if self.lock is None:
+                written = os.pwrite(self.fd, data, offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, data)
+            data = data[written:]
+            offset += written
+
+    def read_at(self, offset: int, buffer: memoryview) -> int:
+        """ Read into buffer from offset, returns the number of bytes read
+        """
+        if self.lock is None:
+            return os.preadv(self.fd, [buffer], offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            data = os.read(self.fd, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def size(self) -> int:
+        return os.fstat(self.fd).st_size
+
+    def close(self):
+        os.close(self.fd)
+
+
+class BufferPool:
+    """ Receive buffers lent to the workers one range at a time, allocated on first need and reused afterwards.
+    The memory in flight never exceeds max_memory (or a single buffer), and the steady state allocates nothing.
+    """
+    def __init__(self, buffer_size: int, max_memory = MAX_BUFFER_MEMORY):
+        self.buffer_size = buffer_size
+        self.buffers = queue.SimpleQueue()
+        self.available = max(1, max_memory // buffer_size)
+        self.lock = threading.Lock()
+
+    def acquire(self) -> memoryview:
+        """ A free buffer, a new one while under the cap, otherwise wait for one
+        """
+        try:
+            return self.buffers.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            allocate = self.available > 0
+            self.available -= allocate
+        return memoryview(bytearray(self.buffer_size)) if allocate else self.buffers.get()
+
+    def release(self, buffer: memoryview):
+        self.buffers.put(buffer)
+
+
+class RangeHasher:
+    """ Hash of a file downloaded by ranges, fed in file order as soon as the completed ranges join the hashed part.
+    They are read back while still in the page cache, during the download, so there is no extra pass over the file at the end.
+    """
+    def __init__(self, writer: RangeWriter, algorithm = "sha256", buffer_size = 1024 * 1024):
+        self.writer = writer
+        self.digest = hashlib.new(algorithm)
+        # Every byte before position is hashed
+        self.position = 0
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.lock = threading.Lock()
+        # Set when the completed ranges cannot be read back, there is no digest then
+        self.broken = False
+
+    def update(self, done: list[tuple[int, int]]):
+        """ Hash the completed bytes that follow the hashed part
+        """
+        with self.lock:
+            end = next((end for start, end in merge_ranges(done) if start <= self.position <= end), None)
+            while not self.broken and end is not None and self.position <= end:
+                try:
+                    size = self.writer.read_at(self.position, self.buffer[:min(len(self.buffer), end + 1 - self.position)])
+                except OSError:
+                    logging.exception(f"Could not read back {self.writer.filename} to hash it")
+                    size = 0
+                if not size:
+                    logging.error(f"{self.writer.filename} ends at {self.position}, before its completed ranges")
+                    self.broken = True
+                    return
+                self.digest.update(self.buffer[:size])
+                self.position += size
+
+    def hexdigest(self) -> str | None:
+        return None if self.broken else self.digest.hexdigest()
+
+
+class ThroughputController:
+    """ Grows the number of workers while the aggregate throughput keeps improving, shrinks it when it drops,
+    and sizes the ranges so one takes about RANGE_DURATION seconds on one connection.
+    """
+    def __init__(self, scheduler: RangeScheduler, max_threads: int):
+        self.scheduler = scheduler
+        self.max_threads = max_threads
+        self.best_throughput = 0
+        self.throughput = 0
+        self.converged = False
+        self.last_bytes = 0
+        self.last_time = time.monotonic()
+        # Every range size chosen, in order
+        self.chunk_sizes = [scheduler.chunk_size]
+
+    def update(self):
+        now = time.monotonic()
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return
+
+        scheduler = self.scheduler
+        downloaded = scheduler.downloaded
+        # smooth the measure, as a single interval is noisy
+        throughput = (downloaded - self.last_bytes) / elapsed
+        self.throughput = throughput if not self.throughput else 0.5 * self.throughput + 0.5 * throughput
+        self.last_bytes, self.last_time = downloaded, now
+
+        # Keep at least two ranges per worker until the end, so the last ones do not drag alone
+        per_connection = self.throughput / max(scheduler.workers, 1)
+        chunk_size = min(int(per_connection * RANGE_DURATION), scheduler.remaining() // (2 * max(scheduler.target_workers, 1)))
+        scheduler.chunk_size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, chunk_size // (1024 * 64) * (1024 * 64)))
+        if scheduler.chunk_size != self.chunk_sizes[-1]:
+            self.chunk_sizes.append(scheduler.chunk_size)
+
+        # Double the workers while the throughput keeps improving, then adjust them one by one
+        if self.throughput > self.best_throughput * 1.1:
+            growth = scheduler.target_workers if not self.converged else 1
+            self.best_throughput = self.throughput
+            scheduler.target_workers = min(self.max_threads, scheduler.target_workers + growth)
+        elif self.throughput < self.best_throughput * 0.7 and scheduler.target_workers > 1:
+            self.converged = True
+            scheduler.target_workers -= 1
+        else:
+            self.converged = True
+
+
+def download_worker(url: str, scheduler: RangeScheduler, pool: BufferPool, timeout: int, writer: RangeWriter, on_progress=None, on_done=None,
+                    flow: bandwidth.Flow = None):
+    """ Pull ranges from the scheduler until it tells the worker to stop, reusing the pooled connections.
+    A buffer is borrowed from pool for each range, so extra workers wait instead of growing the memory.
+    Every worker of a file shares its flow, so the file gets the same share of the bandwidth limit whatever its connections.
+    on_done is called with each (start, end) range once it is fully written, and with the written part of the failed ones.
+    """
+    session = http_client.get_session()
+    while True:
+        task = scheduler.next_task()
+        if task is None:
+            return
+
+        def on_written(size: int):
+            new_bytes = scheduler.advance(task, size)
+            if new_bytes and on_progress:
+                on_progress(new_bytes)
+
+        buffer = pool.acquire()
+        try:
+            with metrics.span("range", hedge=str(task.primary is not None).lower()):
+                written = download_chunk(session, url, task.start, task.end, buffer, timeout, writer, on_written, flow, task)
+            completed = written == task.end - task.start + 1
+        # Whatever the error, the range goes back to the scheduler instead of leaving a hole
+        except Exception as e:
+            completed = False
+            if not task.cancelled:
+                metrics.count("range_failures")
+                logging.warning(f"Could not download range {task.start}-{task.end} of {writer.filename}, attempt {task.attempt + 1}: {e}")
+        finally:
+            pool.release(buffer)
+
+        chunk_range = scheduler.complete(task) if completed else scheduler.fail(task)
+        if chunk_range and on_done:
+            on_done(chunk_range)
+
+@metrics.timed("download_file")
+def download_file(url: str, filename: str, num_threads = 8, chunk_size = 1024 * 1024 * 4, timeout = 10, display_bar = True, buffer_size = 1024 * 64,
+                  adaptive = False, max_threads = 16, stats: dict = None, on_progress=None, on_size=None, max_memory = MAX_BUFFER_MEMORY,
+                  weight = 1.0, hedge = True, expected_size: int = None, hash_algorithm: str = None, expected_hash: str = None) -> bool:
+    """ Download a given url by splitting it into ranges of chunk_size bytes.
+    The ranges are handed out by a shared scheduler that num_threads workers pull from until it is empty,
+    so every connection stays busy until the end of the file.
+    Completed ranges are recorded in a sidecar journal, so an interrupted download resumes
+    with the missing ranges only, unless the remote length or ETag changed.
+
+    In adaptive mode, num_threads and chunk_size are only starting values: the number of workers
+    (up to max_threads) and the range size follow the measured throughput, and small files are
+    fetched with a single streamed GET.
+    If given, stats is filled with the chosen parameters and the achieved throughput in bytes per second,
+    chunk_size being the last range size and chunk_sizes every one chosen on the way.
+    on_size is called with the content length once it is known, on_progress with every written byte count.
+    Every worker writes through one shared descriptor, and reads into buffer_size buffers
+    taken from a pool of at most max_memory bytes.
+    Under a bandwidth limit, the file gets a share of the rate proportional to weight among the active transfers.
+    Failed ranges are retried with a backoff, and with hedge, the stalled ranges of the tail are requested
+    again on another connection, the first copy to finish wins.
+
+    A range only counts once exactly its bytes are written, and the ranges missing at the end are fetched again.
+    The file must end up expected_size bytes long, like the contentLength of the player response, when given.
+    With hash_algorithm (like sha256), the file is hashed as the ranges land, the digest goes to stats["hash"]
+    and has to match expected_hash, when given.
+    Returns True once every range is written and checked, False otherwise.
+    """
+    if chunk_size % 1024 != 0 or num_threads <= 0:
+        return False
+
+    try:
+        response = http_client.get_session().head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.error(f"Cannot download {filename}: {e}")
+        return False
+    total_size = int(response.headers.get('content-length', 0))
+    validator = response.headers.get('etag') or response.headers.get('last-modified')
+    if expected_size and total_size and total_size != expected_size:
+        logging.error(f"Cannot download {filename}, the server announces {total_size} bytes instead of {expected_size}")
+        return False
 
-    global bar
     if display_bar:
-        bar = tqdm(total = (total_size // chunk_size + 1), desc="Downloading file", colour="yellow")
+        from tqdm import tqdm
+        bar = tqdm(total=total_size, desc="Downloading file", colour="yellow", unit="B", unit_scale=True)
     else:
         bar = None
+    if on_size:
+        on_size(total_size)
+
+    # Called by every worker, the bar and on_progress are not thread-safe
+    progress_lock = threading.Lock()
+
+    def report(size: int, metric = "downloaded_bytes"):
+        metrics.count(metric, size)
+        with progress_lock:
+            if bar is not None:
+                bar.update(size)
+            if on_progress:
+                on_progress(size)
+
+    start_time = time.monotonic()
+
+    # Unknown length, or not worth splitting
+    if total_size == 0 or (adaptive and total_size < SMALL_FILE_SIZE):
+        digest = hashlib.new(hash_algorithm) if hash_algorithm else None
+        try:
+            written = stream_download(url, filename, timeout, buffer_size, report, weight, digest)
+        except (requests.RequestException, OSError):
+            logging.exception(f"Could not download {filename}")
+            written = -1
+        if bar is not None:
+            bar.close()
+        if stats is not None:
+            stats.update({"mode": "single", "threads": 1, "chunk_size": total_size, "chunk_sizes": [total_size], "size": written,
+                          "elapsed": time.monotonic() - start_time,
+                          "throughput": written / max(time.monotonic() - start_time, 1e-6)})
+        if written < 0:
+            return False
+        if written != (expected_size or total_size or written):
+            logging.error(f"Download of {filename} is truncated, {written} bytes instead of {expected_size or total_size}")
+            return False
+        return digest is None or check_hash(filename, digest.hexdigest(), hash_algorithm, expected_hash, stats)
+
+    done = load_journal(filename, total_size, validator)
+    if done is None:
+        done = []
+        create_file(filename, total_size)
+        save_journal(filename, total_size, validator, done)
+    else:
+        logging.info(f"Resuming {filename}, {len(done)} ranges already downloaded")
+
+    missing_ranges = get_missing_ranges(total_size, done)
+    missing_size = sum(end - start + 1 for start, end in missing_ranges)
+    # Already on disk, the progress starts from them but they are not downloaded again
+    report(total_size - missing_size, "resumed_bytes")
+
+    if adaptive:
+        scheduler = RangeScheduler(missing_ranges, MIN_CHUNK_SIZE * 4, min(4, num_threads))
+        controller = ThroughputController(scheduler, max_threads)
+    else:
+        scheduler = RangeScheduler(missing_ranges, chunk_size, num_threads)
+        controller = None
+
+    journal_lock = threading.Lock()
+
+    def on_done(chunk_range: tuple[int, int]):
+        with journal_lock:
+            done.append(chunk_range)
+            save_journal(filename, total_size, validator, done)
 
-    threads = []
-    for idx, (start, end) in enumerate(chunk_ranges):
-        thread = threading.Thread(target=download_chunk, args=(url, start, end, chunk_size, timeout, filename))
-        thread.start()
-        threads.append(thread)
+    def on_written(size: int):
+        scheduler.add_bytes(size)
+        report(size)
 
-    # Wait for all threads to end
-    thread: threading.Thread
-    for thread in threads:
-        thread.join()
+    pool = BufferPool(buffer_size, max_memory)
+    writer = RangeWriter(filename)
+    flow = bandwidth.get_limiter().flow(weight)
+    hasher = RangeHasher(writer, hash_algorithm) if hash_algorithm else None
+
+    def run_workers(range_scheduler: RangeScheduler, range_controller: ThroughputController = None):
+        threads = []
+        while True:
+            while range_scheduler.add_worker():
+                thread = threading.Thread(target=metrics.bind(download_worker),
+                                          args=(url, range_scheduler, pool, timeout, writer, on_written, on_done, flow))
+                thread.start()
+                threads.append(thread)
+
+            # Wait for all threads to end, adapting the workers and hashing the landed ranges on the way
+            threads = [thread for thread in threads if thread.is_alive()]
+            if not threads:
+                return
+            threads[0].join(0.5)
+            if range_controller:
+                range_controller.update()
+            if hedge:
+                range_scheduler.hedge_stalled()
+            if hasher is not None:
+                with journal_lock:
+                    completed = list(done)
+                hasher.update(completed)
+
+    run_workers(scheduler, controller)
+
+    # Only the ranges the journal does not account for are fetched again, like the one of a worker that died
+    missing_ranges = get_missing_ranges(total_size, done)
+    if missing_ranges and not scheduler.failed:
+        logging.warning(f"{len(missing_ranges)} ranges of {filename} were not written, fetching them again")
+        metrics.count("range_refetches", len(missing_ranges))
+        refetch_scheduler = RangeScheduler(missing_ranges, chunk_size, num_threads)
+        run_workers(refetch_scheduler)
+        scheduler.failed += refetch_scheduler.failed
+        missing_ranges = get_missing_ranges(total_size, done)
+
+    size_on_disk = writer.size()
+    if hasher is not None and not missing_ranges:
+        hasher.update(done)
+    # Only once every worker is gone, a closed descriptor number could be reused by another file
+    writer.close()
 
     if bar:
         bar.close()
+
+    if stats is not None:
+        elapsed = time.monotonic() - start_time
+        stats.update({"mode": "adaptive" if adaptive else "fixed",
+                      "threads": scheduler.peak_workers,
+                      "chunk_size": scheduler.chunk_size, "chunk_sizes": controller.chunk_sizes if controller else [chunk_size],
+                      "size": scheduler.downloaded,
+                      "retries": scheduler.retried, "hedges": scheduler.hedged,
+                      "elapsed": elapsed, "throughput": scheduler.downloaded / max(elapsed, 1e-6)})
+
+    return check_download(filename, total_size, scheduler.failed, missing_ranges, size_on_disk, hasher, expected_hash, stats)
+
+
+def check_hash(filename: str, hexdigest: str, hash_algorithm: str, expected_hash: str = None, stats: dict = None) -> bool:
+    """ Record the digest of a downloaded file into stats, and compare it with expected_hash, when given
+    """
+    if stats is not None:
+        stats["hash"] = hexdigest
+    if expected_hash and hexdigest != expected_hash.lower():
+        logging.error(f"Download of {filename} is corrupted, its {hash_algorithm} is {hexdigest} instead of {expected_hash}")
+        return False
+    return True
+
+
+def check_download(filename: str, total_size: int, failed: list[tuple[int, int]], missing_ranges: list[tuple[int, int]],
+                   size_on_disk: int, hasher: RangeHasher = None, expected_hash: str = None, stats: dict = None) -> bool:
+    """ Final checks of a download by ranges, once its workers are gone.
+    The journal is kept while the missing ranges can be resumed, and removed otherwise.
+    Returns True if every range is written, the file has its length and, with a hasher, the expected digest.
+    """
+    if failed:
+        logging.error(f"Download of {filename} failed, ranges {', '.join(f'{start}-{end}' for start, end in failed)} "
+                      f"could not be downloaded after {MAX_RANGE_ATTEMPTS} attempts")
+        return False
+
+    # Keep the journal around to resume the missing ranges on the next call
+    if missing_ranges:
+        logging.error(f"Download of {filename} is incomplete, run it again to resume")
+        return False
+
+    # A file of the wrong length or content is not worth resuming, the next call starts over
+    os.remove(get_journal_path(filename))
+    if size_on_disk != total_size:
+        logging.error(f"Download of {filename} is {size_on_disk} bytes long instead of {total_size}")
+        return False
+    if hasher is None:
+        return True
+    return hasher.hexdigest() is not None and check_hash(filename, hasher.hexdigest(), hasher.digest.name, expected_hash, stats)
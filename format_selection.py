@@ -0,0 +1,69 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+# Codecs that can be copied as is into each output container, matched on the start of the codec string
+COMPATIBLE_CODECS = {
+    "mp4": ["avc1", "hev1", "hvc1", "av01", "mp4a"],
+    "m4a": ["mp4a"],
+    "mp3": ["mp3", "mp4a.40.34", "mp4a.6b"],
+}
+
+# ░█▀▀░█░█░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█░█▀▀
+# ░█▀▀░█░█░█░█░█░░░░█░░░█░░█░█░█░█░▀▀█
+# ░▀░░░▀▀▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀▀▀░▀░▀░▀▀▀
+
+
+def is_compatible(codec: str | None, extension: str) -> bool:
+    """ Whether a stream with the given codec can be copied into an extension file without re-encoding
+    """
+    return codec is not None and any(codec.startswith(compatible) for compatible in COMPATIBLE_CODECS.get(extension, []))
+
+
+def get_codec(format: dict) -> str | None:
+    return format["codecs"][0] if format.get("codecs") else None
+
+
+def score_format(format: dict, media_type: str, extension: str, preferred_codec: str = None) -> tuple:
+    """ Sorting key of a format, the highest is the best.
+    Videos never lose resolution for compatibility, but a stream that can be copied beats a higher bitrate
+    at the same height. Audio streams that can be copied beat any bitrate.
+    """
+    codec = get_codec(format) or ""
+    preferred = preferred_codec is not None and codec.startswith(preferred_codec)
+    compatible = is_compatible(codec, extension)
+
+    if media_type == "video":
+        return (preferred, format.get("height", 0), compatible, format["bitrate"])
+    return (preferred, compatible, format["bitrate"])
+
+
+def sort_formats(formats: list[dict], media_type: str, extension: str, max_height: int = None, max_filesize: int = None,
+                 preferred_codec: str = None) -> list[dict]:
+    """ Formats matching the constraints, from the best to the worst for the output extension
+    Args:
+        formats: the formats of one media type, as returned by Video.get_extraction_url
+        media_type: either "audio" or "video"
+        extension: the output extension, like "mp3", "m4a" or "mp4"
+        max_height: the maximum video height, if any
+        max_filesize: the maximum stream size in bytes, if any. Formats of unknown size are kept
+        preferred_codec: the start of a codec to prefer over anything else, like "avc1" or "opus"
+
+    Returns:
+        the sorted formats
+    """
+    if max_height:
+        formats = [format for format in formats if format.get("height", 0) <= max_height]
+    if max_filesize:
+        formats = [format for format in formats if format.get("filesize", 0) <= max_filesize]
+    return sorted(formats, key=lambda format: score_format(format, media_type, extension, preferred_codec), reverse=True)
+
+
+def select_format(formats: dict, media_type: str, extension: str, max_height: int = None, max_filesize: int = None,
+                  preferred_codec: str = None) -> dict | None:
+    """ Best format of the given type for the output extension, or the best of any type if there is none.
+    Returns None if no format matches the constraints.
+    """
+    usable_formats = formats[media_type] if formats[media_type] else formats["audio"] + formats["video"]
+    usable_formats = sort_formats(usable_formats, media_type, extension, max_height, max_filesize, preferred_codec)
+    return usable_formats[0] if usable_formats else None
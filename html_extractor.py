@@ -0,0 +1,51 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import json
+import re
+from typing import Iterable
+
+API_KEY_PATTERN = re.compile(rb'"INNERTUBE_API_KEY":"([^"]+)"')
+
+# Bytes kept from one chunk to the next, so a match split between two chunks is still found
+OVERLAP = 1024
+
+# var ytInitialData = {...}; or window["ytInitialData"] = {...};
+INITIAL_DATA_MARKER = re.compile(r'ytInitialData"?\]?\s*=\s*')
+
+_decoder = json.JSONDecoder()
+
+# ░█▀▀░█░█░▀█▀░█▀▄░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█
+# ░█▀▀░▄▀▄░░█░░█▀▄░█▀█░█░░░░█░░░█░░█░█░█░█
+# ░▀▀▀░▀░▀░░▀░░▀░▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀▀▀░▀░▀
+
+
+def search_chunks(chunks: Iterable[bytes], pattern: re.Pattern = API_KEY_PATTERN, overlap = OVERLAP) -> bytes | None:
+    """ Search the first group of pattern in a stream of bytes, as the chunks arrive.
+    Stops reading at the first match, so the rest of the page is never downloaded nor parsed.
+    Returns None if the stream ends without a match.
+    """
+    buffer = b""
+    for chunk in chunks:
+        buffer = buffer[-overlap:] + chunk
+        match = pattern.search(buffer)
+        if match:
+            return match.group(1)
+    return None
+
+
+def extract_json(html: str, marker: re.Pattern = INITIAL_DATA_MARKER) -> dict | None:
+    """ Decode the single JSON object assigned after marker, like ytInitialData.
+    The decoder stops at the end of the object, instead of a regex looking for it over the whole page.
+    Returns None if the marker is missing or not followed by valid JSON.
+    """
+    match = marker.search(html)
+    if not match:
+        return None
+
+    try:
+        data, _ = _decoder.raw_decode(html, match.end())
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
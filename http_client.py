@@ -0,0 +1,109 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager
+
+# Number of keep-alive connections kept per host, matched on the end of the host name
+POOL_SIZES = {
+    "www.youtube.com": 4,
+    "i.ytimg.com": 4,
+    "googlevideo.com": 32,
+}
+DEFAULT_POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
+
+# ░█▀█░█▀█░█▀█░█░░
+# ░█▀▀░█░█░█░█░█░░
+# ░▀░░░▀▀▀░▀▀▀░▀▀▀
+
+
+def get_pool_size(host: str) -> int:
+    """ Number of connections to keep alive for the given host
+    """
+    for suffix, size in POOL_SIZES.items():
+        if host == suffix or host.endswith("." + suffix):
+            return size
+    return DEFAULT_POOL_SIZE
+
+
+class HostPoolManager(PoolManager):
+    """ Pool manager sizing each host pool with get_pool_size,
+    and keeping track of every pool for the connection reuse counters.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_pools = []
+
+    def connection_from_host(self, host, port=None, scheme="http", pool_kwargs=None):
+        pool_kwargs = dict(pool_kwargs or {})
+        pool_kwargs.setdefault("maxsize", get_pool_size(host or ""))
+        return super().connection_from_host(host, port, scheme, pool_kwargs)
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        self.created_pools.append(pool)
+        return pool
+
+
+class HostPoolAdapter(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = HostPoolManager(num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs)
+
+# ░█▀▀░█░█░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█░█▀▀
+# ░█▀▀░█░█░█░█░█░░░░█░░░█░░█░█░█░█░▀▀█
+# ░▀░░░▀▀▀░▀░▀░▀▀▀░░▀░░▀▀▀░▀▀▀░▀░▀░▀▀▀
+
+
+def get_session() -> requests.Session:
+    """ The process-wide session, keeping connections alive for every module
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HostPoolAdapter(pool_connections=64)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def configure(pool_sizes: dict = None, default_pool_size: int = None):
+    """ Change the per host pool sizes. The current session is closed, the next call to get_session opens a new one.
+    """
+    global _session, DEFAULT_POOL_SIZE
+    if pool_sizes:
+        POOL_SIZES.update(pool_sizes)
+    if default_pool_size:
+        DEFAULT_POOL_SIZE = default_pool_size
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def connection_stats() -> dict[str, dict]:
+    """ Number of connections opened and requests sent per host since the session started.
+    Requests above connections are the handshakes saved by keep-alive.
+    """
+    stats = {}
+    with _session_lock:
+        if _session is None:
+            return stats
+        pools = [pool for adapter in set(_session.adapters.values())
+                 if isinstance(adapter, HostPoolAdapter) for pool in adapter.poolmanager.created_pools]
+
+    for pool in pools:
+        host_stats = stats.setdefault(pool.host, {"connections": 0, "requests": 0})
+        host_stats["connections"] += pool.num_connections
+        host_stats["requests"] += pool.num_requests
+    return stats
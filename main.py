@@ -3,18 +3,34 @@
 # ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
 # text retrieved from https://textkool.com/en/ascii-art-generator?hl=default&vl=default&font=Pagga
 
-import media_management
-import download
+import artifact_cache
+import bandwidth
 import ytb_classes
-import msvcrt
+import http_client
+import pipeline
+import format_selection
+import metrics
 from enum import Enum
-from tqdm import tqdm
 import os
 import sys
-import git
+import json
+import time
+import threading
+import itertools
+import requests
 from pathlib import Path
+from typing import Iterator
 import locale
-locale.setlocale(locale.LC_NUMERIC, 'pl_PL')
+
+# The Polish grouping of the bitrates, where that locale is installed
+try:
+    locale.setlocale(locale.LC_NUMERIC, 'pl_PL')
+except locale.Error:
+    pass
+
+# The remote is fetched at most once per TTL, unless the local commit changed
+VERSION_CHECK_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache", "version_check.json")
+VERSION_CHECK_TTL = 60 * 60 * 24
 
 
 class Color(Enum):
@@ -49,24 +65,58 @@ class Color(Enum):
         return f'{boldstr}{color.value}{string}{Color.END.value}'
 
 
-def check_current_git_version():
+def check_current_git_version() -> str:
     """ Check if current Git repository is up to date
+    Returns:
+        the message to display
     """
+    # GitPython is slow to import and only needed here
+    import git
+
     # Initialize a GitPython Repo object for the existing repository
     repo = git.Repo(os.path.dirname(os.path.realpath(__file__)))
 
-    # Fetch the latest changes from the remote repository
-    repo.remotes.origin.fetch()
-
     # Get the current branch
     branch = repo.active_branch
 
+    try:
+        with open(VERSION_CHECK_CACHE, "r") as f:
+            last_check = json.load(f)
+    except (OSError, ValueError):
+        last_check = {}
+
+    if last_check.get("local") != branch.commit.hexsha or time.time() - last_check.get("checked_at", 0) > VERSION_CHECK_TTL:
+        # Fetch the latest changes from the remote repository
+        repo.remotes.origin.fetch()
+        last_check = {"local": branch.commit.hexsha, "remote": repo.remotes.origin.refs[branch.name].commit.hexsha,
+                      "url": repo.remotes.origin.url, "checked_at": time.time()}
+        os.makedirs(os.path.dirname(VERSION_CHECK_CACHE), exist_ok=True)
+        with open(VERSION_CHECK_CACHE, "w") as f:
+            json.dump(last_check, f)
+
     # Check if the local branch is up to date with the remote branch
-    if branch.commit.hexsha != repo.remotes.origin.refs[branch.name].commit.hexsha:
-        print(Color.string(
-            f"Current repository is not up to date. Try updating it with {Color.string(f'git clone {repo.remotes.origin.url}', Color.CYAN)}", Color.RED))
-    else:
-        print(Color.string("Version up to date.", Color.GREEN))
+    if last_check["local"] != last_check["remote"]:
+        remote_url = last_check["url"]
+        return Color.string(
+            f"Current repository is not up to date. Try updating it with {Color.string(f'git clone {remote_url}', Color.CYAN)}", Color.RED)
+    return Color.string("Version up to date.", Color.GREEN)
+
+
+def start_version_check() -> dict:
+    """ Run check_current_git_version in the background, so it never delays the menu
+    Returns:
+        dict getting the "message" to display once the check is done
+    """
+    result = {}
+
+    def run():
+        try:
+            result["message"] = check_current_git_version()
+        except Exception as e:
+            result["message"] = Color.string(f"Could not check the version: {e}", Color.RED)
+
+    threading.Thread(target=run, daemon=True).start()
+    return result
 
 
 def detect_url(in_url: str) -> tuple[str, object]:
@@ -93,31 +143,26 @@ def detect_url(in_url: str) -> tuple[str, object]:
     return url, url_type
 
 
-def manage_video(video: ytb_classes.Video, media_type: str) -> str | None:
-    """ Will retrieve video intel, download and convert it
+def iter_playlist(videos: Iterator[ytb_classes.Video]) -> Iterator[ytb_classes.Video]:
+    """ Yield the videos of a playlist until one of its pages cannot be fetched,
+    the videos already listed are still downloaded
+    """
+    try:
+        yield from videos
+    except (ValueError, requests.RequestException) as e:
+        print(Color.string(f"Could not list the rest of the playlist: {str(e) or type(e).__name__}", Color.RED))
+
+
+def choose_format(formats: dict, media_type: str, extension: str) -> dict:
+    """ Will pick the format of media_type to download for extension, the best one or the one chosen by the user
     Args:
-        video (Video): the video class instance
+        formats (dict): the formats by media type, as returned by Video.get_extraction_url
         media_type (str): either "audio" or "video"
+        extension (str): the extension of the output
 
     Returns:
-        the downloaded and converted file path
+        the selected format
     """
-    # If video type, we have to download the audio first
-    if media_type == "video":
-        print(Color.string("I have to download the audio first", Color.YELLOW))
-        audio_path = manage_video(video, "audio")
-
-        if not audio_path:
-            return None
-        else:
-            print(Color.string("Then I have to download the video", Color.YELLOW))
-
-    formats = video.get_extraction_url()
-    if not formats:
-        print(Color.string(
-            "Cannot fetch Youtube data on provided link. Is it private?", Color.RED))
-        return None
-
     usable_formats = []
 
     if len(formats[media_type]) == 0:
@@ -127,16 +172,19 @@ def manage_video(video: ytb_classes.Video, media_type: str) -> str | None:
             usable_formats += formats[key]
     else:
         usable_formats = formats[media_type]
+    # Formats that can be copied into the output are preferred, as they do not need to be re-encoded
+    usable_formats = format_selection.sort_formats(usable_formats, media_type, extension)
 
-    selected_format = usable_formats[0] if best_quality else None
+    selected_format = usable_formats[0] if best_quality and usable_formats else None
 
     while not selected_format:
-        print("Choose a format to download:", end="")
+        print(f"Choose a {media_type} format to download:", end="")
         i = 0
         for format in usable_formats:
             i += 1
             display_format = {"Mime": format["mime"], "Bitrate": locale.format_string(
-                '%.2d', format["bitrate"], grouping=True)}
+                '%.2d', format["bitrate"], grouping=True),
+                "Re-encoding": "no" if format_selection.is_compatible(format_selection.get_codec(format), extension) else "yes"}
             print(f"\n{i}. ", end="")
             for elem in display_format:
                 # padding system for a better view of the stats
@@ -150,6 +198,8 @@ def manage_video(video: ytb_classes.Video, media_type: str) -> str | None:
                       Color.string(display_format[elem], Color.GREEN) + padding), end=" ")
 
         print("\n\n>>> ", end="")
+        # Windows console only, imported once the prompt is shown
+        import msvcrt
         choice = str(msvcrt.getch()).split("'")[1].upper()
         print(choice)
 
@@ -160,41 +210,73 @@ def manage_video(video: ytb_classes.Video, media_type: str) -> str | None:
             print(Color.string("Wrong format index.", Color.RED))
             continue
 
-    # mime example: audio/webm; codecs="opus"
-    ext = selected_format["mime"].split("/")[1].split(";")[0]
-    valid_title = media_management.get_valid_filename(video.title)
-    filename = f"{output_folder}\\{valid_title}.{ext}"
-    thumbnail = f"{output_folder}\\{valid_title}.jpg"
-    ext_destination = "mp3" if media_type == "audio" else "mp4"
+    return selected_format
+
 
-    download.download_file(selected_format["url"], filename)
-    download.simple_download(video.thumbnail, thumbnail)
+def manage_video(video: ytb_classes.Video, media_type: str) -> str | None:
+    """ Will retrieve video intel, download and convert it, running the stages of the playlist pipeline one after the other
+    Args:
+        video (Video): the video class instance
+        media_type (str): either "audio" or "video"
 
-    filename = media_management.convert_to(filename, ext_destination, verbose)
-    # if ext_destination == "mp3" and os.path.getsize(filename) > 10 * 1000 * 1000:
-    #     print(Color.string("Converted file is too large, re-converting...", Color.RED))
-    #     filename = media_management.convert_to(filename, ext_destination, verbose)
+    Returns:
+        the downloaded and converted file path
+    """
+    # The same video with the same settings may already be produced, it is then linked from the cache.
+    # Only the default selection is cached, a hand picked format is not what the next lookup expects
+    cache = artifact_cache.get_cache() if best_quality else None
+    job = pipeline.make_video_job(video, media_type, output_folder, verbose, audio_extension,
+                                  streaming=streaming, cache=cache, choose_format=choose_format)
+
+    # One bar for every stream of the video, its total grows as their sizes get known
+    bar = None
+
+    def on_size(size: int):
+        nonlocal bar
+        if bar is None:
+            from tqdm import tqdm
+            bar = tqdm(total=0, desc="Downloading file", colour="yellow", unit="B", unit_scale=True)
+        bar.total += size
+        bar.refresh()
+
+    job["on_size"] = on_size
+    job["on_progress"] = lambda size: bar.update(size)
 
-    if not filename:
-        print(Color.string(
-            f"Could not convert to {ext_destination}. Do you have ffmpeg in PATH?", Color.RED))
-        os.remove(thumbnail)
+    try:
+        for name, function, _ in pipeline.get_video_stages():
+            if name == "post_process":
+                if bar is not None:
+                    bar.close()
+                if job["streaming"]:
+                    print(Color.string("Streaming into ffmpeg... ", Color.YELLOW))
+                elif media_type == "video":
+                    print(Color.string("Merging audio and video together... ", Color.YELLOW))
+            with metrics.span("stage", stage=name):
+                function(job)
+            if job.get("done"):
+                break
+    except pipeline.JobError as e:
+        print(Color.string(str(e), Color.RED))
         return None
-    else:
-        if not media_management.add_metadata(filename, thumbnail, video.author, video.title, verbose):
-            print(Color.string(f"Could not add metadata for {video.title}.", Color.RED))
-        else:
-            print(Color.string(f"{filename} - Done.", Color.GREEN))
+    finally:
+        if bar is not None:
+            bar.close()
 
-    if media_type == "video" and audio_path:
-        print(Color.string("Merging audio and video together... ", Color.YELLOW), end="")
-        filename = media_management.merge_video_audio(filename, audio_path, verbose)
-        if not filename:
-            print(Color.string("Error while merging audio and video files.", Color.RED))
-        else:
-            print(Color.string("Done.", Color.GREEN))
+    print(Color.string(f"{job['output']} - Done{' (cached)' if job.get('cached') else ''}.", Color.GREEN))
+    return job["output"]
 
-    return filename
+
+def manage_traced_video(video: ytb_classes.Video, media_type: str) -> str | None:
+    """ manage_video, recording its spans into a trace written to metrics.TRACES_FOLDER when the metrics are enabled
+    """
+    trace = metrics.start_trace(video.id)
+    metrics.set_trace(trace)
+    try:
+        return manage_video(video, media_type)
+    finally:
+        metrics.set_trace(None)
+        if trace is not None:
+            print(Color.string(f"Trace written to {metrics.write_trace(trace)}", Color.CYAN))
 
 
 # ░█▄█░█▀█░▀█▀░█▀█
@@ -213,7 +295,19 @@ if __name__ == "__main__":
         default_save_path = os.path.dirname(os.path.realpath(__file__))
 
     # Verbosity parameter
-    verbose = len(sys.argv) > 1 and sys.argv[1].lower() == "-v"
+    arguments = [argument.lower() for argument in sys.argv[1:]]
+    verbose = "-v" in arguments
+
+    # Timing spans and counters, written to .cache/traces
+    metrics.enable("--metrics" in arguments)
+
+    # Bandwidth cap shared by every download, like --limit-rate 2M
+    if "--limit-rate" in arguments:
+        position = arguments.index("--limit-rate") + 1
+        try:
+            bandwidth.get_limiter().set_rate(bandwidth.parse_rate(arguments[position] if position < len(arguments) else ""))
+        except ValueError as e:
+            print(Color.string(str(e), Color.RED))
 
     banner = """
 ░█░█░█▀█░█░█░▀█▀░█░█░█▀▄░█▀▀░░░█▀▄░█▀█░█░█░█▀█░█░░░█▀█░█▀█░█▀▄░█▀▀░█▀▄
@@ -224,8 +318,11 @@ if __name__ == "__main__":
         banner += Color.string("\n(Verbosity ENABLED)", Color.CYAN)
     print(Color.string(banner, Color.YELLOW, True))
 
-    # Add version check
-    check_current_git_version()
+    # Add version check, disabled with --no-update-check
+    if "--no-update-check" in arguments or os.environ.get("YTB_NO_UPDATE_CHECK"):
+        version_check = {}
+    else:
+        version_check = start_version_check()
 
     # Global variables
     # The input URL
@@ -237,6 +334,15 @@ if __name__ == "__main__":
     # The auto choice boolean state
     best_quality = True
 
+    # Playlists run through the resolve -> transfer -> post-processing pipeline
+    pipelined = True
+
+    # Audio output, m4a streams can be copied as is while mp3 always needs re-encoding
+    audio_extension = "mp3"
+
+    # Audio is piped into ffmpeg while it downloads
+    streaming = False
+
     # Save folder
     output_folder = default_save_path
 
@@ -254,17 +360,29 @@ if __name__ == "__main__":
             {"action": "video", "text": "Download video from URL"},
             {"action": "best_quality", "text":
                 f"Automatically get best quality [current: {Color.string(best_quality, Color.GREEN if best_quality else Color.RED)}]"},
+            {"action": "audio_extension", "text":
+                f"Switch audio format [current: {Color.string(audio_extension, Color.YELLOW)}]"},
+            {"action": "streaming", "text":
+                f"Stream audio into ffmpeg while downloading [current: {Color.string(streaming, Color.GREEN if streaming else Color.RED)}]"},
+            {"action": "pipelined", "text":
+                f"Pipelined playlist processing (best quality only) [current: {Color.string(pipelined, Color.GREEN if pipelined else Color.RED)}]"},
             {"action": "output_folder",
                 "text": f"Set folder [current: {Color.string(output_folder, Color.YELLOW)}]"},
             {"action": "exit", "text": Color.string("Exit", Color.RED)}
         ]
 
+        # The version check result shows up on the first menu after it completes
+        if "message" in version_check:
+            print(version_check.pop("message"))
+
         # display menu and get user input
         print("")
         for i in range(len(menu)):
             print(f"{i + 1}. {menu[i]['text']}")
 
         print("\n>>> ", end="")
+        # Windows console only, imported once the prompt is shown
+        import msvcrt
         input_char = str(msvcrt.getch()).split("'")[1].upper()
         print(input_char)
 
@@ -291,6 +409,15 @@ if __name__ == "__main__":
         elif action == "best_quality":
             best_quality = not best_quality
 
+        elif action == "pipelined":
+            pipelined = not pipelined
+
+        elif action == "streaming":
+            streaming = not streaming
+
+        elif action == "audio_extension":
+            audio_extension = "m4a" if audio_extension == "mp3" else "mp3"
+
         elif action == "output_folder":
             temp_folder = input("Please enter your folder's path: \n>>> ")
 
@@ -322,19 +449,45 @@ if __name__ == "__main__":
                 print(Color.string("No url provided.", Color.RED))
 
             elif isinstance(url_type, ytb_classes.Playlist):
-                videos = url_type.get_videos()
-                if not videos:
+                # Videos are listed page by page while the first ones download
+                videos = url_type.iter_videos()
+                try:
+                    first_video = next(videos, None)
+                except (ValueError, requests.RequestException):
+                    first_video = None
+                if not first_video:
                     print(Color.string(
                         "Cannot fetch Youtube data on provided link. Is it private?", Color.RED))
                     continue
+                videos = itertools.chain([first_video], iter_playlist(videos))
+
+                # Progress bars are only loaded once needed
+                from tqdm import tqdm
+                if pipelined and best_quality:
+                    with tqdm(desc="Videos done: ", colour="red") as bar:
+                        jobs = pipeline.download_videos(videos, action, output_folder, verbose,
+                                                        on_job_done=lambda job: bar.update(), audio_extension=audio_extension,
+                                                        streaming=streaming, cache=artifact_cache.get_cache())
+                    for job in jobs:
+                        if job["trace"] is not None:
+                            metrics.write_trace(job["trace"])
+                        if job["error"]:
+                            print(Color.string(f"{job['video']} - {job['failed_stage']}: {job['error']}", Color.RED))
+                        else:
+                            print(Color.string(f"{job['output']} - Done{' (cached)' if job.get('cached') else ''}.", Color.GREEN))
                 else:
-                    print(Color.string(
-                        f"{len(videos)} video{'s' if len(videos) > 1 else ''} found in that Playlist.", Color.YELLOW))
+                    for video in tqdm(videos, desc="Videos done: ", colour="red"):
+                        manage_traced_video(video, action)
 
-                for video in tqdm(videos, desc="Videos remaining: ", colour="red"):
-                    manage_video(video, action)
+                if verbose:
+                    for host, host_stats in http_client.connection_stats().items():
+                        print(Color.string(
+                            f"{host}: {host_stats['requests']} requests over {host_stats['connections']} connections", Color.CYAN))
 
             elif isinstance(url_type, ytb_classes.Video):
-                manage_video(url_type, action)
+                manage_traced_video(url_type, action)
+
+            if metrics.ENABLED:
+                metrics.write_prometheus(os.path.join(metrics.TRACES_FOLDER, "metrics.prom"))
 
         input_char = None
@@ -3,10 +3,173 @@
 # ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
 
 import os
-import re
 import subprocess
-from mutagen.easyid3 import EasyID3
-from mutagen.mp4 import MP4
+import logging
+import threading
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import format_selection
+import download
+import metrics
+
+# ░█▀▀░█▀▀░█░█░█▀▀░█▀▄░█░█░█░░░█▀▀░█▀▄
+# ░▀▀█░█░░░█▀█░█▀▀░█░█░█░█░█░░░█▀▀░█▀▄
+# ░▀▀▀░▀▀▀░▀░▀░▀▀▀░▀▀░░▀▀▀░▀▀▀░▀▀▀░▀░▀
+
+# Exit code reported for a command that could not be started, like a shell does when it is not found
+SPAWN_FAILED = 127
+
+
+class ClosedPipe:
+    """ Stdin of a process that could not be started, writing to it fails like writing to a process that exited
+    """
+    closed = True
+
+    def write(self, data) -> int:
+        raise BrokenPipeError("The process could not be started")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FailedProcess:
+    """ Stands for a process that could not be started, as yielded by FfmpegScheduler.popen
+    """
+    def __init__(self, args: list[str], error: OSError):
+        self.args = args
+        self.returncode = SPAWN_FAILED
+        self.error = error
+        self.pid = None
+        self.stdin = ClosedPipe()
+        self.stdout = None
+        self.stderr = None
+
+    def wait(self, timeout=None) -> int:
+        return self.returncode
+
+
+class FfmpegScheduler:
+    """ Runs ffmpeg processes, at most max_processes at a time, each one limited to its share of the cores
+    so that concurrent jobs saturate the machine without oversubscribing it.
+    """
+    def __init__(self, max_processes: int = None, threads_per_process: int = None):
+        cores = os.cpu_count() or 1
+        self.max_processes = max_processes or max(1, cores // 2)
+        self.threads_per_process = threads_per_process or max(1, cores // self.max_processes)
+        self.slots = threading.Semaphore(self.max_processes)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_processes, thread_name_prefix="ffmpeg")
+
+    def with_threads(self, command: list[str]) -> list[str]:
+        """ Add the thread limit as an output option, right before the output path
+        """
+        return command[:-1] + ["-threads", str(self.threads_per_process)] + command[-1:]
+
+    def run(self, command: list[str], verbose=False, stdin=subprocess.DEVNULL) -> subprocess.CompletedProcess:
+        """ Run a command once a slot is free, and wait for it.
+        Returns the completed process, with its exit code and stderr.
+        When verbose, stderr goes to the console instead, so the -stats progress shows up while it runs.
+        A command that cannot be started, like a missing ffmpeg, gives SPAWN_FAILED and the error in stderr.
+        """
+        command = self.with_threads(command)
+        if verbose:
+            print(" ".join(command))
+
+        with metrics.span("ffmpeg_queued"):
+            self.slots.acquire()
+        try:
+            with metrics.span("ffmpeg"):
+                try:
+                    process = subprocess.Popen(command, stdin=stdin, stderr=None if verbose else subprocess.PIPE)
+                except OSError as e:
+                    result = subprocess.CompletedProcess(command, SPAWN_FAILED, stderr=f"Could not start {command[0]}: {e}".encode())
+                else:
+                    stderr = b""
+                    if process.stderr is not None:
+                        stderr = process.stderr.read()
+                        process.stderr.close()
+                    self.wait(process)
+                    result = subprocess.CompletedProcess(command, process.returncode, stderr=stderr)
+        finally:
+            self.slots.release()
+
+        if verbose or result.returncode != 0:
+            logging.log(logging.ERROR if result.returncode != 0 else logging.INFO,
+                        f"ffmpeg exited with {result.returncode}" + (f": {result.stderr.decode(errors='replace').strip()}" if result.stderr else ""))
+        return result
+
+    def submit(self, command: list[str], verbose=False, stdin=subprocess.DEVNULL) -> Future:
+        """ Run a command in the background, see run
+        """
+        return self.executor.submit(metrics.bind(self.run), command, verbose, stdin)
+
+    def submit_task(self, function, *args, **kwargs) -> Future:
+        """ Run one of the post-processing functions (convert_to, add_metadata, merge_video_audio...) in the background
+        """
+        return self.executor.submit(metrics.bind(function), *args, **kwargs)
+
+    @contextmanager
+    def popen(self, command: list[str], verbose=False, **kwargs):
+        """ Start a command once a slot is free, for callers that need to talk to the process.
+        The slot is released once the process ended.
+        A command that cannot be started yields a FailedProcess, its returncode already set to SPAWN_FAILED.
+        """
+        command = self.with_threads(command)
+        if verbose:
+            print(" ".join(command))
+
+        with metrics.span("ffmpeg_queued"):
+            self.slots.acquire()
+        try:
+            with metrics.span("ffmpeg"):
+                try:
+                    process = subprocess.Popen(command, **kwargs)
+                except OSError as e:
+                    logging.error(f"Could not start {command[0]}: {e}")
+                    process = FailedProcess(command, e)
+                try:
+                    yield process
+                finally:
+                    self.wait(process)
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def wait(process: subprocess.Popen) -> int:
+        """ Wait for a process. With the metrics enabled, its CPU time is counted, where the OS reports it.
+        """
+        if not metrics.ENABLED or not hasattr(os, "wait4") or process.returncode is not None:
+            return process.wait()
+
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        metrics.count("ffmpeg_cpu_seconds", usage.ru_utime + usage.ru_stime)
+        return process.returncode
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> FfmpegScheduler:
+    """ The process-wide ffmpeg scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FfmpegScheduler()
+        return _scheduler
+
+
+def configure_scheduler(max_processes: int = None, threads_per_process: int = None):
+    """ Replace the process-wide ffmpeg scheduler, the running processes are not affected
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = FfmpegScheduler(max_processes, threads_per_process)
 
 # ░█▀▀░█░█░█▀█░█▀▀░▀█▀░▀█▀░█▀█░█▀█░█▀▀
 # ░█▀▀░█░█░█░█░█░░░░█░░░█░░█░█░█░█░▀▀█
@@ -18,6 +181,13 @@ def get_ffmpeg_command_starter(verbose=False) -> list[str]:
             "-stats"]
 
 
+def run_ffmpeg(command: list[str], verbose=False, stdin=subprocess.DEVNULL) -> int:
+    """ Run an ffmpeg command through the scheduler, returns its exit code
+    """
+    return get_scheduler().run(command, verbose, stdin).returncode
+
+
+@metrics.timed("convert_to")
 def convert_to(filename: str, extension: str, verbose=False, force=False) -> str:
     """ Convert given file to extension with ffmpeg binary.
     Returns the new filename or None if failed.
@@ -27,8 +197,7 @@ def convert_to(filename: str, extension: str, verbose=False, force=False) -> str
 
     dir_path = os.path.dirname(filename) if len(
         os.path.dirname(filename)) > 0 else os.path.dirname(os.path.realpath(__file__))
-    new_filename = dir_path + "\\" + \
-        os.path.splitext(os.path.basename(filename))[0] + "." + extension
+    new_filename = os.path.join(dir_path, os.path.splitext(os.path.basename(filename))[0] + "." + extension)
     command = get_ffmpeg_command_starter(
         verbose) + ["-i", r"{}".format(filename)]
 
@@ -42,10 +211,10 @@ def convert_to(filename: str, extension: str, verbose=False, force=False) -> str
 
     command += ["-y", r"{}".format(new_filename)]
 
-    if verbose:
-        print(" ".join(command))
-
-    subprocess.call(command, shell=True)
+    if run_ffmpeg(command, verbose) != 0:
+        if os.path.isfile(new_filename) and new_filename != filename:
+            os.remove(new_filename)
+        return None
 
     os.remove(filename)
 
@@ -57,8 +226,53 @@ def convert_to(filename: str, extension: str, verbose=False, force=False) -> str
     return new_filename
 
 
+# Containers tagged in place with mutagen instead of an ffmpeg remux.
+# mp3 is not one of them: ffmpeg leaves almost no padding in its ID3 header, so mutagen would rewrite
+# the whole file to make room for the cover, mp3 tags are written by the ffmpeg pass creating the file instead.
+NATIVE_TAGGING_EXTENSIONS = ["mp4", "m4a"]
+
+
+@metrics.timed("tag_media")
+def tag_media(filename: str, author: str, title: str, cover: bytes = None) -> bool:
+    """ Writes the title, artist and cover art tags in place with mutagen, without rewriting the media data
+    Args:
+        filename: the path for the mp4 or m4a file
+        author: the author of the media
+        title: the media title
+        cover: the jpeg or png image, if any
+
+    Returns:
+        boolean success
+    """
+    # Only loaded when tagging, it is not needed to start
+    from mutagen import MutagenError
+    from mutagen.mp4 import MP4, MP4Cover
+
+    extension = os.path.splitext(filename)[1][1:]
+    mime = "image/png" if cover and cover.startswith(b"\x89PNG") else "image/jpeg"
+
+    try:
+        if extension in ["mp4", "m4a"]:
+            media = MP4(filename)
+            if media.tags is None:
+                media.add_tags()
+            media.tags["\xa9nam"] = [title]
+            media.tags["\xa9ART"] = [author]
+            if cover:
+                media.tags["covr"] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_PNG if mime == "image/png" else MP4Cover.FORMAT_JPEG)]
+            media.save()
+
+        else:
+            return False
+    except MutagenError:
+        logging.exception(f"Could not tag {filename}")
+        return False
+    return True
+
+
+@metrics.timed("add_metadata")
 def add_metadata(filename: str, thumbnail: str, author: str, title: str, verbose=False) -> bool:
-    """ Adds metadata to a media file
+    """ Adds metadata to a media file, in place for mp4 and m4a files
     Args:
         filename: the path for the mp3 file
         thumbnail: the path for the image
@@ -69,6 +283,12 @@ def add_metadata(filename: str, thumbnail: str, author: str, title: str, verbose
     Returns:
         boolean success
     """
+    if os.path.splitext(filename)[1][1:] in NATIVE_TAGGING_EXTENSIONS:
+        with open(thumbnail, "rb") as f:
+            cover = f.read()
+        os.remove(thumbnail)
+        return tag_media(filename, author, title, cover)
+
     output_filename = filename + "_temp" + os.path.splitext(filename)[1]
 
     command = get_ffmpeg_command_starter(verbose) + ["-i", r"{}".format(thumbnail), "-i", r"{}".format(filename),
@@ -76,28 +296,17 @@ def add_metadata(filename: str, thumbnail: str, author: str, title: str, verbose
                                                      "-metadata", r'artist={}'.format(author)
                                                      , "-metadata", r'title={}'.format(title), r"{}".format(output_filename)]
 
-    if verbose:
-        print(" ".join(command))
+    success = run_ffmpeg(command, verbose) == 0 and os.path.isfile(output_filename)
 
-    subprocess.call(command, shell=True, stdin=subprocess.DEVNULL)
+    os.remove(thumbnail)
+    if not success:
+        if os.path.isfile(output_filename):
+            os.remove(output_filename)
+        return False
 
     os.remove(filename)
-    os.remove(thumbnail)
     os.rename(output_filename, filename)
-
-    # Check file metadata
-    try:
-        if filename.endswith(".mp3"):
-            metadata = EasyID3(filename)
-        elif filename.endswith(".mp4"):
-            metadata = MP4(filename).tags
-
-        # Get the title metadata
-        title = metadata.get("title")
-
-        return title != None
-    except:
-        return False
+    return True
 
 
 def get_valid_filename(filename: str, backslash=False) -> str:
@@ -111,21 +320,189 @@ def get_valid_filename(filename: str, backslash=False) -> str:
     return filename
 
 
-def merge_video_audio(video_path: str, audio_path: str, verbose=False) -> str:
+@metrics.timed("merge_video_audio")
+def merge_video_audio(video_path: str, audio_path: str, verbose=False) -> str | None:
     """ Will merge an audio and a video file together
+    Returns the video path or None if failed, the inputs are then kept.
     """
     output_path = video_path + "_temp.mp4"
     command = get_ffmpeg_command_starter(verbose) + \
     ["-i", r"{}".format(video_path), "-i", r"{}".format(audio_path), "-c:v", "copy", "-c:a", "aac",
         "-map", "0:v:1?", "-map", "0:v:0?", "-map", "1:a:0", "-y", r"{}".format(output_path)]
 
-    if verbose:
-        print(" ".join(command))
-
-    subprocess.call(command, shell=True)
+    if run_ffmpeg(command, verbose) != 0 or not os.path.isfile(output_path):
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        return None
 
     os.remove(video_path)
     os.remove(audio_path)
     os.rename(output_path, video_path)
 
-    return output_path
+    return video_path
+
+
+def build_post_processing_command(output: str, audio_path: str = None, video_path: str = None, thumbnail: str = None,
+                                  author: str = None, title: str = None, verbose=False,
+                                  audio_codec: str = None, video_codec: str = None) -> list[str]:
+    """ Build a single ffmpeg command doing the conversion, the audio and video merge,
+    the cover art and the metadata of output at once, instead of one pass for each.
+    Streams whose codec fits the output container are copied instead of re-encoded.
+    Args:
+        output: the path of the mp3, m4a or mp4 file to create
+        audio_path: the downloaded audio stream, if any
+        video_path: the downloaded video stream, if any
+        thumbnail: the path for the cover image, if any
+        author: the author of the media
+        title: the media title
+        verbose: the command verbosity
+        audio_codec: the codec of the audio stream, like "mp4a.40.2", if known
+        video_codec: the codec of the video stream, like "avc1.640028", if known
+
+    Returns:
+        the ffmpeg command
+    """
+    extension = os.path.splitext(output)[1][1:]
+    inputs = []
+    maps = []
+    codecs = []
+
+    if video_path and extension != "mp3":
+        maps += ["-map", f"{len(inputs)}:v:0"]
+        if format_selection.is_compatible(video_codec, extension):
+            codecs += ["-c:v:0", "copy"]
+        inputs += ["-i", r"{}".format(video_path)]
+
+    if audio_path:
+        maps += ["-map", f"{len(inputs) // 2}:a:0"]
+        if format_selection.is_compatible(audio_codec, extension):
+            codecs += ["-c:a", "copy"]
+        elif extension in ["mp4", "m4a"]:
+            codecs += ["-c:a", "aac"]
+        inputs += ["-i", r"{}".format(audio_path)]
+
+    if thumbnail:
+        cover_index = 1 if video_path and extension != "mp3" else 0
+        maps += ["-map", f"{len(inputs) // 2}:v:0"]
+        codecs += [f"-c:v:{cover_index}", "copy", f"-disposition:v:{cover_index}", "attached_pic"]
+        inputs += ["-i", r"{}".format(thumbnail)]
+    if extension == "mp3":
+        codecs += ["-id3v2_version", "3"]
+
+    metadata = []
+    if author:
+        metadata += ["-metadata", r'artist={}'.format(author)]
+    if title:
+        metadata += ["-metadata", r'title={}'.format(title)]
+
+    return get_ffmpeg_command_starter(verbose) + inputs + maps + codecs + metadata + ["-y", r"{}".format(output)]
+
+
+def write_cover(output: str, cover: bytes) -> str:
+    """ Write the in-memory cover next to output, as an input of the ffmpeg pass.
+    Returns its path, to be removed once ffmpeg is done.
+    """
+    path = output + (".cover.png" if cover.startswith(b"\x89PNG") else ".cover.jpg")
+    with open(path, "wb") as f:
+        f.write(cover)
+    return path
+
+
+def finish_tagging(output: str, thumbnail: str = None, author: str = None, title: str = None, cover: bytes = None):
+    """ Tag output in place once ffmpeg is done with it, if it was left to mutagen
+    """
+    if os.path.isfile(output) and os.path.splitext(output)[1][1:] in NATIVE_TAGGING_EXTENSIONS:
+        if cover is None and thumbnail and os.path.isfile(thumbnail):
+            with open(thumbnail, "rb") as f:
+                cover = f.read()
+        if not tag_media(output, author, title, cover):
+            logging.warning(f"Could not add metadata to {output}")
+
+
+@metrics.timed("post_process")
+def post_process(output: str, audio_path: str = None, video_path: str = None, thumbnail: str = None,
+                 author: str = None, title: str = None, verbose=False,
+                 audio_codec: str = None, video_codec: str = None, cover: bytes = None) -> str | None:
+    """ Create output from the downloaded streams in a single ffmpeg pass, see build_post_processing_command.
+    mp4 and m4a outputs are tagged in place afterwards with tag_media, the others by the ffmpeg pass,
+    the cover coming from memory if given, or from the thumbnail file.
+    The downloaded files are removed once output is created, and kept for a retry if ffmpeg failed.
+    Returns the output path or None if failed.
+    """
+    native_tagging = os.path.splitext(output)[1][1:] in NATIVE_TAGGING_EXTENSIONS
+    cover_path = write_cover(output, cover) if cover and not thumbnail and not native_tagging else None
+    if native_tagging:
+        command = build_post_processing_command(output, audio_path, video_path, None, None, None, verbose,
+                                                audio_codec, video_codec)
+    else:
+        command = build_post_processing_command(output, audio_path, video_path, thumbnail or cover_path, author, title, verbose,
+                                                audio_codec, video_codec)
+    success = run_ffmpeg(command, verbose) == 0
+    if cover_path:
+        os.remove(cover_path)
+    if not success:
+        # A partial output would be taken for a finished one
+        if os.path.isfile(output):
+            os.remove(output)
+        return None
+
+    if native_tagging:
+        finish_tagging(output, thumbnail, author, title, cover)
+
+    for path in [audio_path, video_path, thumbnail]:
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    if not os.path.isfile(output):
+        return None
+    return output
+
+
+@metrics.timed("stream_post_process")
+def stream_post_process(output: str, url: str, thumbnail: str = None, author: str = None, title: str = None, verbose=False,
+                        audio_codec: str = None, cover: bytes = None, size: int = None) -> str | None:
+    """ Same as post_process for a single audio stream, but the stream is piped into ffmpeg while it downloads,
+    so the transcoding overlaps the transfer and no intermediate file is written.
+    size is the expected length of the stream, when known.
+    The thumbnail is removed.
+    Returns the output path or None if failed.
+    """
+    native_tagging = os.path.splitext(output)[1][1:] in NATIVE_TAGGING_EXTENSIONS
+    cover_path = write_cover(output, cover) if cover and not thumbnail and not native_tagging else None
+    if native_tagging:
+        command = build_post_processing_command(output, "pipe:0", None, None, None, None, verbose, audio_codec)
+    else:
+        command = build_post_processing_command(output, "pipe:0", None, thumbnail or cover_path, author, title, verbose, audio_codec)
+
+    success = True
+    with get_scheduler().popen(command, verbose, stdin=subprocess.PIPE) as process:
+        try:
+            if process.returncode is not None:
+                raise BrokenPipeError("ffmpeg could not be started")
+            download.stream_ranges(url, process.stdin, expected_size=size)
+        except BrokenPipeError:
+            logging.error(f"ffmpeg stopped reading while streaming {output}")
+            success = False
+        except (requests.RequestException, OSError, ValueError):
+            logging.exception(f"Could not stream {output}")
+            success = False
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                success = False
+    success = process.returncode == 0 and success
+
+    if success and native_tagging:
+        finish_tagging(output, thumbnail, author, title, cover)
+
+    for path in [thumbnail, cover_path]:
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    # A partial stream leaves a truncated output behind
+    if not success and os.path.isfile(output):
+        os.remove(output)
+    if not os.path.isfile(output):
+        return None
+    return output
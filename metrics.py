@@ -0,0 +1,241 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Nothing is recorded until enable is called, every call below returns right away
+ENABLED = False
+
+TRACES_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache", "traces")
+
+# Prefix of the exported metric names
+PREFIX = "ytb"
+
+_lock = threading.Lock()
+_counters = {}
+_summaries = {}
+_local = threading.local()
+_null_span = contextlib.nullcontext()
+
+# ░▀█▀░█▀▄░█▀█░█▀▀░█▀▀░█▀▀
+# ░░█░░█▀▄░█▀█░█░░░█▀▀░▀▀█
+# ░░▀░░▀░▀░▀░▀░▀▀▀░▀▀▀░▀▀▀
+
+
+class Trace:
+    """ Spans and counters of one job, possibly spread over several threads
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.origin = time.monotonic()
+        self.attributes = {}
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, duration: float, labels: dict):
+        with self.lock:
+            self.spans.append({"name": name, "start": start - self.origin, "duration": duration,
+                               "thread": threading.current_thread().name, **({"labels": labels} if labels else {})})
+
+    def add(self, name: str, value: float):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {"name": self.name, "started_at": self.started_at, "attributes": dict(self.attributes),
+                    "spans": sorted(self.spans, key=lambda span: span["start"]), "counters": dict(self.counters)}
+
+
+class Span:
+    """ Times its block into the <name>_seconds summary and the trace of the current thread
+    """
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.monotonic() - self.start
+        labels = dict(self.labels, failed="true") if exc_info[0] else self.labels
+        observe(f"{self.name}_seconds", duration, **labels)
+        trace = get_trace()
+        if trace is not None:
+            trace.add_span(self.name, self.start, duration, labels)
+        return False
+
+# ░█▀▄░█▀▀░█▀▀░█▀█░█▀▄░█▀▄░▀█▀░█▀█░█▀▀
+# ░█▀▄░█▀▀░█░░░█░█░█▀▄░█░█░░█░░█░█░█░█
+# ░▀░▀░▀▀▀░▀▀▀░▀▀▀░▀░▀░▀▀░░▀▀▀░▀░▀░▀▀▀
+
+
+def enable(enabled = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    """ Forget every counter and summary
+    """
+    with _lock:
+        _counters.clear()
+        _summaries.clear()
+
+
+def start_trace(name: str) -> Trace | None:
+    """ New trace for a job, None when disabled
+    """
+    return Trace(name) if ENABLED else None
+
+
+def set_trace(trace: Trace | None):
+    """ Record the spans and counters of the current thread into trace
+    """
+    _local.trace = trace
+
+
+def get_trace() -> Trace | None:
+    return getattr(_local, "trace", None)
+
+
+def bind(function):
+    """ Wrap function so it records into the trace of the calling thread, when run by another thread
+    """
+    trace = get_trace()
+    if trace is None:
+        return function
+
+    def bound(*args, **kwargs):
+        set_trace(trace)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            set_trace(None)
+    return bound
+
+
+def span(name: str, **labels):
+    """ Context manager timing its block, a shared no-op when disabled
+    """
+    if not ENABLED:
+        return _null_span
+    return Span(name, labels)
+
+
+def timed(name: str):
+    """ Decorator timing every call of a function as a span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1, **labels):
+    """ Add value to a counter, and to the trace of the current thread
+    """
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    trace = get_trace()
+    if trace is not None:
+        trace.add(name, value)
+
+
+def observe(name: str, value: float, **labels):
+    """ Add one value to a summary, exported as its count and sum
+    """
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        summary = _summaries.setdefault(key, [0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+
+# ░█▀▀░█░█░█▀█░█▀█░█▀▄░▀█▀
+# ░█▀▀░▄▀▄░█▀▀░█░█░█▀▄░░█░
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░
+
+
+def snapshot() -> dict:
+    """ Current counters and summaries
+    """
+    with _lock:
+        return {"counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in _counters.items()],
+                "summaries": [{"name": name, "labels": dict(labels), "count": summary[0], "sum": summary[1]}
+                              for (name, labels), summary in _summaries.items()]}
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+def prometheus_text() -> str:
+    """ Counters and summaries in the Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        summaries = sorted((key, list(summary)) for key, summary in _summaries.items())
+
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            typed.add(name)
+        lines.append(f"{PREFIX}_{name}_total{format_labels(labels)} {value}")
+    for (name, labels), (number, total) in summaries:
+        if name not in typed:
+            lines.append(f"# TYPE {PREFIX}_{name} summary")
+            typed.add(name)
+        lines.append(f"{PREFIX}_{name}_count{format_labels(labels)} {number}")
+        lines.append(f"{PREFIX}_{name}_sum{format_labels(labels)} {total}")
+    return "\n".join(lines) + "\n"
+
+
+def write_trace(trace: Trace, folder: str = TRACES_FOLDER) -> str:
+    """ Write a trace as <folder>/<name>.json
+    Returns its path.
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "".join(char if char.isalnum() or char in "-_." else "_" for char in trace.name) + ".json")
+    with open(path, "w") as f:
+        json.dump(trace.to_dict(), f, indent=2)
+    return path
+
+
+def write_prometheus(path: str):
+    """ Atomically replace path with the current Prometheus snapshot
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(prometheus_text())
+    os.replace(temporary_path, path)
@@ -0,0 +1,255 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import os
+import queue
+import threading
+import logging
+import time
+from typing import Callable, Iterable
+import artifact_cache
+import download
+import format_selection
+import media_management
+import metrics
+import ytb_classes
+
+# Default number of workers per stage
+RESOLVE_WORKERS = 4
+TRANSFER_WORKERS = 2
+POST_PROCESS_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Jobs waiting between two stages
+QUEUE_SIZE = 4
+
+_end_of_jobs = object()
+
+
+class JobError(Exception):
+    """ Expected failure of a job, reported without a traceback
+    """
+
+# ░█▀█░▀█▀░█▀█░█▀▀░█░░░▀█▀░█▀█░█▀▀
+# ░█▀▀░░█░░█▀▀░█▀▀░█░░░░█░░█░█░█▀▀
+# ░▀░░░▀▀▀░▀░░░▀▀▀░▀▀▀░▀▀▀░▀░▀░▀▀▀
+
+
+def run_pipeline(jobs: Iterable[dict], stages: list[tuple[str, Callable[[dict], None], int]], queue_size = QUEUE_SIZE,
+                 on_job_done: Callable[[dict], None] = None, collect = True) -> list[dict]:
+    """ Run every job through the (name, function, workers) stages.
+    Each stage has its own workers and a bounded queue in front of it, so all stages run at the same time
+    and the slowest one sets the pace. A failing job leaves the pipeline with its error set, without stalling the others.
+    A stage can set job["done"] to skip the next ones.
+    If jobs raises, the error is logged and the jobs already queued still run to the end,
+    an on_job_done callback raising is logged too.
+    Without collect, the finished jobs are only handed to on_job_done and dropped, for a long-running pipeline.
+    Returns the jobs in their input order (none without collect), with their per stage running times in job["timings"]
+    and the time they waited in front of each stage in job["waits"].
+    With the metrics enabled, each job records its spans into job["trace"].
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    results = []
+    results_lock = threading.Lock()
+    remaining_workers = [workers for _, _, workers in stages]
+
+    def finish(job: dict):
+        if collect:
+            with results_lock:
+                results.append(job)
+        if on_job_done:
+            try:
+                on_job_done(job)
+            except Exception:
+                logging.exception(f"on_job_done failed for {job['video']}")
+
+    def worker(index: int):
+        name, function, _ = stages[index]
+        try:
+            while True:
+                job = queues[index].get()
+                if job is _end_of_jobs:
+                    break
+
+                start = time.monotonic()
+                job["waits"][name] = start - job.pop("queued_at")
+                metrics.observe("stage_queued_seconds", job["waits"][name], stage=name)
+                if job["trace"] is not None:
+                    job["trace"].add_span("queued", start - job["waits"][name], job["waits"][name], {"stage": name})
+                metrics.set_trace(job["trace"])
+                try:
+                    with metrics.span("stage", stage=name):
+                        function(job)
+                except JobError as e:
+                    job["error"], job["failed_stage"] = str(e), name
+                    logging.error(f"{job['video']} failed at {name}: {e}")
+                except Exception as e:
+                    job["error"], job["failed_stage"] = str(e) or type(e).__name__, name
+                    logging.exception(f"{job['video']} failed at {name}")
+                job["timings"][name] = time.monotonic() - start
+                metrics.set_trace(None)
+
+                if job["error"] or job.get("done") or index == len(stages) - 1:
+                    finish(job)
+                else:
+                    job["queued_at"] = time.monotonic()
+                    queues[index + 1].put(job)
+        finally:
+            # The last worker of a stage to stop ends the next stage, even if this one died
+            with results_lock:
+                remaining_workers[index] -= 1
+                last = remaining_workers[index] == 0
+            if last and index < len(stages) - 1:
+                for _ in range(stages[index + 1][2]):
+                    queues[index + 1].put(_end_of_jobs)
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True)
+               for index, (_, _, workers) in enumerate(stages) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    # Jobs are fed as they come, so an enumeration can still be running
+    try:
+        for index, job in enumerate(jobs):
+            job.setdefault("index", index)
+            job.setdefault("error", None)
+            job.setdefault("timings", {})
+            job.setdefault("waits", {})
+            job.setdefault("trace", metrics.start_trace(str(job.get("id", index))))
+            if job["trace"] is not None:
+                job["trace"].attributes["job"] = str(job.get("video", index))
+            job["queued_at"] = time.monotonic()
+            queues[0].put(job)
+    except Exception:
+        logging.exception("Could not list the next jobs, only the queued ones are run")
+    finally:
+        for _ in range(stages[0][2]):
+            queues[0].put(_end_of_jobs)
+
+    for thread in threads:
+        thread.join()
+
+    return sorted(results, key=lambda job: job["index"])
+
+# ░█░█░▀█▀░█▀▄░█▀▀░█▀█░░░█▀▀░▀█▀░█▀█░█▀▀░█▀▀░█▀▀
+# ░▀▄▀░░█░░█░█░█▀▀░█░█░░░▀▀█░░█░░█▀█░█░█░█▀▀░▀▀█
+# ░░▀░░▀▀▀░▀▀░░▀▀▀░▀▀▀░░░▀▀▀░░▀░░▀░▀░▀▀▀░▀▀▀░▀▀▀
+
+
+def make_video_job(video: ytb_classes.Video, media_type: str, output_folder: str, verbose = False, audio_extension = "mp3",
+                   constraints: dict = None, streaming = False, cache: artifact_cache.ArtifactCache = None, weight = 1.0,
+                   choose_format: Callable[[dict, str, str], dict | None] = None) -> dict:
+    """ Job downloading a video as "audio" (audio_extension) or "video" (mp4) into output_folder.
+    constraints are the max_height, max_filesize and preferred_codec of format_selection.select_format.
+    With streaming, audio is piped into ffmpeg during post-processing instead of being downloaded first.
+    With a cache, an artifact already produced with the same settings is reused, and new ones are stored.
+    weight is the share of each of its files in the bandwidth limit.
+    choose_format replaces format_selection.select_format, it gets the formats, the media type and the extension.
+    """
+    extension = audio_extension if media_type == "audio" else "mp4"
+    return {"video": video, "media_type": media_type, "output_folder": output_folder, "verbose": verbose,
+            "extension": extension, "constraints": constraints or {}, "streaming": streaming and media_type == "audio",
+            "cache": cache, "settings": artifact_cache.make_settings(media_type, extension, constraints),
+            "weight": weight, "choose_format": choose_format, "error": None, "timings": {}}
+
+
+def resolve_stage(job: dict):
+    """ Fetch the video intel and select the formats to download, unless the output is already cached
+    """
+    video: ytb_classes.Video = job["video"]
+    if job["cache"]:
+        artifact = job["cache"].find(video.id, job["settings"])
+        if artifact:
+            job["output"] = job["cache"].materialize(artifact, job["output_folder"])
+            job["cached"] = job["done"] = True
+            return
+
+    formats = video.get_extraction_url()
+    if not formats:
+        raise JobError("Cannot fetch Youtube data on provided link. Is it private?")
+
+    # Videos are merged with the audio stream
+    media_types = ["audio", "video"] if job["media_type"] == "video" else ["audio"]
+    job["formats"] = {}
+    for media_type in media_types:
+        if job.get("choose_format"):
+            job["formats"][media_type] = job["choose_format"](formats, media_type, job["extension"])
+        else:
+            job["formats"][media_type] = format_selection.select_format(formats, media_type, job["extension"], **job["constraints"])
+        if not job["formats"][media_type]:
+            raise JobError(f"No available formats for {media_type} type matching {job['constraints']}")
+    job["title"] = video.title
+
+
+def transfer_stage(job: dict):
+    """ Download the selected formats and the thumbnail
+    """
+    video: ytb_classes.Video = job["video"]
+    valid_title = media_management.get_valid_filename(job["title"])
+    job["files"] = {}
+
+    # Streamed audio is downloaded by the post-processing
+    for media_type, selected_format in job["formats"].items() if not job["streaming"] else []:
+        # The stream url may have expired while waiting in the queue
+        selected_format = video.get_fresh_format(selected_format)
+        if not selected_format:
+            raise JobError("Cannot fetch Youtube data on provided link. Is it private?")
+
+        # mime example: audio/webm; codecs="opus"
+        ext = selected_format["mime"].split("/")[1].split(";")[0]
+        filename = os.path.join(job["output_folder"], f"{valid_title}.{media_type}.{ext}")
+        if not download.download_file(selected_format["url"], filename, adaptive=True, display_bar=False,
+                                      on_progress=job.get("on_progress"), on_size=job.get("on_size"), weight=job["weight"],
+                                      expected_size=selected_format.get("filesize")):
+            raise JobError("Could not download. Run it again to resume the missing parts.")
+        job["files"][media_type] = filename
+
+    # The cover is kept in memory, to be tagged in place
+    job["cover"] = download.fetch_bytes(video.thumbnail)
+
+
+def post_process_stage(job: dict):
+    """ Convert, merge and tag the downloaded files into the final file, in a single ffmpeg pass
+    """
+    video: ytb_classes.Video = job["video"]
+    valid_title = media_management.get_valid_filename(job["title"])
+    ext_destination = job["extension"]
+    output = os.path.join(job["output_folder"], f"{valid_title}.{ext_destination}")
+    codecs = {media_type: format_selection.get_codec(selected_format) for media_type, selected_format in job["formats"].items()}
+
+    if job["streaming"]:
+        selected_format = video.get_fresh_format(job["formats"]["audio"])
+        if not selected_format:
+            raise JobError("Cannot fetch Youtube data on provided link. Is it private?")
+        if not media_management.stream_post_process(output, selected_format["url"], None, video.author, video.title,
+                                                    job["verbose"], codecs["audio"], job["cover"], selected_format.get("filesize")):
+            raise JobError(f"Could not stream into {ext_destination}. Do you have ffmpeg in PATH?")
+    elif not media_management.post_process(output, job["files"].get("audio"), job["files"].get("video"), None,
+                                           video.author, video.title, job["verbose"], codecs.get("audio"), codecs.get("video"),
+                                           job["cover"]):
+        raise JobError(f"Could not convert to {ext_destination}. Do you have ffmpeg in PATH?")
+    job["output"] = output
+
+    if job["cache"]:
+        job["cache"].put(video.id, [selected_format["itag"] for selected_format in job["formats"].values()],
+                         job["settings"], output)
+
+    # Not needed anymore, and a finished job may be kept for long
+    del job["cover"], job["formats"]
+
+
+def get_video_stages(resolve_workers = RESOLVE_WORKERS, transfer_workers = TRANSFER_WORKERS,
+                     post_process_workers = POST_PROCESS_WORKERS) -> list[tuple[str, Callable[[dict], None], int]]:
+    return [("resolve", resolve_stage, resolve_workers),
+            ("transfer", transfer_stage, transfer_workers),
+            ("post_process", post_process_stage, post_process_workers)]
+
+
+def download_videos(videos: Iterable[ytb_classes.Video], media_type: str, output_folder: str, verbose = False,
+                    on_job_done: Callable[[dict], None] = None, audio_extension = "mp3", constraints: dict = None,
+                    streaming = False, cache: artifact_cache.ArtifactCache = None) -> list[dict]:
+    """ Download every video through the resolve -> transfer -> post-processing pipeline
+    """
+    jobs = (make_video_job(video, media_type, output_folder, verbose, audio_extension, constraints, streaming, cache)
+            for video in videos)
+    return run_pipeline(jobs, get_video_stages(), on_job_done=on_job_done)
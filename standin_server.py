@@ -0,0 +1,321 @@
+# ░▀█▀░█▄█░█▀█░█▀█░█▀▄░▀█▀░█▀▀
+# ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
+# ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API_KEY = "AIzaSyStandInKey000000000000000000000"
+CLIENT_VERSION = "2.20230301.00.00"
+
+# Videos listed per playlist page, like Youtube
+PAGE_SIZE = 100
+
+# Sent between two bandwidth checks of a media response
+WRITE_SIZE = 1024 * 16
+
+# Bytes per second of the media responses picked to be slow, like a throttled connection
+SLOW_BANDWIDTH = 1024 * 256
+
+# ░█▀▄░█▀▀░█▀▀░█▀█░█▀▄░█▀▄░▀█▀░█▀█░█▀▀░█▀▀
+# ░█▀▄░█▀▀░█░░░█░█░█▀▄░█░█░░█░░█░█░█░█░▀▀█
+# ░▀░▀░▀▀▀░▀▀▀░▀▀▀░▀░▀░▀▀░░▀▀▀░▀░▀░▀▀▀░▀▀▀
+
+
+def make_streams(seed = 0, audio_size = 1024 * 1024 * 3, video_size = 1024 * 1024 * 12) -> dict[int, dict]:
+    """ Formats served for every video, by itag, as in a recorded /player response.
+    Their content is random bytes, replace it with real media to run the post-processing.
+    """
+    generator = random.Random(seed)
+    return {
+        251: {"mimeType": 'audio/webm; codecs="opus"', "bitrate": 160000, "audioSampleRate": "48000",
+              "content": generator.randbytes(audio_size)},
+        140: {"mimeType": 'audio/mp4; codecs="mp4a.40.2"', "bitrate": 130000, "audioSampleRate": "44100",
+              "content": generator.randbytes(audio_size)},
+        248: {"mimeType": 'video/webm; codecs="vp9"', "bitrate": 2600000, "qualityLabel": "1080p", "height": 1080,
+              "content": generator.randbytes(video_size)},
+        137: {"mimeType": 'video/mp4; codecs="avc1.640028"', "bitrate": 4400000, "qualityLabel": "1080p", "height": 1080,
+              "content": generator.randbytes(video_size)},
+    }
+
+
+class RepeatedContent:
+    """ Content of size bytes repeating one random block, sliced like bytes without holding it in memory,
+    to serve streams of several GB.
+    """
+    def __init__(self, size: int, seed = 0, block_size = 1024 * 1024):
+        self.size = size
+        block = random.Random(seed).randbytes(block_size)
+        # Doubled, so any slice up to block_size bytes is a single copy
+        self.block = block + block
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: slice) -> bytes:
+        start, stop, _ = index.indices(self.size)
+        block_size = len(self.block) // 2
+        parts = []
+        while start < stop:
+            offset = start % block_size
+            part = self.block[offset:offset + min(stop - start, block_size)]
+            parts.append(part)
+            start += len(part)
+        return b"".join(parts)
+
+
+def make_page(body: str) -> bytes:
+    """ Page of a few hundred KB, the scripts around the data like on Youtube
+    """
+    filler = "".join(f"<script>var f{i} = function(a) {{ return a + {i}; }};</script>" for i in range(4000))
+    return (f"<html><head>{filler}<script>ytcfg.set({{\"INNERTUBE_API_KEY\":\"{API_KEY}\","
+            f"\"INNERTUBE_CLIENT_VERSION\":\"{CLIENT_VERSION}\"}});</script></head><body>{body}{filler}</body></html>").encode()
+
+
+def video_renderer(video_id: str) -> dict:
+    return {"playlistVideoRenderer": {"videoId": video_id, "title": {"runs": [{"text": f"Stand-in video {video_id}"}]}}}
+
+
+def continuation_renderer(token: str) -> dict:
+    return {"continuationItemRenderer": {"continuationEndpoint": {"continuationCommand": {"token": token}}}}
+
+# ░█▀▀░█▀▀░█▀▄░█░█░█▀▀░█▀▄
+# ░▀▀█░█▀▀░█▀▄░▀▄▀░█▀▀░█▀▄
+# ░▀▀▀░▀▀▀░▀░▀░░▀░░▀▀▀░▀░▀
+
+
+class StandInServer(ThreadingHTTPServer):
+    """ Local stand-in for Youtube: /watch pages holding the API key, /youtubei/v1/player streaming data,
+    playlist pages and their /youtubei/v1/browse continuations, thumbnails, and a range-capable /videoplayback.
+    latency is added to every response, bandwidth (bytes per second, 0 for none) caps each media response,
+    and failure_rate is the share of media responses that fail, half with a 503 and half cut in the middle.
+    slow_rate is the share of media responses sent at SLOW_BANDWIDTH.
+    """
+    daemon_threads = True
+
+    def __init__(self, host = "127.0.0.1", port = 0, latency = 0.0, bandwidth = 0, failure_rate = 0.0,
+                 playlist_size = 250, streams: dict[int, dict] = None, seed = 0, slow_rate = 0.0):
+        super().__init__((host, port), StandInHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.playlist_size = playlist_size
+        self.streams = streams or make_streams(seed)
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.thread = None
+
+        self.counters_lock = threading.Lock()
+        self.counters = {"requests": 0, "media_bytes": 0, "failures": 0, "slow": 0}
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, name: str, value = 1):
+        with self.counters_lock:
+            self.counters[name] += value
+
+    def pick_failure(self) -> str | None:
+        """ "status" or "cut" for the media responses that have to fail, "slow" for the slow ones, None for the others
+        """
+        with self.random_lock:
+            if self.random.random() >= self.failure_rate:
+                return "slow" if self.slow_rate and self.random.random() < self.slow_rate else None
+            return self.random.choice(["status", "cut"])
+
+    def handle_error(self, request, client_address):
+        # Clients drop connections on purpose, like the streamed API key extraction
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self) -> "StandInServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StandInServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type = "text/html; charset=utf-8", head = False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def route(self, head = False):
+        time.sleep(self.server.latency)
+        self.server.count("requests")
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/watch":
+            self.send_body(200, make_page(""), head=head)
+        elif url.path == "/playlist":
+            self.send_playlist(query.get("list", [""])[0], head)
+        elif url.path.startswith("/vi/"):
+            self.send_body(200, b"\xff\xd8\xff\xe0stand-in thumbnail", "image/jpeg", head)
+        elif url.path == "/videoplayback":
+            self.send_media(int(query.get("itag", ["0"])[0]), head)
+        elif url.path == "/stats":
+            with self.server.counters_lock:
+                self.send_body(200, json.dumps(self.server.counters).encode(), "application/json", head)
+        else:
+            self.send_body(404, b"Not found", head=head)
+
+    def do_HEAD(self):
+        self.route(head=True)
+
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        self.server.count("requests")
+        url = urlparse(self.path)
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        if parse_qs(url.query).get("key", [""])[0] != API_KEY:
+            self.send_body(403, json.dumps({"error": {"code": 403, "message": "Invalid key"}}).encode(), "application/json")
+        elif url.path == "/youtubei/v1/player":
+            self.send_body(200, json.dumps(self.player_response(request.get("videoId", ""))).encode(), "application/json")
+        elif url.path == "/youtubei/v1/browse":
+            # Continuation tokens are "<playlist id>:<first index>"
+            playlist_id, _, start = request.get("continuation", "").rpartition(":")
+            data = {"onResponseReceivedActions": [{"appendContinuationItemsAction": {
+                "continuationItems": self.playlist_items(playlist_id, int(start or 0))}}]}
+            self.send_body(200, json.dumps(data).encode(), "application/json")
+        else:
+            self.send_body(404, b"Not found")
+
+    def player_response(self, video_id: str) -> dict:
+        expire = int(time.time()) + 6 * 60 * 60
+        formats = []
+        for itag, stream in self.server.streams.items():
+            format = {key: value for key, value in stream.items() if key != "content"}
+            format.update({"itag": itag, "contentLength": str(len(stream["content"])), "averageBitrate": stream["bitrate"],
+                           "url": f"{self.server.url}/videoplayback?id={video_id}&itag={itag}&expire={expire}"})
+            formats.append(format)
+        return {"videoDetails": {"videoId": video_id, "title": f"Stand-in video {video_id}", "author": "Stand-in author"},
+                "streamingData": {"expiresInSeconds": "21600", "adaptiveFormats": formats}}
+
+    def playlist_items(self, playlist_id: str, start: int) -> list[dict]:
+        end = min(start + PAGE_SIZE, self.server.playlist_size)
+        items = [video_renderer(f"{playlist_id}{index:05d}") for index in range(start, end)]
+        if end < self.server.playlist_size:
+            items.append(continuation_renderer(f"{playlist_id}:{end}"))
+        return items
+
+    def send_playlist(self, playlist_id: str, head: bool):
+        initial_data = {"contents": {"twoColumnBrowseResultsRenderer": {"tabs": [{"tabRenderer": {"content": {
+            "sectionListRenderer": {"contents": [{"itemSectionRenderer": {"contents": [{"playlistVideoListRenderer": {
+                "contents": self.playlist_items(playlist_id, 0)}}]}}]}}}}]}}}
+        self.send_body(200, make_page(f"<script>var ytInitialData = {json.dumps(initial_data)};</script>"), head=head)
+
+    def send_media(self, itag: int, head: bool):
+        stream = self.server.streams.get(itag)
+        if not stream:
+            self.send_body(404, b"Not found", head=head)
+            return
+        content = stream["content"]
+
+        start, end, status = 0, len(content) - 1, 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start, status = int(match.group(1)), 206
+            end = min(int(match.group(2)), end) if match.group(2) else end
+
+        failure = None if head else self.server.pick_failure()
+        if failure == "status":
+            self.server.count("failures")
+            self.send_body(503, b"Injected failure")
+            return
+
+        self.send_response(status)
+        self.send_header("Content-Type", stream["mimeType"].split(";")[0])
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        self.end_headers()
+        if head:
+            return
+
+        # Cut in the middle of the body, the connection is closed
+        stop = start + (end - start + 1) // 2 if failure == "cut" else end + 1
+        bandwidth = SLOW_BANDWIDTH if failure == "slow" else self.server.bandwidth
+        if failure == "slow":
+            self.server.count("slow")
+        sent_at = time.monotonic()
+        for position in range(start, stop, WRITE_SIZE):
+            data = content[position:min(position + WRITE_SIZE, stop)]
+            self.wfile.write(data)
+            self.server.count("media_bytes", len(data))
+            if bandwidth:
+                sent_at += len(data) / bandwidth
+                delay = sent_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        if failure == "cut":
+            self.server.count("failures")
+            self.close_connection = True
+
+# ░█▄█░█▀█░▀█▀░█▀█
+# ░█░█░█▀█░░█░░█░█
+# ░▀░▀░▀░▀░▀▀▀░▀░▀
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for Youtube, for the benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes per second of each media response, 0 for no cap")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of media responses failing")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of media responses sent at a crawl")
+    parser.add_argument("--playlist-size", type=int, default=250)
+    parser.add_argument("--audio", help="file served as the only audio stream, an opus webm")
+    parser.add_argument("--large-size", type=int, default=0, help="size in bytes of an extra itag 22 stream, generated on the fly")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    streams = None
+    if args.audio:
+        with open(args.audio, "rb") as f:
+            streams = {251: {"mimeType": 'audio/webm; codecs="opus"', "bitrate": 128000, "audioSampleRate": "48000",
+                             "content": f.read()}}
+    if args.large_size:
+        streams = streams or make_streams(args.seed)
+        streams[22] = {"mimeType": 'video/mp4; codecs="avc1.64001F"', "bitrate": 2000000, "qualityLabel": "720p", "height": 720,
+                       "content": RepeatedContent(args.large_size, args.seed)}
+
+    server = StandInServer(args.host, args.port, args.latency, args.bandwidth, args.failure_rate, args.playlist_size,
+                           streams, args.seed, args.slow_rate)
+    # The first line tells the chosen port to the benchmark
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,63 @@
+import hashlib
+import pytest
+import async_download
+import standin_server
+
+STREAM_SIZE = 1024 * 1024 * 4
+CHUNK_SIZE = 1024 * 256
+
+
+def make_server(**options) -> standin_server.StandInServer:
+    streams = standin_server.make_streams(audio_size=STREAM_SIZE, video_size=STREAM_SIZE)
+    return standin_server.StandInServer(streams=streams, **options).start()
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = make_server()
+    yield server
+    server.stop()
+
+
+def content(server, itag: int) -> bytes:
+    return server.streams[itag]["content"][0:STREAM_SIZE]
+
+
+def test_downloads_are_identical(server, tmp_path):
+    jobs = [(f"{server.url}/videoplayback?itag={itag}", str(tmp_path / f"{itag}.bin"), {"expected_size": STREAM_SIZE})
+            for itag in (251, 137)]
+    assert async_download.download_files(jobs, 4, CHUNK_SIZE, display_bar=False, hedge=False) == [True, True]
+
+    for itag in (251, 137):
+        assert (tmp_path / f"{itag}.bin").read_bytes() == content(server, itag)
+        assert not (tmp_path / f"{itag}.bin.journal").exists()
+
+
+def test_failed_ranges_are_retried(tmp_path):
+    server = make_server(failure_rate=0.2, seed=1)
+    try:
+        stats = {}
+        path = tmp_path / "video.bin"
+        assert async_download.download_file(f"{server.url}/videoplayback?itag=137", str(path), 4, CHUNK_SIZE,
+                                            display_bar=False, stats=stats, expected_size=STREAM_SIZE)
+        assert path.read_bytes() == content(server, 137)
+        assert stats["retries"] > 0
+    finally:
+        server.stop()
+
+
+def test_hash_is_checked(server, tmp_path):
+    url = f"{server.url}/videoplayback?itag=137"
+    expected_hash = hashlib.sha256(content(server, 137)).hexdigest()
+    stats = {}
+    assert async_download.download_file(url, str(tmp_path / "good.bin"), 4, CHUNK_SIZE, display_bar=False, stats=stats,
+                                        hash_algorithm="sha256", expected_hash=expected_hash)
+    assert stats["hash"] == expected_hash
+
+    assert not async_download.download_file(url, str(tmp_path / "bad.bin"), 4, CHUNK_SIZE, display_bar=False,
+                                            hash_algorithm="sha256", expected_hash="0" * 64)
+
+
+def test_wrong_size_is_refused(server, tmp_path):
+    assert not async_download.download_file(f"{server.url}/videoplayback?itag=137", str(tmp_path / "video.bin"), 4, CHUNK_SIZE,
+                                            display_bar=False, expected_size=STREAM_SIZE + 1)
@@ -0,0 +1,66 @@
+import time
+import pytest
+import download
+import standin_server
+
+STREAM_SIZE = 1024 * 1024 * 8
+# Per connection, so the wall time tells how many connections were used
+BANDWIDTH = 1024 * 1024 * 4
+CHUNK_SIZE = 1024 * 1024
+# Long enough for the adaptive mode to measure the throughput and grow
+ADAPTIVE_SIZE = 1024 * 1024 * 32
+
+
+@pytest.fixture(scope="module")
+def server():
+    streams = standin_server.make_streams(audio_size=1024, video_size=1024)
+    streams[22] = {"mimeType": 'video/mp4; codecs="avc1.64001F"', "bitrate": 2000000, "qualityLabel": "720p", "height": 720,
+                   "content": standin_server.RepeatedContent(STREAM_SIZE)}
+    streams[18] = {"mimeType": 'video/mp4; codecs="avc1.42001E"', "bitrate": 500000, "qualityLabel": "360p", "height": 360,
+                   "content": standin_server.RepeatedContent(ADAPTIVE_SIZE, seed=1)}
+    server = standin_server.StandInServer(bandwidth=BANDWIDTH, streams=streams)
+    server.start()
+    yield server
+    server.stop()
+
+
+def timed_download(server, path, num_threads: int, itag = 22, **options) -> float:
+    start = time.monotonic()
+    assert download.download_file(f"{server.url}/videoplayback?itag={itag}", str(path), num_threads, CHUNK_SIZE,
+                                  display_bar=False, hedge=False, expected_size=len(server.streams[itag]["content"]), **options)
+    return time.monotonic() - start
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_download_is_identical(server, tmp_path, num_threads):
+    path = tmp_path / "video.mp4"
+    timed_download(server, path, num_threads)
+
+    assert path.read_bytes() == server.streams[22]["content"][0:STREAM_SIZE]
+    assert not (tmp_path / "video.mp4.journal").exists()
+
+
+def test_more_workers_are_faster(server, tmp_path):
+    single = timed_download(server, tmp_path / "single.mp4", 1)
+    parallel = timed_download(server, tmp_path / "parallel.mp4", 4)
+
+    assert single >= STREAM_SIZE / BANDWIDTH * 0.9
+    assert parallel < single / 2
+
+
+def test_adaptive_adds_workers(server, tmp_path):
+    stats = {}
+    adaptive = timed_download(server, tmp_path / "adaptive.mp4", 4, 18, adaptive=True, stats=stats)
+    fixed = timed_download(server, tmp_path / "fixed.mp4", 4, 18)
+
+    # Adaptive mode starts with 4 workers, each connection being capped it has to grow
+    assert stats["threads"] > 4
+    assert stats["chunk_sizes"][-1] == stats["chunk_size"]
+    assert (tmp_path / "adaptive.mp4").read_bytes() == server.streams[18]["content"][0:ADAPTIVE_SIZE]
+    assert adaptive <= fixed
+
+
+def test_missing_stream_fails(server, tmp_path):
+    path = tmp_path / "missing.mp4"
+    assert not download.download_file(f"{server.url}/videoplayback?itag=9", str(path), display_bar=False)
+    assert not path.exists()
@@ -0,0 +1,50 @@
+import threading
+import pipeline
+
+
+def run_with_timeout(*args, **kwargs) -> list[dict]:
+    results = []
+    thread = threading.Thread(target=lambda: results.append(pipeline.run_pipeline(*args, **kwargs)), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "the pipeline hangs"
+    return results[0]
+
+
+def double(job: dict):
+    job["value"] *= 2
+
+
+def test_failing_job_list_runs_the_queued_jobs():
+    def jobs():
+        for index in range(3):
+            yield {"video": index, "value": index}
+        raise ValueError("Could not fetch the next page")
+
+    results = run_with_timeout(jobs(), [("double", double, 2), ("double_again", double, 2)])
+
+    assert [job["value"] for job in results] == [0, 4, 8]
+
+
+def test_failing_on_job_done_does_not_stop_the_workers():
+    done = []
+
+    def on_job_done(job: dict):
+        done.append(job["video"])
+        raise RuntimeError("Callback failure")
+
+    jobs = [{"video": index, "value": index} for index in range(10)]
+    results = run_with_timeout(jobs, [("double", double, 2), ("double_again", double, 2)], queue_size=1, on_job_done=on_job_done)
+
+    assert [job["value"] for job in results] == [index * 4 for index in range(10)]
+    assert sorted(done) == list(range(10))
+
+
+def test_jobs_are_not_kept_without_collect():
+    done = []
+    jobs = [{"video": index, "value": index} for index in range(5)]
+
+    results = run_with_timeout(jobs, [("double", double, 2)], on_job_done=lambda job: done.append(job["value"]), collect=False)
+
+    assert results == []
+    assert sorted(done) == [0, 2, 4, 6, 8]
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import batch
+import ytb_classes
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+PLAYLIST_URL = "https://www.youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG"
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+class RecordedHandler(BaseHTTPRequestHandler):
+    """ Serves the recorded playlist page and its continuation, and records the browse requests
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/playlist"):
+            self.send_body(200, read_fixture("playlist_page.html"), "text/html; charset=utf-8")
+        else:
+            self.send_body(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        self.server.browse_requests.append((self.path, request))
+        if self.server.broken_continuation:
+            self.send_body(500, b"<html>Internal error</html>", "text/html")
+        elif self.path.startswith("/youtubei/v1/browse"):
+            self.send_body(200, read_fixture("continuation.json"), "application/json")
+        else:
+            self.send_body(404, b"Not found", "text/plain")
+
+
+@pytest.fixture
+def recorded_youtube(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordedHandler)
+    server.browse_requests = []
+    server.broken_continuation = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(ytb_classes, "YOUTUBE_URL", f"http://127.0.0.1:{server.server_port}")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def recorded_video_ids() -> list[str]:
+    page = read_fixture("playlist_page.html").decode()
+    continuation = json.loads(read_fixture("continuation.json"))
+    items = ytb_classes.html_extractor.extract_json(page)["contents"]["twoColumnBrowseResultsRenderer"]["tabs"][0][
+        "tabRenderer"]["content"]["sectionListRenderer"]["contents"][0]["itemSectionRenderer"]["contents"][0][
+        "playlistVideoListRenderer"]["contents"]
+    items += continuation["onResponseReceivedActions"][0]["appendContinuationItemsAction"]["continuationItems"]
+    return [item["playlistVideoRenderer"]["videoId"] for item in items if "playlistVideoRenderer" in item]
+
+
+def test_playlist_follows_continuations(recorded_youtube):
+    videos = ytb_classes.Playlist(PLAYLIST_URL).get_videos()
+
+    assert len(videos) > 100
+    assert [video.id for video in videos] == recorded_video_ids()
+    assert len(recorded_youtube.browse_requests) == 1
+
+    path, request = recorded_youtube.browse_requests[0]
+    assert "key=AIzaSyRecordedKey00000000000000000000" in path
+    assert request["continuation"].startswith("4qmFsgJhEiRWTFBM")
+    assert request["context"]["client"]["clientVersion"] == "2.20230301.00.00"
+
+
+def test_playlist_pages_are_fetched_lazily(recorded_youtube):
+    videos = ytb_classes.Playlist(PLAYLIST_URL).iter_videos()
+
+    first_page = [next(videos) for _ in range(100)]
+    assert len(first_page) == 100
+    assert recorded_youtube.browse_requests == []
+
+    next(videos)
+    assert len(recorded_youtube.browse_requests) == 1
+
+
+def test_broken_continuation_keeps_the_first_page(recorded_youtube):
+    recorded_youtube.broken_continuation = True
+    failures = []
+
+    videos = [video for _, video in batch.expand_urls(iter([PLAYLIST_URL]), failures)]
+
+    assert [video.id for video in videos] == recorded_video_ids()[:100]
+    assert len(failures) == 1 and failures[0]["url"] == PLAYLIST_URL
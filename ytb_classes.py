@@ -2,15 +2,18 @@
 # ░░█░░█░█░█▀▀░█░█░█▀▄░░█░░▀▀█
 # ░▀▀▀░▀░▀░▀░░░▀▀▀░▀░▀░░▀░░▀▀▀
 
-import requests
 import json
+import os
 import re
 import logging
-from bs4 import BeautifulSoup
-import socket
+import threading
 import time
-from urllib.request import Request, urlopen
+import requests
 from urllib.parse import urlparse, parse_qs
+from typing import Iterator
+import http_client
+import html_extractor
+import metrics
 
 # ░█░█░▀█▀░█▀▄░█▀▀░█▀█
 # ░▀▄▀░░█░░█░█░█▀▀░█░█
@@ -19,6 +22,82 @@ from urllib.parse import urlparse, parse_qs
 # HUGE THANKS TO https://github.com/ewtoombs
 # => https://github.com/ytdl-org/youtube-dl/issues/28859
 
+# Base urls of the Youtube pages and API, and of the thumbnails, read on each request
+YOUTUBE_URL = "https://www.youtube.com"
+THUMBNAIL_URL = "https://i.ytimg.com"
+
+API_HEADERS = {
+    # This is to demonstrate how little the user agent matters
+    'User-Agent': 'Hello Google :)',
+}
+
+# The Innertube API key is the same for every video, so it is cached in memory and on disk
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache")
+API_KEY_CACHE = os.path.join(CACHE_FOLDER, "api_key.json")
+API_KEY_TTL = 60 * 60 * 24
+
+# Lifetime of the streaming data when the stream urls do not tell it, and safety margin before it expires, in seconds
+STREAMING_DATA_TTL = 60 * 60
+EXPIRY_MARGIN = 60
+
+_api_key = None
+_api_key_lock = threading.Lock()
+
+
+@metrics.timed("api_key_fetch")
+def fetch_api_key(video_id: str) -> str:
+    """ Get the Innertube API key from the /watch page of any video
+    """
+    # Hit the /watch endpoint, but we actually only want an API key lol.
+    # The page is read as it arrives, and dropped as soon as the key shows up
+    with http_client.get_session().get(
+        f"{YOUTUBE_URL}/watch",
+        params={'v': video_id},
+        headers=API_HEADERS,
+        stream=True,
+    ) as response:
+        key = html_extractor.search_chunks(response.iter_content(chunk_size=1024 * 64))
+
+    assert key is not None
+    return key.decode()
+
+
+def get_api_key(video_id: str) -> str:
+    """ Get the Innertube API key from the process cache, then the disk cache,
+    and only fetch it again once both are older than API_KEY_TTL seconds.
+    """
+    global _api_key
+    with _api_key_lock:
+        if _api_key is None and os.path.isfile(API_KEY_CACHE):
+            try:
+                with open(API_KEY_CACHE, "r") as f:
+                    _api_key = json.load(f)
+            except (OSError, ValueError):
+                logging.exception(f"Could not read API key cache {API_KEY_CACHE}")
+
+        if _api_key is not None and time.time() - _api_key["fetched_at"] < API_KEY_TTL:
+            return _api_key["key"]
+
+        _api_key = {"key": fetch_api_key(video_id), "fetched_at": time.time()}
+        try:
+            os.makedirs(CACHE_FOLDER, exist_ok=True)
+            with open(API_KEY_CACHE + ".tmp", "w") as f:
+                json.dump(_api_key, f)
+            os.replace(API_KEY_CACHE + ".tmp", API_KEY_CACHE)
+        except OSError:
+            logging.exception(f"Could not write API key cache {API_KEY_CACHE}")
+        return _api_key["key"]
+
+
+def invalidate_api_key():
+    """ Forget the cached API key, the next get_api_key call fetches a new one
+    """
+    global _api_key
+    with _api_key_lock:
+        _api_key = None
+        if os.path.isfile(API_KEY_CACHE):
+            os.remove(API_KEY_CACHE)
+
 
 class Video:
     def __init__(self, url: str):
@@ -27,42 +106,20 @@ class Video:
                 self.id = re.search(r'(?<=v=)[^&]+', url).group(0)
             else:
                 self.id = url.split("/")[-1]
-            self.url = f"https://www.youtube.com/watch?v={self.id}"
+            self.url = f"{YOUTUBE_URL}/watch?v={self.id}"
         except:
             raise ValueError("Given link is not a Youtube video")
 
+        # Resolved formats, reused until the stream urls expire
+        self._formats = None
+        self._expires_at = 0
+        self.thumbnail = None
+
     def __repr__(self) -> str:
         return self.url
 
-    def _get_api_key(self) -> tuple[requests.Session, str]:
-        session = requests.Session()
-        session.headers = {
-            # This is to demonstrate how little the user agent matters
-            'User-Agent': 'Hello Google :)',
-        }
-
-        # Hit the /watch endpoint, but we actually only want an API key lol.
-        response = session.get(
-            "https://www.youtube.com/watch",
-            params={'v': id},
-        ).content.decode()
-
-        soup = BeautifulSoup(response, "html.parser")
-
-        # get the key
-        key = None
-        for script_tag in soup.find_all("script"):
-            script = script_tag.string
-            if script is not None:
-                match = re.search(r'"INNERTUBE_API_KEY":"([^"]+)"', script)
-                if match is not None:
-                    key = match.group(1)
-                    break
-        assert key is not None
-        return session, key
-
-    def _get_valid_format(self) -> dict:
-        session, key = self._get_api_key()
+    def _get_valid_format(self, retry_key = True) -> dict:
+        key = get_api_key(self.id)
         # OK, now use the API key to get the actual streaming data.
         post_data = {
             'context': {
@@ -74,22 +131,61 @@ class Video:
             'videoId': self.id,
         }
 
-        data = json.loads(session.post(
-            "https://www.youtube.com/youtubei/v1/player",
-            params={'key': key},
-            data=json.dumps(post_data),
-        ).content)
-
+        with metrics.span("player_post"):
+            response = http_client.get_session().post(
+                f"{YOUTUBE_URL}/youtubei/v1/player",
+                params={'key': key},
+                data=json.dumps(post_data),
+                headers=API_HEADERS,
+            )
+        # An error page is not JSON, only a successful body is parsed
+        data = json.loads(response.content) if response.ok else {}
+
+        # The cached key may have been revoked, get a fresh one and try again
+        if (response.status_code in (400, 401, 403) or "error" in data) and retry_key:
+            logging.warning("API key rejected, fetching a new one")
+            invalidate_api_key()
+            metrics.count("retries", stage="api_key")
+            return self._get_valid_format(retry_key=False)
+
+        if not response.ok:
+            logging.error(f"Could not fetch the player data of {self.id}, status {response.status_code}")
         return data
 
+    def is_expired(self) -> bool:
+        """ Whether the resolved stream urls are about to expire, or were never resolved
+        """
+        return self._formats is None or time.time() >= self._expires_at - EXPIRY_MARGIN
+
+    def get_fresh_format(self, format: dict) -> dict | None:
+        """ Returns the given format, resolved again if its url expired meanwhile
+        """
+        if not self.is_expired():
+            return format
+
+        formats = self.get_extraction_url()
+        if not formats:
+            return None
+        for fresh_format in formats["audio"] + formats["video"]:
+            if fresh_format["itag"] == format["itag"]:
+                return fresh_format
+        return None
+
     def get_extraction_url(self) -> dict | None:
+        """ Resolve the video title, author, thumbnail and formats.
+        The result is kept and reused until the stream urls expire.
+        """
+        if not self.is_expired():
+            return self._formats
+
         data = self._get_valid_format()
 
         # retry counter
         retry = 3
-        while "videoDetails" not in data.keys() or "streamingData" not in data.keys() and retry > 0:
+        while ("videoDetails" not in data.keys() or "streamingData" not in data.keys()) and retry > 0:
             data = self._get_valid_format()
             retry -= 1
+            metrics.count("retries", stage="player")
             logging.error("Could not fetch video data, retrying...")
             time.sleep(2)
 
@@ -100,9 +196,10 @@ class Video:
         self.title = data["videoDetails"]["title"]
 
         # Try to fetch the thumbnail, as sometimes the sddefault.jpg does not exist
-        for image_name in ["sddefault.jpg", "mqdefault.jpg", "default.jpg"]:
-            self.thumbnail = f"https://i.ytimg.com/vi/{self.id}/{image_name}"
-            test_thumbnail = requests.get(self.thumbnail)
+        for image_name in ["sddefault.jpg", "mqdefault.jpg", "default.jpg"] if not self.thumbnail else []:
+            self.thumbnail = f"{THUMBNAIL_URL}/vi/{self.id}/{image_name}"
+            with metrics.span("thumbnail_probe"):
+                test_thumbnail = http_client.get_session().head(self.thumbnail)
 
             if test_thumbnail.status_code != 404:
                 break
@@ -132,6 +229,15 @@ class Video:
                 if "audioSampleRate" in format.keys():
                     important_keys["samplerate"] = format["audioSampleRate"]
 
+                # mime example: video/mp4; codecs="avc1.640028"
+                important_keys["container"] = format["mimeType"].split("/")[1].split(";")[0]
+                codecs = re.search(r'codecs="([^"]+)"', format["mimeType"])
+                important_keys["codecs"] = codecs.group(1).split(", ") if codecs else []
+                if "height" in format.keys():
+                    important_keys["height"] = format["height"]
+                if "contentLength" in format.keys():
+                    important_keys["filesize"] = int(format["contentLength"])
+
                 all_info["formats"].append(important_keys)
             except:
                 logging.exception(f"Could not fetch format {format}")
@@ -152,7 +258,13 @@ class Video:
         video_list = sorted(
             video_list, key=lambda x: x['bitrate'], reverse=True)
 
-        return {"audio": audio_list, "video": video_list}
+        # The stream urls carry their expiry timestamp
+        expires = [int(parse_qs(urlparse(item["url"]).query)["expire"][0])
+                   for item in all_info["formats"] if "expire" in parse_qs(urlparse(item["url"]).query)]
+        self._expires_at = min(expires) if expires else time.time() + STREAMING_DATA_TTL
+        self._formats = {"audio": audio_list, "video": video_list}
+
+        return self._formats
 
 # ░█▀█░█░░░█▀█░█░█░█░░░▀█▀░█▀▀░▀█▀
 # ░█▀▀░█░░░█▀█░░█░░█░░░░█░░▀▀█░░█░
@@ -167,7 +279,7 @@ class Playlist:
             # get the playlist ID
             parsed = urlparse(url)
             self.id = parse_qs(parsed.query)['list'][0]
-            self.url = f"https://www.youtube.com/playlist?list={self.id}"
+            self.url = f"{YOUTUBE_URL}/playlist?list={self.id}"
         except:
             raise ValueError("Given link is not a Youtube playlist")
 
@@ -181,28 +293,21 @@ class Playlist:
         if self._html:
             return self._html
 
-        request = Request(self.url,
-                          headers={"User-Agent": "Mozilla/5.0",
-                                   "accept-language": "en-US,en"},
-                          method="GET")
+        response = http_client.get_session().get(self.url,
+                                                 headers={"User-Agent": "Mozilla/5.0",
+                                                          "accept-language": "en-US,en"})
 
-        self._html = urlopen(request, timeout=socket._GLOBAL_DEFAULT_TIMEOUT)
-        self._html = self._html.read().decode("utf-8")
+        self._html = response.content.decode("utf-8")
         return self._html
 
-    def _get_initial_data(self) -> dict:
-        patterns = [r'ytInitialData =\s*({.+?});']
-
-        for pattern in patterns:
-            regex = re.compile(pattern)
-            result = regex.search(self.html)
-            if result:
-                js = json.loads(result.group(1))
-                if "contents" in js.keys():
-                    return js
+    def _get_initial_data(self) -> dict | None:
+        js = html_extractor.extract_json(self.html)
+        if js and "contents" in js.keys():
+            return js
+        return None
 
-    def get_videos(self) -> list[Video] | None:
-        """ Get videos (works only for <= 100 videos)
+    def _get_first_page(self) -> list[dict] | None:
+        """ Items of the first page of the playlist, as found in the page ytInitialData
         """
         init_data = self._get_initial_data()
 
@@ -224,9 +329,64 @@ class Playlist:
             important_content = section_contents[
                 1]["itemSectionRenderer"][
                 "contents"][0]["playlistVideoListRenderer"]
-        videos = important_content["contents"]
+        return important_content["contents"]
+
+    def _get_continuation(self, token: str) -> list[dict]:
+        """ Items of the next page of the playlist, fetched from the browse endpoint
+        """
+        # The playlist page embeds the API key and the client version of the web client
+        key = re.search(r'"INNERTUBE_API_KEY":"([^"]+)"', self.html)
+        client_version = re.search(r'"INNERTUBE_CLIENT_VERSION":"([^"]+)"', self.html)
+        post_data = {
+            'context': {
+                'client': {
+                    'clientName': 'WEB',
+                    'clientVersion': client_version.group(1) if client_version else '2.20230301.00.00',
+                },
+            },
+            'continuation': token,
+        }
 
-        videos = [
-            Video(f"https://www.youtube.com/watch?v={x['playlistVideoRenderer']['videoId']}") for x in videos]
+        response = http_client.get_session().post(
+            f"{YOUTUBE_URL}/youtubei/v1/browse",
+            params={'key': key.group(1) if key else get_api_key("")},
+            data=json.dumps(post_data),
+            headers={"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"},
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        items = []
+        for action in data.get("onResponseReceivedActions", []):
+            items += action.get("appendContinuationItemsAction", {}).get("continuationItems", [])
+        return items
+
+    def iter_videos(self) -> Iterator[Video]:
+        """ Yield the videos page by page, following the continuation tokens,
+        so the first videos are available before the whole playlist is listed.
+        Raises ValueError if the playlist cannot be fetched,
+        requests.RequestException if one of its next pages cannot.
+        """
+        items = self._get_first_page()
+        if items is None:
+            raise ValueError("Cannot fetch playlist data")
+
+        while items:
+            token = None
+            for item in items:
+                if "playlistVideoRenderer" in item:
+                    yield Video(f"{YOUTUBE_URL}/watch?v={item['playlistVideoRenderer']['videoId']}")
+                elif "continuationItemRenderer" in item:
+                    token = item["continuationItemRenderer"]["continuationEndpoint"]["continuationCommand"]["token"]
+
+            if not token:
+                return
+            items = self._get_continuation(token)
 
-        return videos
+    def get_videos(self) -> list[Video] | None:
+        """ Get every video of the playlist
+        """
+        try:
+            return list(self.iter_videos())
+        except (ValueError, requests.RequestException):
+            return None